@@ -12,6 +12,7 @@ setup(
         "InquirerPy",
         "quart",
         "requests",  
+        "httpx",
         "tabulate",
         "tqdm",
         "fastapi",
@@ -26,6 +27,8 @@ setup(
             "torrent-fetch=torrent_peer.torrent_cli:get_torrent",
             "torrent-leech=torrent_peer.torrent_cli:leech",
             "torrent-status=torrent_peer.torrent_cli:status",
+            "torrent-recheck=torrent_peer.torrent_cli:recheck",
+            "torrent-limit=torrent_peer.torrent_cli:limit",
             "torrent-test=torrent_peer.torrent_cli:test"
         ],
     },
@@ -0,0 +1,153 @@
+import asyncio
+import pytest
+from torrent_peer import announce_scheduler
+from torrent_peer.announce_scheduler import AnnounceScheduler, DEFAULT_INTERVAL
+
+@pytest.fixture(autouse=True)
+def fast_batches(monkeypatch):
+    monkeypatch.setattr(announce_scheduler, "BATCH_DELAY", 0.01)
+    monkeypatch.setattr(announce_scheduler, "ANNOUNCE_JITTER", 0)
+
+class FakeTrackers:
+    """ Records the batches announced, answering with the interval set for each tracker """
+    def __init__(self, intervals=None, fail=()):
+        self.intervals = intervals or {}
+        self.fail = set(fail)
+        self.calls = []
+
+    async def announce(self, tracker_url, torrents):
+        self.calls.append((tracker_url, list(torrents)))
+        if tracker_url in self.fail:
+            raise ConnectionError("tracker down")
+        response = {"peers": [{"ip": "10.0.0.1", "port": 6881}], "min interval": 0.01}
+        if tracker_url in self.intervals:
+            response["interval"] = self.intervals[tracker_url]
+        return {info_hash: response for info_hash, _ in torrents}
+
+def hashes(*numbers):
+    return [bytes([number]) * 20 for number in numbers]
+
+def test_first_announce_sends_the_event_and_reports_peers():
+    trackers = FakeTrackers({"x": 60})
+    received = []
+
+    async def main():
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=0)
+        [info_hash] = hashes(1)
+        response = await asyncio.wait_for(scheduler.add(info_hash, "x", on_peers=received.append), 1)
+        assert response["interval"] == 60
+        await asyncio.sleep(0)
+        state = scheduler.torrents[info_hash]
+        assert state.event is None and state.interval == 60
+        assert state.due == pytest.approx(state.last_announce + 60)
+        await scheduler.stop()
+        return info_hash
+
+    info_hash = asyncio.run(main())
+    assert trackers.calls == [("x", [(info_hash, "started")]), ("x", [(info_hash, "stopped")])]
+    assert received == [[{"ip": "10.0.0.1", "port": 6881}]]
+
+def test_intervals_are_kept_per_tracker():
+    trackers = FakeTrackers({"x": 60})
+
+    async def main():
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=0)
+        first, second, third = hashes(1, 2, 3)
+        await asyncio.wait_for(scheduler.add(first, "x"), 1)
+        # Torrents just announced by the caller wait for the interval of their tracker
+        scheduler.add(second, "x", event=None)
+        scheduler.add(third, "y", event=None)
+        assert scheduler.intervals == {"x": 60}
+        assert scheduler.torrents[second].interval == 60
+        assert scheduler.torrents[third].interval == DEFAULT_INTERVAL
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+def test_a_torrent_short_of_peers_announces_again_early():
+    trackers = FakeTrackers({"x": 60})
+
+    async def main():
+        peers = 0
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=1)
+        [info_hash] = hashes(1)
+        await asyncio.wait_for(scheduler.add(info_hash, "x", peer_count=lambda: peers), 1)
+        await asyncio.sleep(0.1)
+        announces = len(trackers.calls)
+        peers = 1
+        await asyncio.sleep(0.1)
+        assert announces >= 3 and len(trackers.calls) <= announces + 1
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+def test_failed_announces_are_retried_with_their_event():
+    trackers = FakeTrackers({"x": 60}, fail={"x"})
+
+    async def main():
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=0, retry=0.02)
+        [info_hash] = hashes(1)
+        first = scheduler.add(info_hash, "x")
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(asyncio.shield(first), 1)
+        trackers.fail.clear()
+        while scheduler.torrents[info_hash].failures:
+            await asyncio.sleep(0.01)
+        await scheduler.remove(info_hash)
+        return info_hash
+
+    info_hash = asyncio.run(main())
+    assert [torrents for _, torrents in trackers.calls[-2:]] == [[(info_hash, "started")], [(info_hash, "stopped")]]
+    assert len(trackers.calls) >= 3
+
+def test_torrents_due_together_share_one_request_per_tracker():
+    trackers = FakeTrackers({"x": 60, "y": 60})
+
+    async def main():
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=0)
+        first, second, third = hashes(1, 2, 3)
+        await asyncio.wait_for(asyncio.gather(scheduler.add(first, "x"), scheduler.add(second, "y"),
+                                              scheduler.add(third, "x")), 1)
+        await scheduler.stop()
+        return first, second, third
+
+    first, second, third = asyncio.run(main())
+    assert sorted(trackers.calls) == [
+        ("x", [(first, "started"), (third, "started")]),
+        ("x", [(first, "stopped"), (third, "stopped")]),
+        ("y", [(second, "started")]),
+        ("y", [(second, "stopped")]),
+    ]
+
+def test_batches_are_split_at_batch_size(monkeypatch):
+    monkeypatch.setattr(announce_scheduler, "BATCH_SIZE", 2)
+    trackers = FakeTrackers({"x": 60})
+
+    async def main():
+        scheduler = AnnounceScheduler(trackers.announce, min_peers=0)
+        await asyncio.wait_for(asyncio.gather(*(scheduler.add(info_hash, "x") for info_hash in hashes(1, 2, 3))), 1)
+        await scheduler.stop()
+
+    asyncio.run(main())
+    assert [(torrents[0][1], len(torrents)) for _, torrents in trackers.calls] == \
+        [("started", 2), ("started", 1), ("stopped", 2), ("stopped", 1)]
+
+def test_a_torrent_missing_from_the_response_fails_alone():
+    trackers = FakeTrackers({"x": 60})
+    announce = trackers.announce
+
+    async def partial_announce(tracker_url, torrents):
+        responses = await announce(tracker_url, torrents)
+        responses.pop(bytes([2]) * 20, None)
+        return responses
+
+    async def main():
+        scheduler = AnnounceScheduler(partial_announce, min_peers=0)
+        first, second = hashes(1, 2)
+        futures = [scheduler.add(first, "x"), scheduler.add(second, "x")]
+        done = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 1)
+        assert isinstance(done[0], dict) and isinstance(done[1], RuntimeError)
+        assert scheduler.torrents[first].failures == 0 and scheduler.torrents[second].failures == 1
+        await scheduler.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from torrent_tracker.catalog import Catalog
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    yield catalog
+    catalog.close()
+
+def add_all(catalog, names):
+    for number, name in enumerate(names):
+        catalog.add(f"{number:040x}", name, f"about {name}", f"/torrents/{number}.torrent")
+
+def pages(catalog, **kwargs):
+    """ The names of every page of a listing """
+    result, cursor = [], None
+    while True:
+        torrents, cursor = catalog.list(cursor=cursor, **kwargs)
+        result.append([torrent["name"] for torrent in torrents])
+        if cursor is None:
+            return result
+
+def test_pages_cover_every_torrent_once(catalog):
+    add_all(catalog, ["delta", "alpha", "charlie", "bravo", "alpha", "echo", "foxtrot"])
+    assert pages(catalog, limit=3) == [["alpha", "alpha", "bravo"], ["charlie", "delta", "echo"], ["foxtrot"]]
+    assert pages(catalog, limit=7) == [["alpha", "alpha", "bravo", "charlie", "delta", "echo", "foxtrot"]]
+
+def test_prefix_and_search(catalog):
+    add_all(catalog, ["linux.iso", "Linux docs", "lint", "my_linux", "my%linux", "zlib"])
+    assert pages(catalog, limit=2, prefix="lin") == [["lint", "linux.iso"]]
+    assert pages(catalog, limit=10, search="LINUX") == [["Linux docs", "linux.iso", "my%linux", "my_linux"]]
+    # Wildcards are searched literally
+    assert pages(catalog, limit=10, search="y_l") == [["my_linux"]]
+    assert pages(catalog, limit=10, search="%") == [["my%linux"]]
+
+def test_fields(catalog):
+    add_all(catalog, ["alpha"])
+    torrents, _ = catalog.list(fields=("description",))
+    assert torrents == [{"info_hash": f"{0:040x}", "description": "about alpha"}]
+    torrents, _ = catalog.list()
+    assert torrents == [{"info_hash": f"{0:040x}", "name": "alpha", "description": "about alpha"}]
+    with pytest.raises(ValueError):
+        catalog.list(fields=("file_path",))
+
+def test_bad_cursor(catalog):
+    with pytest.raises(ValueError):
+        catalog.list(cursor="not a cursor")
+
+def test_add_replaces_and_get(catalog):
+    assert catalog.is_empty() and catalog.get("a" * 40) is None
+    catalog.add("a" * 40, "old", "", "/old.torrent")
+    catalog.add("a" * 40, "new", "text", "/new.torrent")
+    assert catalog.get("a" * 40) == {"info_hash": "a" * 40, "name": "new", "description": "text",
+                                     "file_path": "/new.torrent"}
+    assert not catalog.is_empty()
+
+def test_import_json(catalog, tmp_path):
+    path = tmp_path / "torrents.json"
+    path.write_text(json.dumps({
+        "a" * 40: {"name": "alpha", "file_path": "/a.torrent"},
+        "b" * 40: {"name": "no file"},
+    }))
+    catalog.add("a" * 40, "kept", "", "/kept.torrent")
+    assert catalog.import_json(str(path)) == 2
+    assert catalog.get("a" * 40)["name"] == "kept"
+    assert catalog.get("b" * 40) is None
+
+def test_threads_share_the_catalog(catalog):
+    def work(number):
+        catalog.add(f"{number:040x}", f"name {number:03}", "", "/t.torrent")
+        assert catalog.get(f"{number:040x}")["name"] == f"name {number:03}"
+        return len(catalog.list(limit=1000)[0])
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert all(count >= 1 for count in executor.map(work, range(200)))
+    assert len(catalog.list(limit=1000)[0]) == 200
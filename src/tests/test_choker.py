@@ -0,0 +1,153 @@
+import pytest
+from torrent_peer import choker as choker_module
+from torrent_peer.choker import Choker, UploadPeer, OPTIMISTIC_UNCHOKE_ROUNDS
+from torrent_peer.peer_message import Choke, Unchoke
+
+class FakeWriter:
+    def __init__(self):
+        self.written = []
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+def make_choker(number_of_peers, upload_slots=3, seeding=False):
+    choker = Choker(lambda: seeding, upload_slots)
+    peers = [UploadPeer(FakeWriter(), bytes([i]) * 20) for i in range(number_of_peers)]
+    for peer in peers:
+        choker.add(peer)
+    return choker, peers
+
+def unchoked(peers):
+    return [peers.index(peer) for peer in peers if not peer.choked]
+
+@pytest.fixture
+def first_choice(monkeypatch):
+    """ Make the optimistic unchoke pick the first candidate, and record the candidates """
+    candidates = []
+    def choice(others):
+        candidates.append(list(others))
+        return others[0]
+    monkeypatch.setattr(choker_module.random, "choice", choice)
+    return candidates
+
+def test_interested_peers_fill_free_slots():
+    choker, peers = make_choker(4, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    assert unchoked(peers) == [0, 1]
+    assert peers[0].writer.written == [Unchoke().encode()]
+    assert peers[2].writer.written == []
+
+def test_lost_interest_frees_the_slot():
+    choker, peers = make_choker(3, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    peers[0].queue.append((0, 0, 16384))
+    choker.set_interested(peers[0], False)
+    assert unchoked(peers) == [1, 2]
+    assert peers[0].writer.written[-1] == Choke().encode()
+    assert not peers[0].queue
+
+def test_removed_peer_frees_the_slot():
+    choker, peers = make_choker(3, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.remove(peers[1])
+    assert not peers[2].choked
+    assert peers[1] not in choker.peers
+
+def test_rechoke_ranks_by_download_rate_while_leeching(first_choice):
+    choker, peers = make_choker(5, upload_slots=3)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.received(peers[3].peer_id, 3000)
+    choker.received(peers[4].peer_id, 2000)
+    choker.received(peers[1].peer_id, 1000)
+    peers[0].uploaded = 10**6     # Only breaks ties while leeching
+    choker.rechoke(interval=10)
+    assert peers[3].download_rate == 300
+    # Two regular slots, and the optimistic one among the rest
+    assert first_choice == [[peers[1], peers[0], peers[2]]]
+    assert unchoked(peers) == [1, 3, 4]
+    assert choker.optimistic is peers[1]
+    assert peers[0].writer.written[-1] == Choke().encode()
+
+def test_rechoke_ranks_by_upload_rate_while_seeding(first_choice):
+    choker, peers = make_choker(4, upload_slots=2, seeding=True)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    peers[2].uploaded = 5000
+    peers[3].uploaded = 1000
+    choker.received(peers[1].peer_id, 10**6)
+    choker.rechoke(interval=10)
+    assert peers[2].upload_rate == 500
+    # peers[2] regular, then the optimistic slot among [3, 1, 0]
+    assert first_choice == [[peers[3], peers[1], peers[0]]]
+    assert unchoked(peers) == [2, 3]
+
+def test_rates_cover_the_last_interval_only(first_choice):
+    choker, peers = make_choker(2, upload_slots=2, seeding=True)
+    peers[0].uploaded = 1000
+    choker.rechoke(interval=10)
+    peers[0].uploaded = 1500
+    choker.received(peers[0].peer_id, 100)
+    choker.rechoke(interval=10)
+    choker.rechoke(interval=10)
+    assert (peers[0].upload_rate, peers[0].download_rate) == (0, 0)
+
+def test_optimistic_unchoke_rotates(first_choice):
+    choker, peers = make_choker(4, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.received(peers[0].peer_id, 1000)
+    choker.rechoke()
+    assert choker.optimistic is peers[1]
+    # Kept for OPTIMISTIC_UNCHOKE_ROUNDS rechokes, even though choice() would still pick it
+    for _ in range(OPTIMISTIC_UNCHOKE_ROUNDS - 1):
+        choker.received(peers[0].peer_id, 1000)
+        choker.rechoke()
+    assert len(first_choice) == 1
+    # Then picked again among the others
+    peers[1].interested = False
+    peers[2].interested = False
+    choker.received(peers[0].peer_id, 1000)
+    choker.rechoke()
+    assert len(first_choice) == 2
+    assert choker.optimistic is peers[3]
+    assert unchoked(peers) == [0, 3]
+
+def test_optimistic_peer_replaced_when_no_longer_interested(first_choice):
+    choker, peers = make_choker(4, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.received(peers[0].peer_id, 1000)
+    choker.rechoke()
+    assert choker.optimistic is peers[1]
+    choker.set_interested(peers[1], False)
+    choker.received(peers[0].peer_id, 1000)
+    choker.rechoke()
+    assert choker.optimistic is peers[2]
+
+def test_optimistic_peer_promoted_to_regular_is_replaced(first_choice):
+    choker, peers = make_choker(3, upload_slots=2)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.received(peers[0].peer_id, 1000)
+    choker.rechoke()
+    assert choker.optimistic is peers[1]
+    choker.received(peers[1].peer_id, 5000)
+    choker.rechoke()
+    assert choker.optimistic is peers[0]
+    assert unchoked(peers) == [0, 1]
+
+def test_single_slot_has_no_optimistic_unchoke(first_choice):
+    choker, peers = make_choker(3, upload_slots=1)
+    for peer in peers:
+        choker.set_interested(peer, True)
+    choker.received(peers[2].peer_id, 1000)
+    choker.rechoke()
+    assert unchoked(peers) == [2]
+    assert first_choice == [] and choker.optimistic is None
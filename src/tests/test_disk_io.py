@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import pytest
+from torrent_peer import disk_io
+from torrent_peer.disk_io import DiskIO
+from torrent_peer.storage import FileStorage
+
+class RecordingStorage(FileStorage):
+    """ A FileStorage that records the writes it gets """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writes = []
+
+    def write(self, offset, data):
+        self.writes.append((offset, len(data)))
+        super().write(offset, data)
+
+def make_storage(tmp_path, length, files=None):
+    if files:
+        for path, file_length in files:
+            with open(tmp_path / path, "wb") as file:
+                file.truncate(file_length)
+        return RecordingStorage(str(tmp_path), files, length, writable=True)
+    path = tmp_path / "data"
+    with open(path, "wb") as file:
+        file.truncate(length)
+    return RecordingStorage(str(path), None, length, writable=True)
+
+def test_runs_merge_adjacent_writes_in_offset_order():
+    loop = asyncio.new_event_loop()
+    try:
+        futures = {offset: loop.create_future() for offset in (0, 10, 20, 40, 50)}
+        batch = {offset: (b"x" * 10, futures[offset]) for offset in (50, 20, 0, 40, 10)}
+        runs = [(offset, [len(data) for data in buffers], len(run_futures))
+                for offset, buffers, run_futures in DiskIO._runs(batch)]
+    finally:
+        loop.close()
+    assert runs == [(0, [10, 10, 10], 3), (40, [10, 10], 2)]
+
+def test_runs_are_split_at_the_largest_write(monkeypatch):
+    monkeypatch.setattr(disk_io, "MAX_WRITE_SIZE", 25)
+    batch = {offset: (b"x" * 10, None) for offset in range(0, 50, 10)}
+    assert [offset for offset, _, _ in DiskIO._runs(batch)] == [0, 20, 40]
+
+def test_adjacent_pieces_are_written_together(tmp_path):
+    storage = make_storage(tmp_path, 64)
+    pieces = {offset: bytes([offset]) * 16 for offset in (48, 0, 16, 32)}
+
+    async def main():
+        disk = DiskIO(storage, workers=1, delay=0.05, sync_policy="none")
+        futures = [await disk.write(offset, data) for offset, data in pieces.items()]
+        await asyncio.gather(*futures)
+        assert disk.buffered == 0
+        await disk.close()
+
+    asyncio.run(main())
+    assert storage.writes == [(0, 64)]
+    with open(tmp_path / "data", "rb") as file:
+        assert file.read() == b"".join(pieces[offset] for offset in sorted(pieces))
+
+def test_writes_span_files(tmp_path):
+    storage = make_storage(tmp_path, 30, files=[("a", 10), ("b", 5), ("c", 15)])
+
+    async def main():
+        disk = DiskIO(storage, workers=2, delay=0)
+        await (await disk.write(0, bytes(range(30))))
+        await disk.close()
+
+    asyncio.run(main())
+    assert (tmp_path / "a").read_bytes() == bytes(range(10))
+    assert (tmp_path / "b").read_bytes() == bytes(range(10, 15))
+    assert (tmp_path / "c").read_bytes() == bytes(range(15, 30))
+
+def test_a_duplicate_write_shares_the_queued_one(tmp_path):
+    storage = make_storage(tmp_path, 32)
+
+    async def main():
+        disk = DiskIO(storage, delay=0.05)
+        first = await disk.write(0, b"a" * 16)
+        second = await disk.write(0, b"a" * 16)
+        assert second is first and disk.buffered == 16
+        with pytest.raises(ValueError):
+            await disk.write(0, b"a" * 8)
+        await first
+        assert disk.buffered == 0
+        await disk.close()
+
+    asyncio.run(main())
+    assert storage.writes == [(0, 16)]
+
+def test_write_waits_while_the_buffer_is_full(tmp_path):
+    storage = make_storage(tmp_path, 64)
+    written = storage.write
+    unblock = threading.Event()
+
+    def slow_write(offset, data):
+        unblock.wait(timeout=5)
+        written(offset, data)
+    storage.write = slow_write
+
+    async def main():
+        disk = DiskIO(storage, max_buffer=32, delay=0)
+        await disk.write(0, b"a" * 16)
+        await disk.write(16, b"b" * 16)
+        third = asyncio.create_task(disk.write(32, b"c" * 16))
+        await asyncio.sleep(0.05)
+        assert not third.done() and disk.buffered == 32
+        unblock.set()
+        await asyncio.wait_for(await third, timeout=5)
+        await disk.close()
+
+    asyncio.run(main())
+    assert (tmp_path / "data").read_bytes()[:48] == b"a" * 16 + b"b" * 16 + b"c" * 16
+
+def test_failed_writes_fail_their_futures(tmp_path):
+    storage = make_storage(tmp_path, 32)
+
+    def fail(offset, data):
+        raise OSError("disk full")
+    storage.write = fail
+
+    async def main():
+        disk = DiskIO(storage, delay=0)
+        future = await disk.write(0, b"a" * 16)
+        with pytest.raises(OSError):
+            await future
+        assert disk.buffered == 0
+        await disk.close()
+
+    asyncio.run(main())
+
+def test_write_after_close_is_refused(tmp_path):
+    async def main():
+        disk = DiskIO(make_storage(tmp_path, 16))
+        await disk.close()
+        with pytest.raises(RuntimeError):
+            await disk.write(0, b"a")
+
+    asyncio.run(main())
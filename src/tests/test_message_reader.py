@@ -0,0 +1,105 @@
+import asyncio
+import struct
+import pytest
+from torrent_peer.message_reader import MessageReader, KEEP_ALIVE
+from torrent_peer.peer_message import (BitField, Cancel, Choke, Handshake, Have, Interested, NotInterested,
+                                       Piece, Request, Unchoke, decode_message)
+
+INFO_HASH, PEER_ID = b"i" * 20, b"p" * 20
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+async def read_all(chunks, max_length=2**21, eof=True):
+    """ Every message a MessageReader reads from `chunks`, fed one at a time """
+    reader = asyncio.StreamReader()
+    messages = MessageReader(reader, max_length)
+    received = []
+
+    async def feed():
+        for chunk in chunks:
+            reader.feed_data(chunk)
+            await asyncio.sleep(0)
+        if eof:
+            reader.feed_eof()
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while True:
+            received.append(await messages.next(timeout=1))
+    except asyncio.IncompleteReadError:
+        pass
+    await feeder
+    return received
+
+def test_decode_every_message():
+    for message in (Choke(), Unchoke(), Interested(), NotInterested(), Have(7), Request(1, 16384, 100),
+                    Cancel(2, 0, 16384)):
+        decoded = decode_message(memoryview(message.encode())[4:])
+        assert type(decoded) is type(message)
+        assert decoded.encode() == message.encode()
+    bitfield = decode_message(memoryview(BitField(b"\xa0\x01").encode())[4:])
+    assert bitfield.bitfield.tobytes() == b"\xa0\x01"
+
+def test_decode_piece_without_copying_the_block():
+    body = bytearray(Piece(3, 32, b"block").encode()[4:])
+    piece = decode_message(memoryview(body))
+    assert (piece.index, piece.begin, bytes(piece.block)) == (3, 32, b"block")
+    body[-5:] = b"BLOCK"
+    assert bytes(piece.block) == b"BLOCK"
+
+def test_decode_unsupported_message():
+    assert decode_message(memoryview(b"\x14extended")) is None
+
+def test_decode_malformed_message():
+    with pytest.raises(struct.error):
+        decode_message(memoryview(b"\x04\x00\x01"))   # Have with two bytes
+
+def test_messages_split_and_coalesced():
+    stream = Have(1).encode() + b"\x00\x00\x00\x00" + Piece(0, 0, b"x" * 100).encode() + Unchoke().encode()
+    # One byte at a time, then everything at once
+    for chunks in ([stream[i:i + 1] for i in range(len(stream))], [stream]):
+        messages = run(read_all(chunks))
+        assert [type(message) for message in messages] == [Have, type(KEEP_ALIVE), Piece, Unchoke]
+        assert messages[1] is KEEP_ALIVE
+        assert bytes(messages[2].block) == b"x" * 100
+
+def test_unsupported_message_is_skipped_whole():
+    stream = struct.pack(">IB", 4, 20) + b"ext" + Interested().encode()
+    assert [type(message) for message in run(read_all([stream]))] == [type(None), Interested]
+
+def test_message_over_the_limit():
+    with pytest.raises(ValueError):
+        run(read_all([Piece(0, 0, b"x" * 100).encode()], max_length=64))
+
+def test_malformed_message():
+    with pytest.raises(ValueError):
+        run(read_all([struct.pack(">IBH", 3, 4, 1)]))
+
+def test_connection_closed_mid_message():
+    assert run(read_all([Have(1).encode()[:6]])) == []
+
+def test_timeout_waiting_for_a_message():
+    async def main():
+        messages = MessageReader(asyncio.StreamReader())
+        await messages.next(timeout=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        run(main())
+
+def test_timeout_in_the_middle_of_a_message():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(Have(1).encode()[:6])
+        await MessageReader(reader).next(timeout=1, body_timeout=0.01)
+    with pytest.raises(asyncio.TimeoutError):
+        run(main())
+
+def test_handshake():
+    async def main(data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        return await MessageReader(reader).handshake(timeout=1)
+    handshake = run(main(Handshake(INFO_HASH, PEER_ID).encode()))
+    assert (handshake.info_hash, handshake.peer_id) == (INFO_HASH, PEER_ID)
+    with pytest.raises(ValueError):
+        run(main(b"\x13Not the protocol!!!" + bytes(48)))
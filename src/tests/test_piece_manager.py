@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import threading
+import bencodepy
+from torrent_peer.peer_message import Piece
+from torrent_peer.piece_manager import PieceManager, PieceStatus
+from torrent_peer.torrent_file import TorrentFile
+
+BLOCK = 16
+DATA = bytes(range(64))     # Two pieces of two blocks
+
+def make_manager(tmp_path):
+    pieces = b"".join(hashlib.sha1(DATA[start:start + 2 * BLOCK]).digest() for start in (0, 2 * BLOCK))
+    torrent_filepath = tmp_path / "t.torrent"
+    torrent_filepath.write_bytes(bencodepy.encode({
+        b"announce": b"http://tracker/announce",
+        b"info": {b"name": b"t", b"piece length": 2 * BLOCK, b"pieces": pieces, b"length": len(DATA)},
+    }))
+    return PieceManager(TorrentFile(str(torrent_filepath)), str(tmp_path), block_size=BLOCK)
+
+async def close(manager):
+    await manager.disk.close()
+    manager.storage.close()
+
+def block(index, begin, data=DATA):
+    start = index * 2 * BLOCK + begin
+    return Piece(index, begin, data[start:start + BLOCK])
+
+def test_a_piece_is_hashed_off_the_loop_once(tmp_path):
+    async def main():
+        manager = make_manager(tmp_path)
+        pipeline = set()
+        requests = [manager.get_request_msg(pipeline) for _ in range(2)]
+        index = requests[0].index
+        assert [(request.index, request.begin) for request in requests] == [(index, 0), (index, BLOCK)]
+        hashing, resume = threading.Event(), threading.Event()
+        validate = manager.validate_received_piece
+        calls = []
+        def slow_validate(data, index):
+            calls.append((threading.current_thread() is threading.main_thread(), manager.pieces_status[index]))
+            hashing.set()
+            resume.wait(timeout=5)
+            return validate(data, index)
+        manager.validate_received_piece = slow_validate
+
+        assert await manager.receive_piece(block(index, 0), pipeline) is None
+        completing = asyncio.create_task(manager.receive_piece(block(index, BLOCK), pipeline))
+        await asyncio.to_thread(hashing.wait, 5)
+        # Another copy of the last block arrives while the piece is being hashed
+        assert await manager.receive_piece(block(index, BLOCK)) is None
+        resume.set()
+        assert await completing == index
+        assert calls == [(False, PieceStatus.VERIFYING)]
+        assert index not in manager.partial_pieces and manager.pieces_status[index] == PieceStatus.DOWNLOADED
+        await close(manager)
+        assert manager.have.has(index)
+        return index
+
+    index = asyncio.run(main())
+    start = index * 2 * BLOCK
+    assert (tmp_path / "t").read_bytes()[start:start + 2 * BLOCK] == DATA[start:start + 2 * BLOCK]
+
+def test_a_corrupt_piece_is_downloaded_again(tmp_path):
+    async def main():
+        manager = make_manager(tmp_path)
+        pipeline = set()
+        index = manager.get_request_msg(pipeline).index
+        manager.get_request_msg(pipeline)
+        corrupt = bytes(len(DATA))
+        await manager.receive_piece(block(index, 0, corrupt), pipeline)
+        assert await manager.receive_piece(block(index, BLOCK, corrupt), pipeline) is None
+        assert manager.pieces_status[index] == PieceStatus.PENDING
+        partial = manager.partial_pieces[index]
+        assert (partial.received, partial.missing) == (0, 2)
+        request = manager.get_request_msg(set())
+        assert (request.index, request.begin) == (index, 0)
+        await close(manager)
+
+    asyncio.run(main())
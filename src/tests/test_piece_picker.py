@@ -0,0 +1,85 @@
+import pytest
+from torrent_peer.piece_picker import PeerPieces, PiecePicker
+
+def peer_with(number_of_pieces, indices):
+    pieces = PeerPieces(number_of_pieces)
+    for index in indices:
+        pieces.add(index)
+    return pieces
+
+def check_invariants(picker):
+    """ `order[:size]` is sorted by availability, `pos` is its inverse and `ends` its buckets """
+    wanted = list(picker.order[:picker.size])
+    levels = [picker.availability[index] for index in wanted]
+    assert levels == sorted(levels)
+    for position, index in enumerate(picker.order):
+        assert picker.pos[index] == position
+    for level, end in enumerate(picker.ends):
+        assert end == sum(1 for other in levels if other <= level)
+
+def test_peer_pieces_bitfield_round_trip():
+    pieces = peer_with(10, [0, 7, 9])
+    assert bytes(pieces.bits) == bytes([0b10000001, 0b01000000])
+    assert pieces.count == 3 and not pieces.add(7)
+    assert list(pieces.indices()) == [0, 7, 9]
+
+    copy = PeerPieces(10)
+    copy.set_bitfield(bytes(pieces.bits))
+    assert copy.count == 3 and copy.has(9) and not copy.has(8)
+
+def test_peer_pieces_rejects_malformed_bitfields():
+    pieces = PeerPieces(10)
+    with pytest.raises(ValueError):
+        pieces.set_bitfield(b"\xff")                    # Too short
+    with pytest.raises(ValueError):
+        pieces.set_bitfield(bytes([0xff, 0b11100000]))  # Spare bits set
+
+def test_full_is_a_seed():
+    pieces = PeerPieces.full(10)
+    assert pieces.is_seed and pieces.count == 10
+    assert bytes(pieces.bits) == bytes([0xff, 0b11000000])
+
+def test_picks_the_rarest_piece_the_peer_has():
+    picker = PiecePicker(6)
+    for index in (0, 1, 1, 2, 2, 2, 3, 3, 3, 3):
+        picker.increment(index)
+    check_invariants(picker)
+
+    assert picker.pick(peer_with(6, [0, 1, 2, 3])) == 0
+    assert picker.pick(peer_with(6, [2, 3])) == 2
+    assert picker.pick(peer_with(6, [4])) is None   # Nobody announced it, not even this peer
+    assert picker.pick() in (4, 5)                  # Any wanted piece
+
+def test_removed_pieces_are_not_picked_until_added_again():
+    picker = PiecePicker(4)
+    for index in (0, 1, 1):
+        picker.increment(index)
+    picker.remove(0)
+    check_invariants(picker)
+    assert picker.size == 3 and not picker.is_wanted(0)
+    assert picker.pick(peer_with(4, [0, 1])) == 1
+
+    picker.increment(0)     # Availability is still counted while it is not wanted
+    picker.add(0)
+    check_invariants(picker)
+    assert picker.pick(peer_with(4, [0, 1])) in (0, 1)
+    picker.decrement(0)
+    assert picker.pick(peer_with(4, [0, 1])) == 0
+
+def test_availability_updates_keep_the_order():
+    picker = PiecePicker(50)
+    for step in range(500):
+        index = (step * 7) % 50
+        if step % 3 == 2:
+            picker.decrement(index)
+        else:
+            picker.increment(index)
+        if step % 11 == 0:
+            picker.remove((step * 3) % 50)
+        if step % 13 == 0:
+            picker.add((step * 5) % 50)
+    check_invariants(picker)
+    seed = PeerPieces.full(50)
+    rarest = picker.pick(seed)
+    assert picker.availability[rarest] == min(picker.availability[index]
+                                              for index in picker.order[:picker.size])
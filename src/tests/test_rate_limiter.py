@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from torrent_peer import rate_limiter
+from torrent_peer.rate_limiter import TokenBucket, BandwidthLimits, MIN_BURST
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", clock)
+    return clock
+
+def test_no_limit():
+    bucket = TokenBucket()
+    assert bucket.reserve(10**9) == 0
+    assert bucket.reserve(10**9) == 0
+
+def test_a_new_bucket_holds_one_block(clock):
+    bucket = TokenBucket(rate=100_000, burst=50_000)
+    assert bucket.reserve(MIN_BURST) == 0
+    assert bucket.reserve(10_000) == pytest.approx(0.1)
+
+def test_reservations_queue_up_as_debt(clock):
+    bucket = TokenBucket(rate=100_000, burst=50_000)
+    clock.now += 1
+    assert bucket.reserve(50_000) == 0       # The burst
+    assert bucket.reserve(20_000) == pytest.approx(0.2)
+    assert bucket.reserve(20_000) == pytest.approx(0.4)
+    clock.now += 0.4
+    assert bucket.reserve(10_000) == pytest.approx(0.1)
+
+def test_idle_time_saves_up_to_the_burst(clock):
+    bucket = TokenBucket(rate=100_000, burst=50_000)
+    bucket.reserve(50_000)
+    clock.now += 60
+    assert bucket.reserve(50_000) == 0
+    assert bucket.reserve(10_000) == pytest.approx(0.1)
+
+def test_default_burst():
+    assert TokenBucket(rate=4 * 2**20).burst == 2**20
+    assert TokenBucket(rate=1000).burst == MIN_BURST
+
+def test_set_rate_keeps_the_debt(clock):
+    bucket = TokenBucket(rate=100_000, burst=50_000)
+    clock.now += 1
+    bucket.reserve(70_000)
+    bucket.set_rate(10_000, burst=50_000)
+    assert bucket.reserve(0) == pytest.approx(2.0)
+    bucket.set_rate(0)
+    assert bucket.reserve(10**6) == 0
+    with pytest.raises(ValueError):
+        bucket.set_rate(-1)
+
+def test_limits_of_a_torrent():
+    limits = BandwidthLimits(upload_rate=0, download_rate=0)
+    info_hash = b"\x01" * 20
+    limits.set(upload=1000, info_hash=info_hash)
+    limits.set(download=2000)
+    assert limits.to_dict() == {"upload": 0, "download": 2000,
+                                "torrents": {info_hash.hex(): {"upload": 1000, "download": 0}}}
+    limits.set(upload=0, info_hash=info_hash)
+    assert limits.torrents == {}
+    with pytest.raises(ValueError):
+        limits.set(download=-5, info_hash=info_hash)
+    assert limits.torrents == {}
+
+def test_throttle_waits_for_the_slowest_bucket(clock, monkeypatch):
+    delays = []
+    async def sleep(delay):
+        delays.append(delay)
+    monkeypatch.setattr(rate_limiter.asyncio, "sleep", sleep)
+    limits = BandwidthLimits(upload_rate=100_000, download_rate=0)
+    info_hash = b"\x01" * 20
+    limits.set(upload=MIN_BURST, info_hash=info_hash)
+
+    async def main():
+        await limits.throttle_upload(info_hash, MIN_BURST)
+        await limits.throttle_upload(info_hash, MIN_BURST)
+        await limits.throttle_upload(b"\x02" * 20, 10_000)
+        await limits.throttle_download(info_hash, 10**9)
+
+    asyncio.run(main())
+    # The torrent's bucket is the slower one, then the other torrent waits for the daemon's
+    assert delays == [pytest.approx(1.0), pytest.approx((MIN_BURST + 10_000) / 100_000)]
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import bencodepy
+import pytest
+from torrent_peer import recheck as recheck_module
+from torrent_peer.recheck import recheck, torrents_in_directory
+from torrent_peer.torrent_file import Metainfo
+
+PIECE_LENGTH = 16
+FILES = [("a", 40), ("b", 24)]   # Piece 2 lies in both files
+DATA = bytes(range(64))
+
+@pytest.fixture(autouse=True)
+def small_reads(monkeypatch):
+    # Several reads per file, and reads spanning more than one piece
+    monkeypatch.setattr(recheck_module, "READ_SIZE", 2 * PIECE_LENGTH)
+
+def piece_hashes(data):
+    return b"".join(hashlib.sha1(data[start:start + PIECE_LENGTH]).digest()
+                    for start in range(0, len(data), PIECE_LENGTH))
+
+def make_metainfo(tmp_path, files=FILES, data=DATA):
+    info = {b"name": b"t", b"piece length": PIECE_LENGTH, b"pieces": piece_hashes(data)}
+    if files:
+        info[b"files"] = [{b"path": [path.encode()], b"length": length} for path, length in files]
+    else:
+        info[b"length"] = len(data)
+    torrent_filepath = str(tmp_path / "t.torrent")
+    encoded = bencodepy.encode({b"announce": b"http://tracker/announce", b"info": info})
+    with open(torrent_filepath, "wb") as file:
+        file.write(encoded)
+    return Metainfo(torrent_filepath, encoded)
+
+def write_files(path, data=DATA, files=FILES):
+    path.mkdir()
+    offset = 0
+    for name, length in files:
+        (path / name).write_bytes(data[offset:offset + length])
+        offset += length
+
+def valid_pieces(result):
+    return list(result.have.indices())
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_complete_data(tmp_path, workers):
+    metainfo = make_metainfo(tmp_path)
+    write_files(tmp_path / "t")
+    result = recheck(metainfo, str(tmp_path / "t"), workers=workers)
+    assert valid_pieces(result) == [0, 1, 2, 3]
+    assert result.complete
+    assert result.bytes_checked == len(DATA)
+
+def test_single_file(tmp_path):
+    metainfo = make_metainfo(tmp_path, files=None, data=DATA[:56])
+    (tmp_path / "t").write_bytes(DATA[:56])
+    result = recheck(metainfo, str(tmp_path / "t"))
+    assert valid_pieces(result) == [0, 1, 2, 3]     # The last piece is short
+
+def test_corrupted_bytes_invalidate_their_pieces_only(tmp_path):
+    metainfo = make_metainfo(tmp_path)
+    data = bytearray(DATA)
+    data[20] ^= 0xff    # Piece 1
+    data[45] ^= 0xff    # Piece 2, in the second file
+    write_files(tmp_path / "t", bytes(data))
+    result = recheck(metainfo, str(tmp_path / "t"), workers=2)
+    assert valid_pieces(result) == [0, 3]
+    assert not result.complete
+
+def test_truncated_file(tmp_path):
+    metainfo = make_metainfo(tmp_path)
+    write_files(tmp_path / "t")
+    with open(tmp_path / "t" / "a", "r+b") as file:
+        file.truncate(20)
+    result = recheck(metainfo, str(tmp_path / "t"))
+    # Piece 1 is cut short, and piece 2 starts in the missing end of "a"
+    assert valid_pieces(result) == [0, 3]
+    assert result.bytes_checked == 20 + 24
+
+def test_missing_file(tmp_path):
+    metainfo = make_metainfo(tmp_path)
+    write_files(tmp_path / "t")
+    os.remove(tmp_path / "t" / "b")
+    result = recheck(metainfo, str(tmp_path / "t"))
+    assert valid_pieces(result) == [0, 1]
+    assert result.bytes_checked == 40
+
+def test_missing_data_is_not_hashed(tmp_path):
+    # The expected data of "b" is zeros, as the unfilled buffer is: it must still not pass
+    data = DATA[:40] + bytes(24)
+    metainfo = make_metainfo(tmp_path, data=data)
+    write_files(tmp_path / "t", data)
+    os.remove(tmp_path / "t" / "b")
+    result = recheck(metainfo, str(tmp_path / "t"), workers=1)
+    assert valid_pieces(result) == [0, 1]
+
+def test_progress(tmp_path):
+    metainfo = make_metainfo(tmp_path)
+    write_files(tmp_path / "t")
+    calls = []
+    recheck(metainfo, str(tmp_path / "t"), progress=lambda done, total: calls.append((done, total)))
+    assert calls[-1] == (len(DATA), len(DATA))
+    assert [done for done, _ in calls] == sorted(done for done, _ in calls)
+
+def test_resume_data(tmp_path):
+    metainfo = make_metainfo(tmp_path)
+    write_files(tmp_path / "t")
+    os.remove(tmp_path / "t" / "b")
+    resume = recheck(metainfo, str(tmp_path / "t")).resume_data()
+    assert (resume.info_hash, resume.output_name) == (metainfo.info_hash, str(tmp_path / "t"))
+    assert (resume.have, resume.in_flight) == (b"\xc0", [])
+    assert resume.file_stats[0][0] == 40 and resume.file_stats[1] == (-1, 0)
+
+def test_torrents_in_directory(tmp_path):
+    make_metainfo(tmp_path)
+    (tmp_path / "broken.torrent").write_bytes(b"not bencoded")
+    (tmp_path / "notes.txt").write_bytes(b"")
+    assert torrents_in_directory(str(tmp_path), "/data") == \
+        [(str(tmp_path / "t.torrent"), os.path.join("/data", "t"))]
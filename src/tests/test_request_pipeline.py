@@ -0,0 +1,85 @@
+from torrent_peer import request_pipeline
+from torrent_peer.peer_message import Cancel, Request
+from torrent_peer.request_pipeline import RequestPipeline
+
+BLOCK = 2**14
+
+class FakeWriter:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def is_closing(self):
+        return False
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def make_pipeline(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(request_pipeline.time, "monotonic", clock)
+    return RequestPipeline(FakeWriter(), block_size=BLOCK, **kwargs), clock
+
+def test_replies_match_requests_in_any_order(monkeypatch):
+    pipeline, _ = make_pipeline(monkeypatch)
+    first, second = Request(0, 0, BLOCK), Request(0, BLOCK, BLOCK)
+    pipeline.add(first)
+    pipeline.add(second)
+    assert len(pipeline) == 2 and (0, BLOCK) in pipeline
+
+    assert pipeline.complete(0, BLOCK, BLOCK) is second
+    assert pipeline.complete(0, 0, BLOCK) is first
+    assert pipeline.complete(0, 0, BLOCK) is None     # Answered already
+    assert pipeline.complete(5, 0, BLOCK) is None     # Never requested
+    assert len(pipeline) == 0
+
+def test_cancel_sends_cancel_and_ignores_late_reply(monkeypatch):
+    pipeline, _ = make_pipeline(monkeypatch)
+    pipeline.add(Request(3, BLOCK, BLOCK))
+    pipeline.cancel(3, BLOCK)
+    pipeline.cancel(3, BLOCK)   # Not outstanding any more: nothing sent
+
+    assert pipeline.writer.written == [Cancel(3, BLOCK, BLOCK).encode()]
+    assert pipeline.complete(3, BLOCK, BLOCK) is None
+
+def test_drain_returns_every_outstanding_request(monkeypatch):
+    pipeline, _ = make_pipeline(monkeypatch)
+    requests = [Request(1, begin, BLOCK) for begin in range(0, 4 * BLOCK, BLOCK)]
+    for request in requests:
+        pipeline.add(request)
+
+    assert pipeline.drain() == requests
+    assert len(pipeline) == 0 and pipeline.can_request()
+
+def receive(pipeline, clock, blocks, rtt, interval):
+    """ Receive `blocks` blocks `interval` seconds apart, each requested `rtt` seconds before """
+    for block in range(blocks):
+        clock.now += interval
+        clock.now -= rtt
+        pipeline.add(Request(0, block * BLOCK, BLOCK))
+        clock.now += rtt
+        pipeline.complete(0, block * BLOCK, BLOCK)
+
+def test_depth_follows_bandwidth_delay_product(monkeypatch):
+    pipeline, clock = make_pipeline(monkeypatch, max_depth=256)
+    assert pipeline.depth == RequestPipeline.INITIAL_DEPTH
+
+    # 100 blocks per second with a 100 ms round trip: 10 blocks in flight fill the link
+    receive(pipeline, clock, 100, rtt=0.1, interval=0.01)
+    assert abs(pipeline.min_rtt - 0.1) < 1e-9
+    assert 18 <= pipeline.depth <= 24
+
+def test_depth_stays_within_bounds(monkeypatch):
+    pipeline, clock = make_pipeline(monkeypatch, max_depth=16)
+    receive(pipeline, clock, 100, rtt=1.0, interval=0.01)
+    assert pipeline.depth == 16
+
+    pipeline, clock = make_pipeline(monkeypatch, max_depth=256)
+    receive(pipeline, clock, 20, rtt=0.001, interval=0.5)
+    assert pipeline.depth == RequestPipeline.MIN_DEPTH
@@ -0,0 +1,128 @@
+import asyncio
+import hashlib
+import os
+import bencodepy
+from torrent_peer.resume import ResumeData
+from torrent_peer.piece_manager import PieceManager
+from torrent_peer.torrent_file import TorrentFile
+
+PIECE_LENGTH = 16
+FILES = [("a", 40), ("b", 24)]   # Piece 2 lies in both files
+DATA = bytes(range(64))
+MTIME = 1_700_000_000 * 10**9
+
+def make_resume(info_hash=b"\x01" * 20, **kwargs):
+    values = dict(info_hash=info_hash, torrent_filepath="/torrents/t.torrent", output_name="/downloads/t",
+                  have=b"\xa0", in_flight=[1], file_stats=[(40, 123), (-1, 0)])
+    values.update(kwargs)
+    return ResumeData(**values)
+
+def test_save_and_load(tmp_path):
+    make_resume().save(str(tmp_path))
+    resume = ResumeData.load(b"\x01" * 20, str(tmp_path))
+    assert (resume.info_hash, resume.torrent_filepath, resume.output_name) == \
+        (b"\x01" * 20, "/torrents/t.torrent", "/downloads/t")
+    assert (resume.have, resume.in_flight, resume.file_stats) == (b"\xa0", [1], [(40, 123), (-1, 0)])
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+def test_load_all_skips_unreadable_files(tmp_path):
+    make_resume(b"\x01" * 20).save(str(tmp_path))
+    make_resume(b"\x02" * 20).save(str(tmp_path))
+    (tmp_path / ("03" * 20 + ".resume")).write_bytes(b"not bencoded")
+    (tmp_path / "notes.txt").write_bytes(b"")
+    assert [resume.info_hash for resume in ResumeData.load_all(str(tmp_path))] == [b"\x01" * 20, b"\x02" * 20]
+    assert ResumeData.load_all(str(tmp_path / "missing")) == []
+
+def test_discard(tmp_path):
+    make_resume().save(str(tmp_path))
+    ResumeData.discard(b"\x01" * 20, str(tmp_path))
+    ResumeData.discard(b"\x01" * 20, str(tmp_path))
+    assert ResumeData.load(b"\x01" * 20, str(tmp_path)) is None
+
+def test_stat_files(tmp_path):
+    path = tmp_path / "a"
+    path.write_bytes(b"abc")
+    os.utime(path, ns=(MTIME, MTIME))
+    assert ResumeData.stat_files([str(path), str(tmp_path / "missing")]) == [(3, MTIME), (-1, 0)]
+
+def make_download(tmp_path, have, in_flight=()):
+    """ A complete download of FILES and its resume data, saved with the pieces of `have` """
+    pieces = b"".join(hashlib.sha1(DATA[start:start + PIECE_LENGTH]).digest()
+                      for start in range(0, len(DATA), PIECE_LENGTH))
+    torrent_filepath = str(tmp_path / "t.torrent")
+    with open(torrent_filepath, "wb") as file:
+        file.write(bencodepy.encode({
+            b"announce": b"http://tracker/announce",
+            b"info": {b"name": b"t", b"piece length": PIECE_LENGTH, b"pieces": pieces,
+                      b"files": [{b"path": [path.encode()], b"length": length} for path, length in FILES]},
+        }))
+    output_name = tmp_path / "t"
+    output_name.mkdir()
+    start = 0
+    for path, length in FILES:
+        (output_name / path).write_bytes(DATA[start:start + length])
+        os.utime(output_name / path, ns=(MTIME, MTIME))
+        start += length
+    bitfield = bytearray(1)
+    for index in have:
+        bitfield[0] |= 0x80 >> index
+    torrent = TorrentFile(torrent_filepath)
+    file_stats = ResumeData.stat_files([str(output_name / path) for path, _ in FILES])
+    return torrent, ResumeData(torrent.info_hash, torrent_filepath, str(output_name),
+                               bytes(bitfield), list(in_flight), file_stats)
+
+def restore(tmp_path, torrent, resume):
+    """ Restore the download, returning the pieces it hashed and the pieces it has """
+    async def main():
+        manager = PieceManager(torrent, str(tmp_path), resume=resume)
+        hashed = []
+        verify_pieces = manager.verify_pieces
+        def record(indices):
+            hashed.extend(indices)
+            return verify_pieces(indices)
+        manager.verify_pieces = record
+        try:
+            await manager.restore()
+        finally:
+            await manager.disk.close()
+            manager.storage.close()
+        return hashed, list(manager.have.indices())
+    return asyncio.run(main())
+
+def test_restore_trusts_unchanged_files(tmp_path):
+    torrent, resume = make_download(tmp_path, have=[0, 1], in_flight=[3])
+    assert restore(tmp_path, torrent, resume) == ([3], [0, 1, 3])
+
+def test_restore_only_checks_the_pieces_in_flight_after_a_crash(tmp_path):
+    torrent, resume = make_download(tmp_path, have=[0], in_flight=[2])
+    # Pieces 2 and 3 reached b before a crash; 3 was started after the save
+    os.utime(tmp_path / "t" / "b", ns=(MTIME + 10**9, MTIME + 10**9))
+    assert restore(tmp_path, torrent, resume) == ([2], [0, 2])
+
+def test_restore_checks_everything_if_a_file_is_older(tmp_path):
+    torrent, resume = make_download(tmp_path, have=[0, 1, 2, 3])
+    with open(tmp_path / "t" / "a", "r+b") as file:
+        file.write(b"x")
+    os.utime(tmp_path / "t" / "a", ns=(MTIME - 10**9, MTIME - 10**9))
+    assert restore(tmp_path, torrent, resume) == ([0, 1, 2, 3], [1, 2, 3])
+
+def test_restore_checks_everything_if_a_size_changed(tmp_path):
+    torrent, resume = make_download(tmp_path, have=[0])
+    resume.file_stats[1] = (25, MTIME)
+    assert restore(tmp_path, torrent, resume) == ([0, 1, 2, 3], [0, 1, 2, 3])
+
+def test_pieces_being_downloaded_are_in_flight(tmp_path):
+    torrent, _ = make_download(tmp_path, have=[])
+
+    async def main():
+        manager = PieceManager(torrent, str(tmp_path / "downloads"))
+        started = manager.get_request_msg(set()).index
+        manager._mark_downloaded(3 if started != 3 else 2)
+        try:
+            return started, manager.resume_data([]).in_flight
+        finally:
+            await manager.disk.close()
+            manager.storage.close()
+
+    started, in_flight = asyncio.run(main())
+    assert in_flight == [started]
@@ -0,0 +1,69 @@
+import pytest
+from torrent_peer.storage import FileStorage, MmapStorage, open_storage
+
+FILES = [("a", 10), ("empty", 0), ("b", 6)]
+DATA = bytes(range(16))
+
+def make_files(tmp_path, data=bytes(16)):
+    root = tmp_path / "t"
+    root.mkdir()
+    offset = 0
+    for name, length in FILES:
+        (root / name).write_bytes(data[offset:offset + length])
+        offset += length
+    return str(root)
+
+@pytest.fixture(params=["file", "mmap"])
+def backend(request):
+    return request.param
+
+def test_write_across_files(tmp_path, backend):
+    root = make_files(tmp_path)
+    storage = open_storage(root, FILES, 16, writable=True, backend=backend)
+    storage.write(4, DATA[4:14])
+    storage.write(0, memoryview(DATA)[:4])
+    storage.flush()
+    assert storage.read(0, 16) == DATA[:14] + bytes(2)
+    storage.close()
+    assert (tmp_path / "t" / "a").read_bytes() == DATA[:10]
+    assert (tmp_path / "t" / "b").read_bytes() == DATA[10:14] + bytes(2)
+
+def test_readinto(tmp_path, backend):
+    root = make_files(tmp_path, DATA)
+    storage = open_storage(root, FILES, 16, backend=backend)
+    buffer = bytearray(8)
+    assert storage.readinto(6, memoryview(buffer)) == 8
+    assert buffer == DATA[6:14]
+    storage.close()
+
+def test_single_file(tmp_path, backend):
+    path = tmp_path / "t"
+    path.write_bytes(bytes(16))
+    storage = open_storage(str(path), None, 16, writable=True, backend=backend)
+    storage.write(3, b"abc")
+    storage.flush(3, 3)
+    storage.close()
+    assert path.read_bytes() == bytes(3) + b"abc" + bytes(10)
+
+def test_mmap_writes_are_visible_to_file_reads(tmp_path):
+    root = make_files(tmp_path)
+    storage = MmapStorage(root, FILES, 16, writable=True)
+    reader = FileStorage(root, FILES, 16)
+    storage.write(8, b"wxyz")
+    assert reader.read(8, 4) == b"wxyz"
+    with storage.file_range(11, 2) as (file, file_offset):
+        assert (file.name, file_offset) == (str(tmp_path / "t" / "b"), 1)
+    storage.close()
+    reader.close()
+
+def test_mmap_read_only(tmp_path):
+    root = make_files(tmp_path, DATA)
+    storage = MmapStorage(root, FILES, 16)
+    assert storage.read(0, 16) == DATA
+    with pytest.raises(TypeError):
+        storage.write(0, b"x")
+    storage.close()
+
+def test_unknown_backend(tmp_path):
+    with pytest.raises(ValueError):
+        open_storage(make_files(tmp_path), FILES, 16, backend="tape")
@@ -0,0 +1,79 @@
+import json
+import time
+from torrent_tracker.swarm import SwarmRegistry, compact_peers
+
+A, B, C = ("10.0.0.1", 6881), ("10.0.0.2", 6882), ("10.0.0.3", 6883)
+
+def test_seeds_and_leechers_are_counted():
+    registry = SwarmRegistry(peer_ttl=60)
+    registry.announce("t", A, "started", now=0, left=100)
+    registry.announce("t", B, "started", now=0, left=0)
+    registry.announce("t", C, now=0)
+    assert registry.stats("t", now=1) == {"complete": 1, "incomplete": 2, "downloaded": 0}
+    registry.announce("t", A, "completed", now=1, left=0)
+    registry.announce("t", C, now=1)   # Not saying what is left keeps it a leecher
+    assert registry.stats("t", now=2) == {"complete": 2, "incomplete": 1, "downloaded": 1}
+    registry.announce("t", B, "stopped", now=2)
+    registry.announce("t", B, "stopped", now=2)
+    assert registry.stats("t", now=3) == {"complete": 1, "incomplete": 1, "downloaded": 1}
+
+def test_completed_count_outlives_the_swarm():
+    registry = SwarmRegistry(peer_ttl=60)
+    registry.announce("t", A, "completed", now=0, left=0)
+    registry.announce("t", A, "stopped", now=1)
+    assert "t" not in registry.swarms and "t" not in registry.seeders
+    assert registry.stats("t") == {"complete": 0, "incomplete": 0, "downloaded": 1}
+
+def test_stale_peers_expire():
+    registry = SwarmRegistry(peer_ttl=10)
+    registry.announce("t", A, now=0, left=0)
+    registry.announce("t", B, now=5)
+    registry.announce("t", A, now=8, left=0)  # Moves A behind B
+    assert registry.peers("t", now=16) == [A]
+    assert registry.stats("t", now=16) == {"complete": 1, "incomplete": 0, "downloaded": 0}
+    registry.announce("u", C, now=0)
+    assert registry.expire(now=20) == 2
+    assert registry.swarms == {} and registry.seeders == {}
+
+def test_peers_exclude_and_numwant():
+    registry = SwarmRegistry(peer_ttl=60)
+    for address in (A, B, C):
+        registry.announce("t", address, now=0)
+    assert registry.peers("t", now=1, exclude={B}) == [A, C]
+    sample = registry.peers("t", now=1, numwant=2)
+    assert len(sample) == 2 and set(sample) <= {A, B, C}
+    assert registry.peers("t", now=1, numwant=5) == [A, B, C]
+    assert registry.peers("missing", now=1) == []
+
+def test_snapshot_round_trip(tmp_path):
+    now = time.time()
+    registry = SwarmRegistry(peer_ttl=60)
+    registry.announce("t", A, "completed", now=now - 2, left=0)
+    registry.announce("t", B, now=now - 1, left=10)
+    registry.announce("u", C, now=now - 120)   # Stale by the time it is restored
+    path = str(tmp_path / "peers.json")
+    SwarmRegistry.write_snapshot(registry.snapshot(), path)
+
+    restored = SwarmRegistry(peer_ttl=60)
+    restored.restore(path)
+    assert list(restored.swarms) == ["t"]
+    assert list(restored.swarms["t"].items()) == [(A, (now - 2, True)), (B, (now - 1, False))]
+    assert restored.stats("t") == {"complete": 1, "incomplete": 1, "downloaded": 1}
+
+def test_restore_reads_old_snapshots_and_ignores_bad_ones(tmp_path):
+    now = time.time()
+    path = tmp_path / "peers.json"
+    path.write_text(json.dumps({"t": [["10.0.0.1", 6881, now], ["bad"]]}))
+    registry = SwarmRegistry(peer_ttl=60)
+    registry.restore(str(path))
+    assert registry.peers("t") == [A]
+    assert registry.stats("t")["complete"] == 0
+    for content in ("not json", "[]"):
+        path.write_text(content)
+        SwarmRegistry(peer_ttl=60).restore(str(path))
+    SwarmRegistry(peer_ttl=60).restore(str(tmp_path / "missing.json"))
+
+def test_compact_peers():
+    ipv4, ipv6 = compact_peers([A, ("::1", 6881), ("tracker.example", 80), ("10.0.0.2", 256)])
+    assert ipv4 == bytes([10, 0, 0, 1, 0x1a, 0xe1, 10, 0, 0, 2, 1, 0])
+    assert ipv6 == bytes(15) + b"\x01" + b"\x1a\xe1"
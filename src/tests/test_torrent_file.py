@@ -0,0 +1,66 @@
+import hashlib
+import os
+import bencodepy
+import pytest
+from torrent_peer import torrent_file
+from torrent_peer.torrent_file import TorrentFile
+
+PIECE_LENGTH = 16
+
+def reference_pieces(data, piece_length=PIECE_LENGTH):
+    return b"".join(hashlib.sha1(data[start:start + piece_length]).digest()
+                    for start in range(0, len(data), piece_length))
+
+def write_files(tmp_path, lengths):
+    """ Files of the given lengths holding consecutive slices of one stream. Returns paths and stream. """
+    data = os.urandom(sum(lengths))
+    paths, offset = [], 0
+    for i, length in enumerate(lengths):
+        path = tmp_path / f"{i}"
+        path.write_bytes(data[offset:offset + length])
+        paths.append(str(path))
+        offset += length
+    return paths, data
+
+@pytest.mark.parametrize("lengths", [
+    [64],           # Whole pieces
+    [70],           # Short last piece
+    [5],            # Less than a piece
+    [40, 24],       # Piece across two files
+    [3, 0, 7, 30],  # Empty file, and several files in one piece
+])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_hash_pieces_matches_hashlib(tmp_path, lengths, workers):
+    paths, data = write_files(tmp_path, lengths)
+    assert TorrentFile._hash_pieces(paths, PIECE_LENGTH, workers) == reference_pieces(data)
+
+def test_hash_pieces_reuses_a_small_ring(tmp_path, monkeypatch):
+    # Room for two buffers only: every piece waits for an older one to be hashed
+    monkeypatch.setattr(torrent_file, "MAX_HASH_BUFFER", PIECE_LENGTH)
+    paths, data = write_files(tmp_path, [100, 37, 200])
+    assert TorrentFile._hash_pieces(paths, PIECE_LENGTH, workers=8) == reference_pieces(data)
+
+def test_hash_pieces_progress(tmp_path):
+    paths, data = write_files(tmp_path, [40, 24, 10])
+    calls = []
+    TorrentFile._hash_pieces(paths, PIECE_LENGTH, progress=lambda done, total: calls.append((done, total)))
+    assert calls == [(done, 74) for done in (16, 32, 48, 64, 74)]
+
+def test_hash_pieces_of_no_data(tmp_path):
+    paths, _ = write_files(tmp_path, [0])
+    assert TorrentFile._hash_pieces(paths, PIECE_LENGTH) == b""
+
+def test_create_torrent_file_for_directory(tmp_path):
+    directory = tmp_path / "d"
+    (directory / "sub").mkdir(parents=True)
+    (directory / "sub" / "x").write_bytes(b"x" * 30)
+    (directory / "y").write_bytes(b"y" * 20)
+    output_path = TorrentFile.create_torrent_file(str(directory), [["http://tracker/announce"]],
+                                                  piece_length=PIECE_LENGTH,
+                                                  output_path=str(tmp_path / "d.torrent"))
+    with open(output_path, "rb") as file:
+        info = bencodepy.decode(file.read())[b"info"]
+    files = [(b"/".join(entry[b"path"]), entry[b"length"]) for entry in info[b"files"]]
+    data = b"".join((directory / path.decode()).read_bytes() for path, _ in files)
+    assert sorted(files) == [(b"sub/x", 30), (b"y", 20)]
+    assert info[b"pieces"] == reference_pieces(data)
@@ -0,0 +1,35 @@
+import base64
+import socket
+import struct
+from torrent_peer.tracker_client import _decode_peers, decode_compact_peers
+
+def compact(family, *peers):
+    return b"".join(socket.inet_pton(family, ip) + struct.pack(">H", port) for ip, port in peers)
+
+def test_decode_ipv4_peers():
+    data = compact(socket.AF_INET, ("10.0.0.1", 6881), ("192.168.1.20", 65535))
+    assert decode_compact_peers(data) == [{"ip": "10.0.0.1", "port": 6881},
+                                          {"ip": "192.168.1.20", "port": 65535}]
+
+def test_decode_ipv6_peers():
+    data = compact(socket.AF_INET6, ("::1", 1), ("2001:db8::42", 51413))
+    assert decode_compact_peers(data, socket.AF_INET6) == [{"ip": "::1", "port": 1},
+                                                           {"ip": "2001:db8::42", "port": 51413}]
+
+def test_decode_ignores_a_truncated_peer():
+    data = compact(socket.AF_INET, ("10.0.0.1", 6881), ("10.0.0.2", 6882))
+    assert decode_compact_peers(data[:-1]) == [{"ip": "10.0.0.1", "port": 6881}]
+    assert decode_compact_peers(b"") == []
+
+def test_decode_response_peers():
+    response = {
+        "interval": 1800,
+        "peers": base64.b64encode(compact(socket.AF_INET, ("10.0.0.1", 6881))).decode(),
+        "peers6": base64.b64encode(compact(socket.AF_INET6, ("::1", 6882))).decode(),
+    }
+    assert _decode_peers(response) == {"interval": 1800, "peers": [{"ip": "10.0.0.1", "port": 6881},
+                                                                   {"ip": "::1", "port": 6882}]}
+
+def test_dict_peers_are_kept():
+    peers = [{"ip": "10.0.0.1", "port": 6881}]
+    assert _decode_peers({"peers": peers}) == {"peers": peers}
@@ -0,0 +1,166 @@
+import asyncio
+import pytest
+from torrent_peer import wire_protocol
+from torrent_peer.wire_protocol import PeerWireProtocol
+from torrent_peer.message_reader import KEEP_ALIVE
+from torrent_peer.peer_message import Handshake, Have, Interested, Piece, Request
+
+INFO_HASH, PEER_ID = b"i" * 20, b"p" * 20
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.paused = False
+        self.closing = False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def writelines(self, buffers):
+        self.written.append(b"".join(bytes(buffer) for buffer in buffers))
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+def connect(**kwargs):
+    protocol = PeerWireProtocol(**kwargs)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    return protocol, transport
+
+def feed(protocol, data, chunk=None):
+    """ Hand `data` to the protocol like the event loop does, at most `chunk` bytes per read """
+    data = memoryview(data)
+    while data:
+        buffer = protocol.get_buffer(-1)
+        size = min(len(buffer), len(data), chunk or len(data))
+        buffer[:size] = data[:size]
+        protocol.buffer_updated(size)
+        data = data[size:]
+
+async def read_all(protocol, count):
+    return [await protocol.next(timeout=1) for _ in range(count)]
+
+def test_messages_are_parsed_whatever_the_reads():
+    stream = Handshake(INFO_HASH, PEER_ID).encode() + Interested().encode() + b"\x00" * 4 \
+        + Have(7).encode() + Request(1, 2**14, 2**14).encode() + Piece(3, 0, b"x" * 1000).encode()
+    for chunk in (None, 1, 5, 70):
+        async def main():
+            protocol, _ = connect()
+            feed(protocol, stream, chunk)
+            protocol.eof_received()
+            handshake = await protocol.handshake(timeout=1)
+            assert (handshake.info_hash, handshake.peer_id) == (INFO_HASH, PEER_ID)
+            interested, keep_alive, have, request, piece = await read_all(protocol, 5)
+            assert isinstance(interested, Interested) and keep_alive is KEEP_ALIVE
+            assert have.index == 7
+            assert (request.index, request.begin, request.length) == (1, 2**14, 2**14)
+            assert (piece.index, piece.begin, bytes(piece.block)) == (3, 0, b"x" * 1000)
+            with pytest.raises(asyncio.IncompleteReadError):
+                await protocol.next(timeout=1)
+        asyncio.run(main())
+
+def test_a_message_longer_than_the_buffer():
+    async def main():
+        protocol, _ = connect(max_length=2**20)
+        block = bytes(range(256)) * 1024    # Four times RECEIVE_BUFFER
+        feed(protocol, Handshake(INFO_HASH).encode() + Piece(0, 0, block).encode(), 4096)
+        await protocol.handshake(timeout=1)
+        [piece] = await read_all(protocol, 1)
+        assert bytes(piece.block) == block
+    asyncio.run(main())
+
+def test_an_oversized_message_fails_the_connection():
+    async def main():
+        protocol, transport = connect(max_length=100)
+        feed(protocol, Handshake(INFO_HASH).encode() + Have(1).encode() + (101).to_bytes(4, "big") + b"\x07")
+        await protocol.handshake(timeout=1)
+        assert (await protocol.next(timeout=1)).index == 1
+        assert transport.paused
+        with pytest.raises(ValueError):
+            await protocol.next(timeout=1)
+    asyncio.run(main())
+
+def test_an_invalid_handshake_is_refused():
+    async def main():
+        protocol, _ = connect()
+        feed(protocol, b"\x13" + b"x" * 67)
+        with pytest.raises(ValueError):
+            await protocol.handshake(timeout=1)
+    asyncio.run(main())
+
+def test_blocks_are_received_in_place():
+    async def main():
+        protocol, _ = connect()
+        piece = bytearray(64)
+        asked = []
+        def block_buffer(index, begin, length):
+            asked.append((index, begin, length))
+            return memoryview(piece)[begin:begin + length] if index == 5 else None
+        protocol.block_buffer = block_buffer
+        stream = Handshake(INFO_HASH).encode() + Piece(5, 16, b"a" * 32).encode() \
+            + Piece(6, 0, b"b" * 8).encode() + Have(2).encode()
+        feed(protocol, stream, 7)
+        await protocol.handshake(timeout=1)
+        received, other, have = await read_all(protocol, 3)
+        # A Piece with nowhere to go is asked about again on every read until it is whole
+        assert asked[0] == (5, 16, 32) and set(asked[1:]) == {(6, 0, 8)}
+        assert received.block.obj is piece and bytes(piece) == bytes(16) + b"a" * 32 + bytes(16)
+        assert bytes(other.block) == b"b" * 8 and have.index == 2
+    asyncio.run(main())
+
+def test_reading_pauses_while_messages_pile_up(monkeypatch):
+    monkeypatch.setattr(wire_protocol, "MAX_PENDING_MESSAGES", 4)
+    async def main():
+        protocol, transport = connect()
+        feed(protocol, Handshake(INFO_HASH).encode() + b"".join(Have(index).encode() for index in range(4)))
+        await protocol.handshake(timeout=1)
+        assert transport.paused
+        await read_all(protocol, 1)
+        assert transport.paused
+        await read_all(protocol, 1)
+        assert not transport.paused
+    asyncio.run(main())
+
+def test_small_writes_are_coalesced():
+    async def main():
+        protocol, transport = connect()
+        protocol.writer.write(Interested().encode())
+        protocol.writer.write(Have(1).encode())
+        assert transport.written == []
+        await asyncio.sleep(0)
+        assert transport.written == [Interested().encode() + Have(1).encode()]
+        protocol.writer.write(Have(2).encode())
+        protocol.writer.writelines(Piece(0, 0, b"x" * 1000).encode_buffers())
+        assert transport.written[1] == Have(2).encode() + Piece(0, 0, b"x" * 1000).encode()
+        await asyncio.sleep(0)
+        assert len(transport.written) == 2
+    asyncio.run(main())
+
+def test_a_dropped_block_stops_writing_to_its_buffer():
+    async def main():
+        protocol, _ = connect()
+        piece = bytearray(32)
+        protocol.block_buffer = lambda index, begin, length: memoryview(piece)[begin:begin + length]
+        stream = Handshake(INFO_HASH).encode() + Piece(0, 0, b"a" * 32).encode() + Have(4).encode()
+        split = Handshake.length + 13 + 10
+        feed(protocol, stream[:split])
+        await protocol.handshake(timeout=1)
+        protocol.drop_block()
+        feed(protocol, stream[split:], 7)
+        [have] = await read_all(protocol, 1)
+        assert have.index == 4
+        assert bytes(piece) == b"a" * 10 + bytes(22)
+    asyncio.run(main())
@@ -0,0 +1,259 @@
+"""Per-torrent scheduling of tracker announces"""
+import time
+import heapq
+import random
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from torrent_peer.config_loader import INTERVAL, MIN_PEERS, ANNOUNCE_RETRY
+
+logger = logging.getLogger(__name__)
+
+# Announces are delayed by up to this fraction of their interval, so torrents added together
+# do not keep announcing together
+ANNOUNCE_JITTER = 0.1
+# Seconds a due announce waits for others to the same tracker, so they share one request
+# (announces are delayed, never sent early)
+BATCH_DELAY = 0.5
+# Most torrents announced in one request
+BATCH_SIZE = 500
+# Seconds between announces to a tracker until it says otherwise
+DEFAULT_INTERVAL = 1800.0
+
+# `announce(tracker_url, [(info_hash, event), ...])` -> `{info_hash: response}`
+BatchAnnounce = Callable[[str, List[Tuple[bytes, Optional[str]]]], Awaitable[Dict[bytes, Dict[str, Any]]]]
+
+class AnnounceState:
+    """ Announce bookkeeping of one torrent """
+    def __init__(self,
+                 info_hash: bytes,
+                 tracker_url: str,
+                 interval: float,
+                 min_interval: float,
+                 on_peers: Callable[[List[Dict[str, Any]]], None] = None,
+                 peer_count: Callable[[], int] = None) -> None:
+        self.info_hash = info_hash
+        self.tracker_url = tracker_url
+        self.interval = interval
+        self.min_interval = min_interval
+        self.on_peers = on_peers
+        self.peer_count = peer_count
+        self.event: Optional[str] = None    # Event to send with the next announce
+        self.last_announce = float("-inf")
+        self.due = float("inf")
+        self.failures = 0
+        self.announcing = False
+        # Outcome of the first announce: its response, or the error if it failed
+        self.first: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.first.add_done_callback(_retrieve)
+
+def _retrieve(future: asyncio.Future) -> None:
+    # Nobody has to wait for the first announce: do not warn about an error left unread
+    if not future.cancelled():
+        future.exception()
+
+class AnnounceScheduler:
+    """
+    Announces every registered torrent to its tracker when the tracker asks to.
+
+    After a successful announce the next one is due `interval` seconds later, as returned
+    by the tracker, plus a random jitter. A torrent that has fewer than `min_peers`
+    connected peers (`peer_count`) re-announces as soon as the tracker's `min interval`
+    allows, to find more. Failed announces are retried after `retry` seconds, doubling
+    with every failure up to the interval.
+
+    All torrents share one task and a heap ordered by due time, so idle torrents cost
+    nothing between their announces. Torrents due within `BATCH_DELAY` of each other on
+    the same tracker are announced in one batched request, and so are the `stopped`
+    announces of `stop`.
+
+    Args:
+        announce: Coroutine function announcing a batch of torrents to one tracker; it
+            returns the decoded response of every torrent by info_hash.
+    """
+    def __init__(self,
+                 announce: BatchAnnounce,
+                 min_peers: int = MIN_PEERS,
+                 retry: float = ANNOUNCE_RETRY,
+                 min_interval: float = INTERVAL) -> None:
+        self.announce = announce
+        self.min_peers = min_peers
+        self.retry = retry
+        self.min_interval = min_interval
+        self.intervals: Dict[str, float] = {}   # Last interval returned by each tracker
+        self.torrents: Dict[bytes, AnnounceState] = {}
+        self._heap: List[Tuple[float, int, bytes]] = []
+        self._counter = 0       # Tie-breaker of heap entries
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+        self._announces = set()
+
+    def add(self,
+            info_hash: bytes,
+            tracker_url: str,
+            event: Optional[str] = "started",
+            on_peers: Callable[[List[Dict[str, Any]]], None] = None,
+            peer_count: Callable[[], int] = None) -> asyncio.Future:
+        """
+        Start announcing a torrent, replacing its earlier registration if any.
+
+        Args:
+            event: Announced right away (after `BATCH_DELAY`) with this event. None if the
+                torrent was just announced by the caller; the next announce is then one
+                interval away.
+            on_peers: Called with the peers of every successful announce.
+            peer_count: Number of peers currently connected for this torrent.
+
+        Returns:
+            A future of the response to the first announce. It raises if that announce
+            failed; the announce is retried all the same.
+        """
+        state = AnnounceState(info_hash, tracker_url, self.intervals.get(tracker_url, DEFAULT_INTERVAL),
+                              self.min_interval, on_peers, peer_count)
+        replaced = self.torrents.get(info_hash)
+        if replaced is not None and not replaced.first.done():
+            state.first = replaced.first    # Whoever waits for it gets the first announce of this one
+        self.torrents[info_hash] = state
+        if event is not None:
+            state.event = event
+            self._schedule(state, time.monotonic())
+        else:
+            state.last_announce = time.monotonic()
+            self._schedule_next(state)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return state.first
+
+    async def remove(self, info_hash: bytes, event: Optional[str] = "stopped") -> None:
+        """ Stop announcing a torrent, telling the tracker with a last `event` announce """
+        state = self.torrents.pop(info_hash, None)
+        if state is not None:
+            state.first.cancel()
+        if state is None or event is None:
+            return
+        await self._send_final(state.tracker_url, [info_hash], event)
+
+    def peers_changed(self, info_hash: bytes) -> None:
+        """ A connection of the torrent was lost: re-announce early if it is short of peers """
+        state = self.torrents.get(info_hash)
+        if state is None or state.announcing or state.failures or not self._short_of_peers(state):
+            return
+        due = max(state.last_announce + state.min_interval, time.monotonic())
+        if due < state.due:
+            self._schedule(state, due)
+
+    async def stop(self) -> None:
+        """ Stop scheduling and announce "stopped" for every torrent, in batches per tracker """
+        if self._task is not None:
+            self._task.cancel()
+        by_tracker: Dict[str, List[bytes]] = {}
+        for state in self.torrents.values():
+            by_tracker.setdefault(state.tracker_url, []).append(state.info_hash)
+        for state in self.torrents.values():
+            state.first.cancel()
+        self.torrents.clear()
+        await asyncio.gather(*(self._send_final(tracker_url, info_hashes[start:start + BATCH_SIZE], "stopped")
+                               for tracker_url, info_hashes in by_tracker.items()
+                               for start in range(0, len(info_hashes), BATCH_SIZE)))
+
+    async def _send_final(self, tracker_url: str, info_hashes: List[bytes], event: str) -> None:
+        try:
+            await self.announce(tracker_url, [(info_hash, event) for info_hash in info_hashes])
+        except Exception as e:
+            logger.info(f"Error announcing {event} for {len(info_hashes)} torrents to {tracker_url}: {e}")
+
+    def _short_of_peers(self, state: AnnounceState) -> bool:
+        return state.peer_count is not None and state.peer_count() < self.min_peers
+
+    def _schedule(self, state: AnnounceState, due: float) -> None:
+        state.due = due
+        self._counter += 1
+        heapq.heappush(self._heap, (due, self._counter, state.info_hash))
+        self._wakeup.set()
+
+    def _schedule_next(self, state: AnnounceState) -> None:
+        delay = state.min_interval if self._short_of_peers(state) else state.interval
+        self._schedule(state, state.last_announce + delay * (1 + random.uniform(0, ANNOUNCE_JITTER)))
+
+    def _skip_stale(self) -> None:
+        """ Drop the heap entries of removed torrents, or superseded by a later `_schedule` """
+        while self._heap:
+            due, _, info_hash = self._heap[0]
+            state = self.torrents.get(info_hash)
+            if state is not None and state.due == due and not state.announcing:
+                return
+            heapq.heappop(self._heap)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            self._skip_stale()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            # The first due announce waits BATCH_DELAY, then goes with everything due by then
+            now = time.monotonic()
+            delay = self._heap[0][0] + BATCH_DELAY - now
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batches: Dict[str, List[AnnounceState]] = {}
+            while self._heap and self._heap[0][0] <= now:
+                _, _, info_hash = heapq.heappop(self._heap)
+                state = self.torrents[info_hash]
+                state.due = float("inf")
+                batches.setdefault(state.tracker_url, []).append(state)
+                self._skip_stale()
+            for tracker_url, states in batches.items():
+                for start in range(0, len(states), BATCH_SIZE):
+                    task = asyncio.create_task(self._announce(tracker_url, states[start:start + BATCH_SIZE]))
+                    self._announces.add(task)
+                    task.add_done_callback(self._announces.discard)
+
+    async def _announce(self, tracker_url: str, states: List[AnnounceState]) -> None:
+        for state in states:
+            state.announcing = True
+        try:
+            responses = await self.announce(tracker_url, [(state.info_hash, state.event) for state in states])
+        except Exception as e:
+            logger.info(f"Announce of {len(states)} torrents to {tracker_url} failed: {e}")
+            for state in states:
+                self._failed(state, e)
+            return
+        finally:
+            for state in states:
+                state.announcing = False
+
+        for state in states:
+            response = responses.get(state.info_hash)
+            if response is None:
+                self._failed(state, RuntimeError(f"{tracker_url} did not answer for {state.info_hash.hex()}"))
+                continue
+            if not state.first.done():
+                state.first.set_result(response)
+            state.failures = 0
+            state.event = None
+            state.last_announce = time.monotonic()
+            state.interval = self.intervals[tracker_url] = float(response.get("interval", state.interval))
+            state.min_interval = float(response.get("min interval", state.min_interval))
+            if self.torrents.get(state.info_hash) is not state:
+                continue  # Removed (or replaced) meanwhile
+            if state.on_peers is not None:
+                try:
+                    state.on_peers(response.get("peers", []))
+                except Exception as e:
+                    logger.error(f"Error handling the peers of {state.info_hash.hex()}: {e}")
+            self._schedule_next(state)
+
+    def _failed(self, state: AnnounceState, error: Exception) -> None:
+        """ Retry a failed announce (with its event) after an exponential backoff """
+        if not state.first.done():
+            state.first.set_exception(error)
+        state.failures += 1
+        delay = min(self.retry * 2 ** (state.failures - 1), max(state.interval, self.retry))
+        logger.info(f"Announce of {state.info_hash.hex()} failed, retrying in {delay:.0f} s")
+        if self.torrents.get(state.info_hash) is state:
+            self._schedule(state, time.monotonic() + delay * (1 + random.uniform(0, ANNOUNCE_JITTER)))
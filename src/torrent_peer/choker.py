@@ -0,0 +1,128 @@
+"""Tit-for-tat choking of the peers downloading a torrent from us"""
+import random
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from torrent_peer.peer_message import Choke, Unchoke
+from torrent_peer.config_loader import UPLOAD_SLOTS
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two rechokes
+RECHOKE_INTERVAL = 10
+# The optimistic unchoke moves to another peer every this many rechokes
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+class UploadPeer:
+    """ A connection a remote peer downloads from, as seen by the choker """
+    def __init__(self, writer, peer_id: bytes, queue: Deque[Tuple[int, int, int]] = None) -> None:
+        self.writer = writer
+        self.peer_id = peer_id
+        self.queue = queue if queue is not None else deque()    # Its requests waiting to be served
+        self.choked = True          # Every connection starts choked
+        self.interested = False
+        self.uploaded = 0           # Bytes sent to it
+        self.upload_rate = 0.0      # Bytes per second over the last rechoke interval
+        self.download_rate = 0.0    # Bytes per second received from the same peer
+        self._uploaded_before = 0
+
+class Choker:
+    """
+    Chooses which of the peers downloading one torrent from us are served (unchoked).
+
+    At most `upload_slots` interested peers are unchoked at a time. Every rechoke
+    (`RECHOKE_INTERVAL` seconds) the slots go to the peers that reciprocate best: those we
+    download from fastest while we are leeching the torrent, those we upload to fastest
+    once we seed it (so they finish and start seeding soon). One slot is an optimistic
+    unchoke instead, given to a random choked peer every `OPTIMISTIC_UNCHOKE_ROUNDS`
+    rechokes, so that new peers get a chance to prove themselves.
+
+    Slots freed between rechokes (a peer loses interest or disconnects) are given out
+    right away. A choked peer's queued requests are dropped, as the protocol expects.
+
+    Args:
+        seeding: Whether we have the whole torrent (ranks peers by upload rate).
+    """
+    def __init__(self, seeding: Callable[[], bool], upload_slots: int = UPLOAD_SLOTS) -> None:
+        self.seeding = seeding
+        self.upload_slots = max(1, upload_slots)
+        self.peers: List[UploadPeer] = []
+        self.optimistic: Optional[UploadPeer] = None
+        self._received: Dict[bytes, int] = {}   # Bytes downloaded from each peer_id since the last rechoke
+        self._rounds = 0
+
+    def add(self, peer: UploadPeer) -> None:
+        self.peers.append(peer)
+
+    def remove(self, peer: UploadPeer) -> None:
+        if peer in self.peers:
+            self.peers.remove(peer)
+        if peer is self.optimistic:
+            self.optimistic = None
+        if not peer.choked:
+            self._fill_slots()
+
+    def set_interested(self, peer: UploadPeer, interested: bool) -> None:
+        """ Record an Interested or NotInterested message of `peer` """
+        peer.interested = interested
+        if not interested and not peer.choked:
+            self._choke(peer)
+        self._fill_slots()
+
+    def received(self, peer_id: bytes, length: int) -> None:
+        """ Count the bytes downloaded from a peer (on our own connection to it) """
+        self._received[peer_id] = self._received.get(peer_id, 0) + length
+
+    def rechoke(self, interval: float = RECHOKE_INTERVAL) -> None:
+        """ Measure the rates of the last `interval` seconds and hand out the slots again """
+        for peer in self.peers:
+            peer.upload_rate = (peer.uploaded - peer._uploaded_before) / interval
+            peer._uploaded_before = peer.uploaded
+            peer.download_rate = self._received.get(peer.peer_id, 0) / interval
+        self._received.clear()
+
+        interested = sorted((peer for peer in self.peers if peer.interested), key=self._rank, reverse=True)
+        regular = self.upload_slots - 1 if self.upload_slots > 1 else 1
+        unchoked = interested[:regular]
+        if self.upload_slots > 1:
+            if self._rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0 or self.optimistic not in interested \
+                    or self.optimistic in unchoked:
+                others = interested[regular:]
+                self.optimistic = random.choice(others) if others else None
+            if self.optimistic is not None:
+                unchoked.append(self.optimistic)
+        self._rounds += 1
+
+        for peer in self.peers:
+            if peer in unchoked:
+                if peer.choked:
+                    self._unchoke(peer)
+            elif not peer.choked:
+                self._choke(peer)
+        logger.debug(f"Rechoked: {len(unchoked)} of {len(self.peers)} peers unchoked")
+
+    def _rank(self, peer: UploadPeer) -> Tuple[float, float]:
+        if self.seeding():
+            return (peer.upload_rate, peer.download_rate)
+        return (peer.download_rate, peer.upload_rate)
+
+    def _fill_slots(self) -> None:
+        """ Unchoke the best choked interested peers while slots are free """
+        free = self.upload_slots - sum(1 for peer in self.peers if not peer.choked)
+        if free <= 0:
+            return
+        waiting = sorted((peer for peer in self.peers if peer.choked and peer.interested),
+                         key=self._rank, reverse=True)
+        for peer in waiting[:free]:
+            self._unchoke(peer)
+
+    def _choke(self, peer: UploadPeer) -> None:
+        peer.choked = True
+        peer.queue.clear()
+        if not peer.writer.is_closing():
+            peer.writer.write(Choke().encode())
+
+    def _unchoke(self, peer: UploadPeer) -> None:
+        peer.choked = False
+        if not peer.writer.is_closing():
+            peer.writer.write(Unchoke().encode())
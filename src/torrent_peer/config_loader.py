@@ -8,5 +8,27 @@ config.read(CONFIG_PATH)
 TRACKER_URL = config["peer"]["TRACKER_URL"]
 TORRENT_DIR = os.path.join(CURRENT_DIR, config["peer"]["TORRENT_DIR"])
 DOWNLOAD_DIR = os.path.join(CURRENT_DIR, config["peer"]["DOWNLOAD_DIR"])
+RESUME_DIR = os.path.join(CURRENT_DIR, config["peer"]["RESUME_DIR"])
 INTERVAL = int(config["peer"]["INTERVAL"])
-PORT = int(config["peer"]["PORT"])
\ No newline at end of file
+MIN_PEERS = int(config["peer"]["MIN_PEERS"])
+NUMWANT = int(config["peer"]["NUMWANT"])
+ANNOUNCE_RETRY = float(config["peer"]["ANNOUNCE_RETRY"])
+TRACKER_TIMEOUT = float(config["peer"]["TRACKER_TIMEOUT"])
+TRACKER_CONNECT_TIMEOUT = float(config["peer"]["TRACKER_CONNECT_TIMEOUT"])
+TRACKER_MAX_CONNECTIONS = int(config["peer"]["TRACKER_MAX_CONNECTIONS"])
+PORT = int(config["peer"]["PORT"])
+BLOCK_SIZE = int(config["peer"]["BLOCK_SIZE"])
+MAX_PIPELINE_DEPTH = int(config["peer"]["MAX_PIPELINE_DEPTH"])
+UPLOAD_SLOTS = int(config["peer"]["UPLOAD_SLOTS"])
+MAX_UPLOAD_RATE = float(config["peer"]["MAX_UPLOAD_RATE"])
+MAX_DOWNLOAD_RATE = float(config["peer"]["MAX_DOWNLOAD_RATE"])
+MAX_OPEN_FILES = int(config["peer"]["MAX_OPEN_FILES"])
+STORAGE_BACKEND = config["peer"]["STORAGE_BACKEND"]
+MSYNC_POLICY = config["peer"]["MSYNC_POLICY"]
+MSYNC_INTERVAL = float(config["peer"]["MSYNC_INTERVAL"])
+DISK_WRITE_BUFFER = int(config["peer"]["DISK_WRITE_BUFFER"])
+DISK_WORKERS = int(config["peer"]["DISK_WORKERS"])
+DISK_WRITE_DELAY = float(config["peer"]["DISK_WRITE_DELAY"])
+RESUME_INTERVAL = int(config["peer"]["RESUME_INTERVAL"])
+RESUME_PIECES = int(config["peer"]["RESUME_PIECES"])
+WIRE_ENGINE = config["peer"]["WIRE_ENGINE"]
@@ -5,6 +5,7 @@ import asyncio
 import logging
 import uvicorn
 from torrent_peer.peer import TorrentPeer
+from torrent_peer.resume import ResumeData
 from torrent_peer.config_loader import TORRENT_DIR, DOWNLOAD_DIR, TRACKER_URL
 import click
 os.makedirs(TORRENT_DIR, exist_ok=True)
@@ -47,7 +48,7 @@ async def seed():
         input_path = data.get("input_path", None)
         if input_path is None:
             return jsonify({"error": "input_path is required"}), 400
-        peer.seed(
+        await peer.seed(
             input_path = input_path,
             trackers= data.get("trackers", [[TRACKER_URL]]),
             public=data.get("public", True),
@@ -60,6 +61,8 @@ async def seed():
     except FileNotFoundError as e:
         return jsonify({"error": "File not found error.",
                         "details": f"{input_path} doesn't exist"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
@@ -82,10 +85,33 @@ async def leech():
     asyncio.create_task(peer.download(torrent_filepath, pbar_pos%10))
     return jsonify({"message": "File is downloading"}), 200
 
+@app.route("/recheck", methods=["POST"])
+async def recheck():
+    try:
+        data = await request.get_json()
+        torrent_filepath = data.get("torrent_filepath", None)
+        input_path = data.get("input_path", None)
+        torrent_dir = data.get("torrent_dir", None)
+        data_dir = data.get("data_dir", None)
+        options = {"seed": data.get("seed", False), "resume": data.get("resume", False)}
+        if torrent_filepath and input_path:
+            results = [await peer.recheck(torrent_filepath, input_path, **options)]
+        elif torrent_dir and data_dir:
+            results = await peer.recheck_directory(torrent_dir, data_dir, **options)
+        else:
+            return jsonify({"error": "torrent_filepath and input_path, or torrent_dir and data_dir are required"}), 400
+        return jsonify({"data": [result.to_dict() for result in results]}), 200
+    except FileNotFoundError as e:
+        return jsonify({"error": "File not found error.", "details": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/torrents", methods=["GET"])
 async def get_torrents():
     try:
-        torrents = TorrentPeer.get_torrents()
+        params = {key: request.args.get(key) for key in ("limit", "cursor", "prefix", "search", "fields")}
+        health = request.args.get("health", "").lower() in ("1", "true", "yes")
+        torrents = await peer.get_torrents(health=health, **params)
         return jsonify({"data": torrents}), 200
     except RuntimeError as e:
         # Catch custom errors raised from get_torrents
@@ -98,16 +124,45 @@ async def get_torrents():
 @app.route("/torrents/<string:info_hash>", methods=["GET"])
 async def get_torrent_by_info_hash(info_hash):
     try:
-        file_path = await TorrentPeer.get_torrent_by_info_hash(info_hash)
+        file_path = await peer.get_torrent_by_info_hash(info_hash)
         return jsonify({"data": file_path}), 200
     except Exception as e:
         # Catch-all for any other unanticipated exceptions
         logging.error(f"Unexpected error: {e}")  # Log the error for debugging
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
+@app.route("/limits", methods=["GET"])
+def get_limits():
+    return jsonify(peer.limits.to_dict()), 200
+
+@app.route("/limits", methods=["POST"])
+async def set_limits():
+    """
+    Change bandwidth limits in bytes per second (0: no limit): `upload` and/or `download`,
+    of the whole daemon or, with `info_hash`, of one torrent.
+    """
+    try:
+        data = await request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "The body must be a JSON object"}), 400
+        info_hash = data.get("info_hash", None)
+        peer.limits.set(upload=data.get("upload", None),
+                        download=data.get("download", None),
+                        info_hash=bytes.fromhex(info_hash) if info_hash else None)
+        return jsonify(peer.limits.to_dict()), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
 @app.before_serving
 async def run_background_tasks():
     asyncio.create_task(peer.start_seeding())
+    # Continue the downloads that were unfinished when the daemon stopped
+    global pbar_pos
+    for resume in ResumeData.load_all():
+        if not os.path.exists(resume.torrent_filepath):
+            continue
+        pbar_pos += 1
+        asyncio.create_task(peer.download(resume.torrent_filepath, pbar_pos%10))
 
 @click.command()
 @click.option("--port", "port", default=5000, help="Running port for torrent daemon (default: 5000)")
@@ -0,0 +1,162 @@
+"""Background write-back of verified pieces to storage"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Set, Tuple
+from torrent_peer.storage import FileStorage
+from torrent_peer.config_loader import (DISK_WRITE_BUFFER, DISK_WORKERS, DISK_WRITE_DELAY,
+                                        MSYNC_POLICY, MSYNC_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+# Largest single write a run of adjacent pieces is merged into
+MAX_WRITE_SIZE = 2**22
+
+class DiskIO:
+    """
+    Writes verified pieces to a storage in the background.
+
+    Pieces handed to `write` wait in a write-back queue for up to `delay` seconds, so
+    pieces that end up next to each other on disk can be merged into one large sequential
+    write instead of many small random ones. Every batch is sorted by offset (that is by
+    file, then by position in the file) and its runs are handed in that order to a fixed
+    pool of worker threads; with more than one worker, runs may be written concurrently
+    and finish out of order. The connections keep downloading meanwhile: `write` only
+    makes its caller wait when the bytes queued or being written reach `max_buffer`.
+
+    When written data is flushed to disk follows `sync_policy`: "none", "piece" (after
+    every write) or "interval" (every `sync_interval` seconds). `close` always flushes.
+    """
+    def __init__(self,
+                 storage: FileStorage,
+                 max_buffer: int = DISK_WRITE_BUFFER,
+                 workers: int = DISK_WORKERS,
+                 delay: float = DISK_WRITE_DELAY,
+                 sync_policy: str = MSYNC_POLICY,
+                 sync_interval: float = MSYNC_INTERVAL) -> None:
+        self.storage = storage
+        self.max_buffer = max_buffer
+        self.delay = delay
+        self.sync_policy = sync_policy
+        self.sync_interval = sync_interval
+        self.buffered = 0   # Bytes queued or being written
+        self._queue: Dict[int, Tuple[bytes, asyncio.Future]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="disk-io")
+        self._space = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._flusher: asyncio.Task = None
+        self._writes: Set[asyncio.Task] = set()
+        self._last_sync = time.monotonic()
+        self._closed = False
+
+    async def write(self, offset: int, data: bytes) -> asyncio.Future:
+        """
+        Queue `data` to be written at `offset`, waiting only while the buffer is full.
+        `data` must not be modified afterwards. If the same data is still queued at
+        `offset`, it is written once and both callers share its future.
+
+        Returns:
+            A future resolved once the data is written (and flushed if the policy says so),
+            or failed with the error of the write.
+        """
+        if self._closed:
+            raise RuntimeError("Disk writer is closed.")
+        async with self._space:
+            # A write larger than the whole buffer goes through once the buffer is empty
+            await self._space.wait_for(
+                lambda: self.buffered == 0 or self.buffered + len(data) <= self.max_buffer)
+            queued = self._queue.get(offset)
+            if queued is not None:
+                if len(queued[0]) != len(data):
+                    raise ValueError(f"A write of {len(queued[0])} bytes is queued at offset {offset} already")
+                return queued[1]
+            self.buffered += len(data)
+            future = asyncio.get_running_loop().create_future()
+            self._queue[offset] = (data, future)
+        self._idle.clear()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return future
+
+    async def close(self) -> None:
+        """ Write everything still queued, flush the storage and stop the workers """
+        self._closed = True
+        self._wakeup.set()
+        await self._idle.wait()
+        if self._flusher is not None:
+            self._flusher.cancel()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self.storage.flush)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Give the neighbours of the queued pieces a moment to arrive, unless the
+            # buffer is filling up or everything has to be written now
+            if self.delay > 0 and not self._closed and self.buffered < self.max_buffer // 2:
+                await asyncio.sleep(self.delay)
+            self._wakeup.clear()
+            batch, self._queue = self._queue, {}
+            for offset, buffers, futures in self._runs(batch):
+                # The executor starts queued jobs in order: with a single worker, runs are
+                # written sorted by offset
+                self._writes.add(asyncio.create_task(self._write(offset, buffers, futures)))
+
+    @staticmethod
+    def _runs(batch: Dict[int, Tuple[bytes, asyncio.Future]]) -> Iterator[Tuple[int, List[bytes], List[asyncio.Future]]]:
+        """ `(offset, buffers, futures)` of each run of adjacent writes, in offset order """
+        run_offset, buffers, futures, end = None, [], [], None
+        for offset in sorted(batch):
+            data, future = batch[offset]
+            if buffers and (offset != end or end - run_offset + len(data) > MAX_WRITE_SIZE):
+                yield run_offset, buffers, futures
+                buffers, futures = [], []
+            if not buffers:
+                run_offset = offset
+            buffers.append(data)
+            futures.append(future)
+            end = offset + len(data)
+        if buffers:
+            yield run_offset, buffers, futures
+
+    def _write_run(self, offset: int, buffers: List[bytes]) -> None:
+        """ Runs on a worker thread """
+        data = buffers[0] if len(buffers) == 1 else b"".join(buffers)
+        self.storage.write(offset, data)
+        if self.sync_policy == "piece":
+            self.storage.flush(offset, len(data))
+
+    async def _write(self, offset: int, buffers: List[bytes], futures: List[asyncio.Future]) -> None:
+        loop = asyncio.get_running_loop()
+        size = sum(map(len, buffers))
+        try:
+            await loop.run_in_executor(self._executor, self._write_run, offset, buffers)
+        except Exception as e:
+            logger.error(f"Writing {size} bytes at offset {offset} of {self.storage.root_path} failed: {e}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(None)
+            if self.sync_policy == "interval" and time.monotonic() - self._last_sync >= self.sync_interval:
+                self._last_sync = time.monotonic()
+                try:
+                    await loop.run_in_executor(self._executor, self.storage.flush)
+                except Exception as e:
+                    logger.error(f"Flushing {self.storage.root_path} failed: {e}")
+        finally:
+            self._writes.discard(asyncio.current_task())
+            async with self._space:
+                self.buffered -= size
+                self._space.notify_all()
+            if self.buffered == 0:
+                self._idle.set()
@@ -0,0 +1,52 @@
+"""Framing of the messages received on a peer wire connection"""
+import asyncio
+import struct
+from typing import Optional
+from torrent_peer.peer_message import Handshake, KeepAlive, PeerMessage, decode_message
+
+# Largest message accepted: a Piece of the largest block, or the BitField of a torrent of
+# up to 16M pieces
+MAX_MESSAGE_LENGTH = 2**21
+
+_LENGTH = struct.Struct('>I')
+KEEP_ALIVE = KeepAlive()
+
+class MessageReader:
+    """
+    Reads whole messages from a peer.
+
+    Every read is exact-length (`readexactly`): the 4-byte length prefix, then exactly
+    that many bytes, so a message split across TCP segments is never taken for a shorter
+    one. Messages are decoded by message ID (`decode_message`) over a `memoryview` of the
+    received bytes, so the block of a Piece is not copied before it is stored.
+
+    Reads raise `asyncio.IncompleteReadError` when the connection closes, and
+    `asyncio.TimeoutError` when nothing arrives in time.
+    """
+    def __init__(self, reader: asyncio.StreamReader, max_length: int = MAX_MESSAGE_LENGTH) -> None:
+        self.reader = reader
+        self.max_length = max_length
+
+    async def handshake(self, timeout: float) -> Handshake:
+        data = await asyncio.wait_for(self.reader.readexactly(Handshake.length), timeout=timeout)
+        if not Handshake.is_valid(data):
+            raise ValueError("Invalid handshake")
+        return Handshake.decode(data)
+
+    async def next(self, timeout: float, body_timeout: float = 10) -> Optional[PeerMessage]:
+        """
+        The next message: `KEEP_ALIVE` for a keep-alive, None for a message ID that is not
+        supported. `timeout` applies to the wait for the message to start, `body_timeout`
+        to the rest of it.
+        """
+        header = await asyncio.wait_for(self.reader.readexactly(_LENGTH.size), timeout=timeout)
+        length = _LENGTH.unpack(header)[0]
+        if length == 0:
+            return KEEP_ALIVE
+        if length > self.max_length:
+            raise ValueError(f"Message of {length} bytes exceeds the limit of {self.max_length}")
+        body = await asyncio.wait_for(self.reader.readexactly(length), timeout=body_timeout)
+        try:
+            return decode_message(memoryview(body))
+        except struct.error:
+            raise ValueError(f"Malformed message {body[0]} of {length} bytes")
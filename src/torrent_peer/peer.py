@@ -1,10 +1,9 @@
 """Module for Torrent Peer class"""
 import aiofiles
 import os
-from typing import List, Dict, Any
-import requests
+from typing import List, Dict, Any, Set, Tuple
+import httpx
 import asyncio
-import struct
 from uuid import uuid4
 import aiofiles
 import logging
@@ -12,10 +11,30 @@ import traceback
 from tqdm.asyncio import tqdm_asyncio
 from tqdm import tqdm
 from torrent_peer.piece_manager import PieceManager
-from torrent_peer.torrent_file import TorrentFile
+from torrent_peer.torrent_file import TorrentFile, Metainfo, metainfo_registry
 from torrent_peer.utils import get_unique_filename, get_local_ip
-from torrent_peer.peer_message import Handshake, Piece
-from torrent_peer.config_loader import TRACKER_URL, TORRENT_DIR, DOWNLOAD_DIR, INTERVAL
+from torrent_peer.peer_message import (Handshake, Piece, BitField, Have, KeepAlive, Request, Cancel,
+                                       Choke, Unchoke, Interested, NotInterested)
+from torrent_peer.wire_protocol import PeerWireProtocol, Messages, Writer, open_peer_connection, start_peer_server
+from torrent_peer.piece_picker import PeerPieces
+from torrent_peer.storage import FileStorage
+from torrent_peer.request_pipeline import RequestPipeline
+from torrent_peer.resume import ResumeData
+from torrent_peer.recheck import RecheckResult, recheck, torrents_in_directory
+from torrent_peer.tracker_client import TrackerClient
+from torrent_peer.announce_scheduler import AnnounceScheduler
+from torrent_peer.choker import Choker, UploadPeer, RECHOKE_INTERVAL
+from torrent_peer.rate_limiter import BandwidthLimits
+from torrent_peer.config_loader import TRACKER_URL, TORRENT_DIR, DOWNLOAD_DIR, BLOCK_SIZE, RESUME_INTERVAL, RESUME_PIECES, NUMWANT
+
+# Largest block a remote peer may request in a single Request message
+MAX_BLOCK_SIZE = 2**17
+# Largest number of requests queued for one uploading connection
+MAX_QUEUED_REQUESTS = 512
+# Seconds without any message before an uploading connection is dropped
+IDLE_TIMEOUT = 120
+# Seconds a downloading connection with nothing to request waits before sending a keep-alive
+KEEP_ALIVE_INTERVAL = 30
 
 logger = logging.getLogger(__name__)
 
@@ -36,57 +55,114 @@ class TorrentPeer:
         # }
         self.seeding_torrents = {}
         self.leeching_torrents: Dict[bytes, PieceManager] = {}
-
-    def _send_request_to_tracker(self, torrent_filepath: str, event: str = None) -> requests.Response:
+        # Open peer wire connections (both directions) of each torrent, used to broadcast Have
+        self.connections: Dict[bytes, Set[Writer]] = {}
+        self.peer_id: bytes = b"-TL0001-" + os.urandom(12)
+        # Open-file pools of the torrents being served
+        self.storages: Dict[bytes, FileStorage] = {}
+        # Shared by every torrent, so connections to the trackers are reused
+        self.tracker = TrackerClient()
+        # Re-announces every seeded or downloaded torrent when its tracker asks to
+        self.announcer = AnnounceScheduler(self._announce_batch)
+        # Upload slots of the torrents peers download from us
+        self.chokers: Dict[bytes, Choker] = {}
+        # Bandwidth limits of the daemon and of single torrents, shared by all connections
+        self.limits = BandwidthLimits()
+
+    def _bytes_left(self, info_hash: bytes) -> int:
+        """ Bytes of a torrent still to download, as announced to the tracker (0 for a seed) """
+        piece_manager = self.leeching_torrents.get(info_hash)
+        if piece_manager is not None:
+            have = piece_manager.have
+        else:
+            have = self.seeding_torrents.get(info_hash, {}).get("have")
+            if have is None:
+                return 0
+        metainfo = metainfo_registry.get(info_hash)
+        if have.is_seed or metainfo is None:
+            return 0
+        return max(1, metainfo.total_length - have.count * metainfo.piece_length)
+
+    async def _send_request_to_tracker(self, torrent_filepath: str, event: str = None) -> Dict[str, Any]:
         torrent = TorrentFile(torrent_filepath)
         tracker_url = torrent.tracker_url
         params = {
             "info_hash": torrent.info_hash.hex(), 
             "port": self.port,
-            "ip": self.local_ip 
+            "ip": self.local_ip,
+            "left": self._bytes_left(torrent.info_hash),
+            "compact": 1,
+            "numwant": NUMWANT
         }
         
         if event is not None:
             params["event"] = event
         try:
-            response = requests.get(tracker_url + "/announce", params=params, timeout=30)
-            response.raise_for_status()  # Raise error if status is not 200
-            return response
-        except requests.exceptions.RequestException as e:
+            return await self.tracker.announce(tracker_url, params)
+        except httpx.HTTPError as e:
             logger.info(f"Error connecting to tracker.\nError: {str(e)}")
             raise 
         except Exception as e:
             logger.error(f"Error occurs in _send_request_to_tracker: {str(e)}")
             raise
+
+    async def _announce_batch(self,
+                              tracker_url: str,
+                              entries: List[Tuple[bytes, str]]) -> Dict[bytes, Dict[str, Any]]:
+        """ Announce `(info_hash, event)` of many torrents to one tracker in a single request """
+        body = {
+            "port": self.port,
+            "ip": self.local_ip,
+            "compact": 1,
+            "numwant": NUMWANT,
+            "torrents": [
+                {
+                    "info_hash": info_hash.hex(),
+                    "event": event,
+                    "left": self._bytes_left(info_hash)
+                } for info_hash, event in entries
+            ]
+        }
+        try:
+            responses = await self.tracker.announce_batch(tracker_url, body)
+            return {bytes.fromhex(info_hash): response for info_hash, response in responses.items()}
+        except httpx.HTTPError as e:
+            logger.info(f"Error connecting to tracker.\nError: {str(e)}")
+            raise 
+        except Exception as e:
+            logger.error(f"Error occurs in _announce_batch: {str(e)}")
+            raise
         
     ##### For seeding - BEGIN #####
-    def _upload_torrent_to_tracker(self, name: str, description: str, torrent_filepath: str):
+    async def _upload_torrent_to_tracker(self, name: str, description: str, torrent_filepath: str):
         torrent = TorrentFile(torrent_filepath)
         tracker_url = torrent.tracker_url
+        data = {
+            "name": name,
+            "description": description,
+        }
+        params = {
+            "info_hash": torrent.info_hash.hex(),
+            "port": self.port,
+            "ip": self.local_ip,
+            "event": "started",
+            "left": 0,
+            "compact": 1,
+            "numwant": NUMWANT
+        }
         with open(torrent_filepath, "rb") as file:
-            files = {'file': file}
-            data = {
-                "name": name,
-                "description": description,
-            }
-            params = {
-                "info_hash": torrent.info_hash.hex(),
-                "port": self.port,
-                "ip": self.local_ip,
-                "event": "started"
-            }
-            try:
-                response = requests.post(tracker_url + "/announce", files=files, data=data, params=params, timeout=30)
-                response.raise_for_status()
-                return response   
-            except requests.exceptions.RequestException as e:
-                logger.info(f"Error connecting to tracker.\nError: {str(e)}")
-                raise 
-            except Exception as e:
-                logger.error(f"Error occurs in _send_request_to_tracker: {str(e)}")
-                raise
+            torrent_data = file.read()
+        try:
+            return await self.tracker.upload(tracker_url, torrent_data, os.path.basename(torrent_filepath), 
+                                             data, params)
+        except httpx.HTTPError as e:
+            logger.info(f"Error connecting to tracker.\nError: {str(e)}")
+            raise 
+        except Exception as e:
+            logger.error(f"Error occurs in _send_request_to_tracker: {str(e)}")
+            raise
 
-    def seed(self, input_path: str, 
+    async def seed(self, input_path: str, 
                    trackers: List[List[str]], 
                    public: bool = True,
                    piece_length: int = None, 
@@ -96,15 +172,31 @@ class TorrentPeer:
             if not os.path.exists(input_path): 
                 raise FileNotFoundError(input_path, "does not exists.")
             
-            if not piece_length: piece_length = 2**14
-            elif piece_length > 2**14: piece_length = 2**14
-
-            torrent_filepath = TorrentFile.create_torrent_file(
-                input_path=input_path,
-                trackers=trackers,
-                output_path=torrent_filepath or os.path.join(TORRENT_DIR, os.path.basename(input_path) + ".torrent"),
-                piece_length=piece_length
-            )
+            # Walking a large directory takes a while too
+            total_size = await asyncio.to_thread(TorrentFile.get_total_size, input_path)
+            if not piece_length:
+                piece_length = TorrentFile.choose_piece_length(total_size)
+            else:
+                # Pieces are requested in blocks and held in memory whole while downloading
+                TorrentFile.check_piece_length(piece_length, min_length=BLOCK_SIZE)
+
+            # Hashing a large input takes a while, keep the event loop serving peers meanwhile
+            with tqdm(total=total_size,
+                      desc=f"Hashing {os.path.basename(input_path)}",
+                      unit="B",
+                      unit_scale=True,
+                      leave=False) as pbar:
+                def progress(hashed_bytes: int, total_bytes: int):
+                    pbar.update(hashed_bytes - pbar.n)
+
+                torrent_filepath = await asyncio.to_thread(
+                    TorrentFile.create_torrent_file,
+                    input_path=input_path,
+                    trackers=trackers,
+                    output_path=torrent_filepath or os.path.join(TORRENT_DIR, os.path.basename(input_path) + ".torrent"),
+                    piece_length=piece_length,
+                    progress=progress
+                )
             torrent = TorrentFile(torrent_filepath)
 
             # Add to list of active torrents
@@ -116,9 +208,10 @@ class TorrentPeer:
             if public:
                 name = kwargs.get("name", None) or torrent.filename
                 description = kwargs.get("description", "")
-                self._upload_torrent_to_tracker(name, description, torrent.filepath)
+                await self._upload_torrent_to_tracker(name, description, torrent.filepath)
+                self.announcer.add(torrent.info_hash, torrent.tracker_url, event=None)
             else:
-                self._send_request_to_tracker(torrent.filepath, "started")
+                await self.announcer.add(torrent.info_hash, torrent.tracker_url, event="started")
         except FileNotFoundError as e:
             logger.error(f"FileNotFoundError occurs in seed: {str(e)}")
             raise 
@@ -126,9 +219,15 @@ class TorrentPeer:
             logger.error(f"Error occurs in seed: {str(e)}")
             raise 
         
-    def _seed_after_downloading(self, 
+    async def _seed_after_downloading(self, 
                                 input_path: str, 
-                                input_torrent_filepath: str):
+                                input_torrent_filepath: str,
+                                have: PeerPieces = None,
+                                event: str = "started"):
+        """
+        Seed existing data of a torrent: every piece, or only the pieces in `have`. `event`
+        is announced to the tracker: `completed` when the data was just downloaded.
+        """
         try:
             if not os.path.exists(input_path): 
                 raise FileNotFoundError(input_path, "does not exists.")
@@ -143,8 +242,10 @@ class TorrentPeer:
                 "torrent_filepath": torrent.filepath,
                 "filepath": input_path
             }
+            if have is not None:
+                self.seeding_torrents[torrent.info_hash]["have"] = have
 
-            self._send_request_to_tracker(torrent.filepath, "started")
+            self.announcer.add(torrent.info_hash, torrent.tracker_url, event=event)
         except FileNotFoundError as e:
             logger.error(f"FileNotFoundError occurs in seed: {str(e)}")
             raise 
@@ -152,42 +253,83 @@ class TorrentPeer:
             logger.error(f"Error occurs in seed: {str(e)}")
             raise 
 
-    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    async def handle_client(self, messages: Messages, writer: Writer):
         addr = writer.get_extra_info('peername')
+        info_hash = None
         try: 
-            request = await asyncio.wait_for(reader.read(68), timeout=10)
-            if not request:
+            try:
+                handshake_request = await messages.handshake(timeout=10)
+            except asyncio.IncompleteReadError:
                 raise Exception(f"Connection to client {addr} closed!") 
 
-            if not Handshake.is_valid(request):
-                raise Exception("Invalid handshake response")
-
-            # Get correct torrent to seed
-            handshake_request = Handshake.decode(request)
+            # Get correct torrent to seed. Torrents that are still downloading are served
+            # too, limited to the pieces downloaded so far.
             info_hash = handshake_request.info_hash
-            if info_hash not in self.seeding_torrents:
+            if handshake_request.peer_id == self.peer_id:
+                raise Exception("Connected to ourselves.")
+            piece_manager = None
+            if info_hash in self.seeding_torrents:
+                curr_torrent_metadata = self.seeding_torrents[info_hash]
+            elif info_hash in self.leeching_torrents:
+                piece_manager = self.leeching_torrents[info_hash]
+                curr_torrent_metadata = {
+                    "torrent_filepath": piece_manager.torrent.filepath,
+                    "filepath": piece_manager.output_name
+                }
+            else:
                 raise Exception("Requested torrent is not found.")
             
-            curr_torrent_metadata = self.seeding_torrents[info_hash]
-            curr_torrent = TorrentFile(curr_torrent_metadata["torrent_filepath"])
-            # Send handshake msg
-            handshake_msg = Handshake(info_hash).encode()
-            writer.write(handshake_msg)
+            curr_torrent = metainfo_registry.get(info_hash) \
+                            or metainfo_registry.load(curr_torrent_metadata["torrent_filepath"])
+            # Send handshake msg, followed by the pieces we have
+            if piece_manager is not None:
+                have = piece_manager.have
+            else:
+                have = curr_torrent_metadata.get("have") or PeerPieces.full(curr_torrent.number_of_pieces)
+            writer.writelines((Handshake(info_hash, self.peer_id).encode(), BitField(have.bits).encode()))
             await writer.drain()
-
-            # Listening for request after handshaking
-            while True:
-                msg = await asyncio.wait_for(reader.read(4), timeout=10)
-                if not msg:
-                    break  
-                request_length = struct.unpack('>I', msg)[0]
-                msg = await asyncio.wait_for(reader.read(request_length), timeout=10)
-                (id, index, begin, length) = struct.unpack('>bIII', msg)
-                piece = await self.get_piece_for_seeding(curr_torrent, curr_torrent_metadata, index, length)
-                piece_msg = Piece(index, begin, piece).encode()
-                writer.write(piece_msg)
-                await writer.drain()    
-                tqdm.write(f"Sent PIECE with index {index} to peer {addr}")
+            self._add_connection(info_hash, writer)
+
+            # Listening for request after handshaking. Requests may arrive back-to-back
+            # (pipelined): they are queued here and answered in order by `sender`, so a
+            # Cancel for a request that has not been answered yet removes it from the queue.
+            # Only the requests of an unchoked peer are served (see Choker).
+            upload = UploadPeer(writer, handshake_request.peer_id)
+            queue = upload.queue
+            choker = self._get_choker(info_hash)
+            choker.add(upload)
+            wakeup = asyncio.Event()
+            sender = asyncio.create_task(self._serve_requests(
+                writer, curr_torrent, curr_torrent_metadata, upload, wakeup, addr))
+            try:
+                while True:
+                    try:
+                        message = await messages.next(timeout=IDLE_TIMEOUT)
+                    except asyncio.IncompleteReadError:
+                        break
+                    if isinstance(message, Cancel):
+                        try:
+                            queue.remove((message.index, message.begin, message.length))
+                        except ValueError: # Already sent
+                            pass
+                        continue
+                    if isinstance(message, (Interested, NotInterested)):
+                        choker.set_interested(upload, isinstance(message, Interested))
+                        continue
+                    if not isinstance(message, Request) or upload.choked:
+                        continue
+                    index, begin, length = message.index, message.begin, message.length
+                    if index >= curr_torrent.number_of_pieces or length > MAX_BLOCK_SIZE \
+                            or begin + length > curr_torrent.piece_size(index) \
+                            or not have.has(index) \
+                            or len(queue) >= MAX_QUEUED_REQUESTS:
+                        logger.info(f"Ignored invalid request ({index}, {begin}, {length}) from {addr}")
+                        continue
+                    queue.append((index, begin, length))
+                    wakeup.set()
+            finally:
+                sender.cancel()
+                choker.remove(upload)
 
             writer.close()
             await writer.wait_closed()            
@@ -195,72 +337,241 @@ class TorrentPeer:
             logger.info(f"Error caught in handle_client {addr}: {e}")
             raise 
         finally:
+            if info_hash is not None:
+                self._remove_connection(info_hash, writer)
             logger.info(f"Closed connection to {addr}")
+
+    async def _serve_requests(self,
+                              writer: Writer,
+                              curr_torrent: Metainfo,
+                              curr_torrent_metadata: Dict[str, Any],
+                              upload: UploadPeer,
+                              wakeup: asyncio.Event,
+                              addr):
+        """
+        Answer the queued requests of one uploading connection, in order.
+
+        A block that lies within a single file is sent as the Piece header followed by the
+        file range with `loop.sendfile`, so the data never enters Python. Blocks crossing a
+        file boundary (or transports without sendfile support) are read into a new buffer
+        and written with the header by `writelines`, without building a message of both:
+        the transport may keep the buffer until it is sent, so buffers are not reused.
+        """
+        loop = asyncio.get_running_loop()
+        use_sendfile = hasattr(os, "sendfile")
+        queue = upload.queue
+        try:
+            while True:
+                while not queue:
+                    wakeup.clear()
+                    await wakeup.wait()
+                request = queue[0]
+                await self.limits.throttle_upload(curr_torrent.info_hash, request[2])
+                if not queue or queue[0] != request:
+                    continue    # Cancelled (or the peer choked) while waiting for the limit
+                if curr_torrent.info_hash not in self.seeding_torrents \
+                        and curr_torrent.info_hash not in self.leeching_torrents:
+                    raise Exception("The torrent is no longer served")
+                index, begin, length = queue.popleft()
+                if use_sendfile:
+                    storage = self._get_storage(curr_torrent.info_hash, curr_torrent, 
+                                                curr_torrent_metadata["filepath"])
+                    # The file stays open (pinned in the pool) until the send is done
+                    offset = index * curr_torrent.piece_length + begin
+                    with storage.file_range(offset, length) as file_range:
+                        if file_range is not None:
+                            file, file_offset = file_range
+                            writer.write(Piece.encode_header(index, begin, length))
+                            await writer.drain()    # The header goes out before the file data
+                            try:
+                                sent = await loop.sendfile(writer.transport, file, file_offset, length, 
+                                                           fallback=False)
+                            except asyncio.SendfileNotAvailableError:
+                                # The header is out already, finish this block with a plain write
+                                use_sendfile = False
+                                block = await self.get_piece_for_seeding(curr_torrent, curr_torrent_metadata, 
+                                                                         index, begin, length)
+                                sent = len(block)
+                                writer.write(block)
+                                await writer.drain()
+                            if sent != length:
+                                raise Exception(f"Sent {sent} of {length} bytes of block ({index}, {begin})")
+                            upload.uploaded += length
+                            logger.debug("Sent PIECE with index %d to peer %s", index, addr)
+                            continue
+                piece = await self.get_piece_for_seeding(curr_torrent, curr_torrent_metadata, 
+                                                         index, begin, length)
+                if len(piece) != length:
+                    raise Exception(f"Read {len(piece)} of {length} bytes of block ({index}, {begin})")
+                writer.writelines(Piece(index, begin, piece).encode_buffers())
+                await writer.drain()
+                upload.uploaded += length
+                logger.debug("Sent PIECE with index %d to peer %s", index, addr)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"Error caught while sending to {addr}: {e}")
+            writer.close()
+
+    def _is_own_address(self, peer: Dict[str, Any]) -> bool:
+        return int(peer["port"]) == self.port and peer["ip"] in (self.local_ip, "127.0.0.1")
+
+    def _add_connection(self, info_hash: bytes, writer: Writer):
+        self.connections.setdefault(info_hash, set()).add(writer)
+
+    def _remove_connection(self, info_hash: bytes, writer: Writer):
+        writers = self.connections.get(info_hash)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.connections[info_hash]
+
+    def _close_connections(self, info_hash: bytes):
+        """ Close every connection of the torrent, downloading and uploading """
+        for writer in self.connections.pop(info_hash, ()):
+            writer.close()
+
+    def broadcast_have(self, info_hash: bytes, index: int):
+        """ Tell every connected peer of the torrent that we now have piece `index` """
+        have_msg = Have(index).encode()
+        for writer in self.connections.get(info_hash, ()):
+            if not writer.is_closing():
+                writer.write(have_msg)
                 
+    def _get_choker(self, info_hash: bytes) -> Choker:
+        choker = self.chokers.get(info_hash)
+        if choker is None:
+            choker = Choker(seeding=lambda: info_hash not in self.leeching_torrents)
+            self.chokers[info_hash] = choker
+        return choker
+
+    async def _rechoke(self):
+        """ Rechoke the peers of every torrent every RECHOKE_INTERVAL seconds """
+        while True:
+            await asyncio.sleep(RECHOKE_INTERVAL)
+            for info_hash, choker in list(self.chokers.items()):
+                if not choker.peers:
+                    del self.chokers[info_hash]
+                    continue
+                try:
+                    choker.rechoke(RECHOKE_INTERVAL)
+                except Exception as e:
+                    logger.error(f"Error rechoking {info_hash.hex()}: {e}")
+
+    def _get_storage(self, info_hash: bytes, curr_torrent: Metainfo, filepath: str) -> FileStorage:
+        """ The (cached) storage reader of a seeded torrent """
+        storage = self.storages.get(info_hash)
+        if storage is None or storage.root_path != filepath:
+            if storage is not None:
+                storage.close()
+            storage = FileStorage(filepath, curr_torrent.files, curr_torrent.total_length)
+            self.storages[info_hash] = storage
+        return storage
+
     async def get_piece_for_seeding(self, 
-                              curr_torrent: TorrentFile, 
+                              curr_torrent: Metainfo, 
                               curr_torrent_metadata: Dict[str, Any], 
                               index: int, 
-                              length: int):
-        piece_length = curr_torrent.piece_length
-        filepath = curr_torrent_metadata["filepath"]
-
-        if curr_torrent.files == None: # Single file case
-            async with aiofiles.open(filepath, "rb") as file:
-                await file.seek(index * piece_length)
-                piece = await file.read(length)
-        else: 
-            lower_offset = index * piece_length
-            piece = b""
-            reading_length = length
-            for (path, file_length) in curr_torrent.files:
-                if lower_offset < file_length:
-                    async with aiofiles.open(os.path.join(filepath, path), "rb") as file:
-                        await file.seek(lower_offset)
-                        piece += await file.read(reading_length)
-                    if len(piece) == length:
-                        break
-                    reading_length = length - len(piece)
-                    lower_offset = 0
-                else:
-                    lower_offset -= file_length
-        return piece
+                              begin: int,
+                              length: int) -> bytearray:
+        """
+        Read the block `(index, begin, length)` of a seeded torrent into a new buffer, on a
+        worker thread so that a slow disk does not stall the other connections.
+        """
+        storage = self._get_storage(curr_torrent.info_hash, curr_torrent, curr_torrent_metadata["filepath"])
+        offset = index * curr_torrent.piece_length + begin
+        return await asyncio.to_thread(storage.read, offset, length)
+
+    async def recheck(self, 
+                      torrent_filepath: str, 
+                      input_path: str, 
+                      seed: bool = False,
+                      resume: bool = False) -> RecheckResult:
+        """
+        Verify the data at `input_path` against the piece hashes of a torrent.
+
+        Args:
+            seed: Seed the valid pieces (all of them, or only those for partial data).
+            resume: Save the valid pieces as resume data, so leeching the torrent continues
+                from `input_path` instead of starting over.
+        """
+        metainfo = metainfo_registry.load(torrent_filepath)
+        with tqdm(total=metainfo.total_length,
+                  desc=f"Checking {metainfo.name}",
+                  unit="B",
+                  unit_scale=True,
+                  leave=False) as pbar:
+            def progress(checked_bytes: int, total_bytes: int):
+                pbar.update(checked_bytes - pbar.n)
+
+            # Checking reads every byte, keep the event loop serving peers meanwhile
+            result = await asyncio.to_thread(recheck, metainfo, input_path, progress=progress)
+        logger.info(f"Checked {input_path}: {result.have.count}/{metainfo.number_of_pieces} pieces valid, "
+                    f"{result.bytes_checked / 2**20:.0f} MiB at {result.throughput / 2**20:.0f} MiB/s")
+        if seed and result.have.count:
+            await self._seed_after_downloading(input_path, torrent_filepath, 
+                                               None if result.complete else result.have)
+        if resume and not result.complete and result.have.count:
+            result.resume_data().save()
+        return result
+
+    async def recheck_directory(self, 
+                                torrent_dir: str, 
+                                data_dir: str, 
+                                seed: bool = False,
+                                resume: bool = False) -> List[RecheckResult]:
+        """ `recheck` every .torrent file of `torrent_dir` against its data in `data_dir` """
+        return [await self.recheck(torrent_filepath, input_path, seed, resume)
+                for torrent_filepath, input_path in torrents_in_directory(torrent_dir, data_dir)]
     ##### For seeding - END #####
 
     ##### For downloading - BEGIN #####
-    def get_peers(self, torrent_filepath: str) -> Dict[str, Any]:
-        response = self._send_request_to_tracker(torrent_filepath)
-        return response.json().get("peers", {})
+    async def get_peers(self, torrent_filepath: str, event: str = None) -> List[Dict[str, Any]]:
+        response = await self._send_request_to_tracker(torrent_filepath, event)
+        return response.get("peers", [])
     
-    @staticmethod
-    def get_torrents():
+    async def scrape(self, info_hashes: List[str], tracker_url: str = None) -> Dict[str, Dict[str, int]]:
+        """ Swarm counts (`complete`, `incomplete`, `downloaded`) of many torrents, in one request """
+        return await self.tracker.scrape(tracker_url or TRACKER_URL, info_hashes)
+
+    async def get_torrents(self, health: bool = False, **params):
+        """
+        One page of the tracker's catalog. `params` are passed on to the tracker: `limit`,
+        `cursor`, `prefix`, `search` and `fields`. With `health`, the swarm counts of the
+        page (`complete`, `incomplete`, `downloaded`) are added to its torrents, from a
+        single scrape.
+
+        Returns:
+            `{"torrents": {<info_hash>: {...}}, "next_cursor": <cursor or None>}`
+        """
         try:
-            response = requests.get(TRACKER_URL + "/torrents")
-            response.raise_for_status()  # Raises HTTPError for bad responses (4XX or 5XX)
-            torrents = response.json()
+            params = {key: value for key, value in params.items() if value is not None}
+            torrents = await self.tracker.get_torrents(TRACKER_URL, params)
+            if health and torrents["torrents"]:
+                stats = await self.scrape(list(torrents["torrents"]))
+                for info_hash, torrent in torrents["torrents"].items():
+                    torrent.update(stats.get(info_hash, {}))
             return torrents
-        except requests.HTTPError as e:
+        except httpx.HTTPStatusError as e:
             # Handle HTTP errors (e.g., 404, 500, etc.)
             raise RuntimeError(f"HTTP error occurred: {e}") from e
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             # Handle other requests-related issues (e.g., connection errors)
             raise RuntimeError(f"Request error occurred: {e}") from e
-        except ValueError:
+        except ValueError as e:
             # Handle JSON decoding error (e.g., if response is not in JSON format)
             raise RuntimeError("Invalid JSON in response") from e
         except Exception as e:
             raise Exception("Error occured during getting torrents from tracker") from e
 
-    @staticmethod
-    async def get_torrent_by_info_hash(info_hash: bytes):
+    async def get_torrent_by_info_hash(self, info_hash: str):
         try:
-            response = requests.get(TRACKER_URL + f"/torrents/{info_hash}")
-            response.raise_for_status()
+            content = await self.tracker.get_torrent_file(TRACKER_URL, info_hash)
             
             torrent_filepath = os.path.join(DOWNLOAD_DIR, str(uuid4()))
 
             async with aiofiles.open(torrent_filepath, "wb") as f:
-                await f.write(response.content)
+                await f.write(content)
 
             filename = TorrentFile(torrent_filepath).filename + ".torrent"
 
@@ -269,15 +580,15 @@ class TorrentPeer:
             os.rename(torrent_filepath, new_torrent_filepath)    
 
             return new_torrent_filepath
-        except requests.HTTPError as e:
+        except httpx.HTTPStatusError as e:
             # Handle HTTP errors (e.g., 404, 500, etc.)
             raise RuntimeError(f"HTTP error occurred: {e}") from  e
-        except requests.RequestException as e:
+        except httpx.HTTPError as e:
             # Handle other requests-related issues (e.g., connection errors)
             raise RuntimeError(f"Request error occurred: {e}") from e
-        except FileNotFoundError:
+        except FileNotFoundError as e:
             raise FileNotFoundError(f"The file does not exist: {e}") from e
-        except PermissionError:
+        except PermissionError as e:
             raise PermissionError(f"Permission denied. You may not have the right permissions. {e}") from e
         except Exception as e:
             raise Exception(f"Error occured during getting torrent by info_hash from tracker. {e}") from e
@@ -285,8 +596,7 @@ class TorrentPeer:
     async def download_from_peer(self, 
                                  piece_manager: PieceManager, 
                                  torrent: TorrentFile, 
-                                 peer: Dict[str, str],
-                                 pbar: tqdm_asyncio):
+                                 peer: Dict[str, str]):
         """
         Args:
             peer (Dict[str, Any]): 
@@ -295,53 +605,100 @@ class TorrentPeer:
                     "port": 25
                 }
         """
+        pipeline = None
+        peer_pieces = None
+        messages = None
+        writer = None
         try:
             # Open connection
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(peer["ip"], int(peer["port"])), 
+            messages, writer = await asyncio.wait_for(
+                open_peer_connection(peer["ip"], int(peer["port"])), 
                 timeout=5
             ) 
             tqdm.write(f"Connected to ({peer['ip']}, {peer['port']})")
 
             piece_manager.active_peers.append(peer)
-            # Create handshake msg
-            handshake_msg = Handshake(torrent.info_hash).encode()
-            # Send handshake msg
-            writer.write(handshake_msg)
+            pipeline = RequestPipeline(writer)
+            if isinstance(messages, PeerWireProtocol):
+                # Receive the blocks we requested straight into their pieces
+                messages.block_buffer = lambda index, begin, length: \
+                    piece_manager.block_buffer(index, begin, length, pipeline)
+            peer_pieces = PeerPieces(piece_manager.number_of_pieces)
+            # Send handshake msg, followed by the pieces we have
+            writer.writelines((Handshake(torrent.info_hash, self.peer_id).encode(), 
+                               BitField(piece_manager.have.bits).encode()))
             await writer.drain()
 
             # Wait for Handshake response from peer
-            response = await asyncio.wait_for(reader.read(68), timeout=10)
-            if not response:
-                raise Exception(f"Connection to {peer} closed.")
-            if not Handshake.is_valid(response):
-                raise Exception("Invalid handshake response")
-
-            # Start requesting
+            remote_peer_id = (await messages.handshake(timeout=10)).peer_id
+            if remote_peer_id == self.peer_id:
+                raise Exception("Connected to ourselves.")
+            self._add_connection(torrent.info_hash, writer)
+
+            # Start requesting once the peer unchokes us. Keep up to `pipeline.depth` requests
+            # in flight for pieces the peer has, and match the Piece replies to them in
+            # whatever order they come back.
+            choked = True
+            interested = False
             while not piece_manager.completed:
-                request_msg = piece_manager.get_request_msg()
-                if request_msg is None:
+                # The new requests go out together, in a single write
+                requests = []
+                while not choked and pipeline.can_request():
+                    request = piece_manager.get_request_msg(pipeline, peer_pieces)
+                    if request is None:
+                        break
+                    pipeline.add(request)
+                    requests.append(request.encode())
+                if requests:
+                    writer.writelines(requests)
+                # We are interested as long as the peer has pieces we miss
+                wanted = bool(pipeline) or piece_manager.wants_from(peer_pieces)
+                if wanted != interested:
+                    interested = wanted
+                    writer.write((Interested() if wanted else NotInterested()).encode())
+                if not pipeline and not choked and peer_pieces.is_seed:
                     logger.info(f"No more pieces to request from {peer}.")
                     break
-                # Send request
-                writer.write(request_msg)
                 await writer.drain()
-                # Response length
-                msg = await asyncio.wait_for(reader.read(4), timeout=10)
-                if not msg:
-                    raise Exception(f"Connection to {peer} closed.")
-                # ### Check if fail -> mark pending_pieces
-
-                response_len = struct.unpack('>I', msg[:4])[0]
-                # Piece 
-                piece = await asyncio.wait_for(reader.read(response_len), timeout=10)
-                if not piece:
-                    raise Exception(f"Connection to {peer} closed.")
-                idx = await piece_manager.receive_piece(piece)
-                if idx:
-                    tqdm.write(f"Received piece with index {idx} from {peer}\n")
-                    pbar.update(1)
-                    pbar.refresh()
+
+                # Response length. While nothing is requested we are only waiting for the
+                # peer to announce new pieces, so idling is fine as long as we keep alive.
+                try:
+                    message = await messages.next(timeout=10 if pipeline else KEEP_ALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if pipeline:
+                        raise
+                    writer.write(KeepAlive().encode())
+                    continue
+
+                if isinstance(message, Piece):
+                    if pipeline.complete(message.index, message.begin, len(message.block)) is None:
+                        continue
+                    # What the peer gives us counts for what we give it back (tit-for-tat)
+                    choker = self.chokers.get(torrent.info_hash)
+                    if choker is not None:
+                        choker.received(remote_peer_id, len(message.block))
+                    idx = await piece_manager.receive_piece(message, pipeline)
+                    if idx is not None:
+                        logger.debug("Received piece with index %d from %s", idx, peer)
+                    # Reading stops while over the download limit, which slows the peer down
+                    await self.limits.throttle_download(torrent.info_hash, len(message.block))
+                elif isinstance(message, Have):
+                    piece_manager.peer_has(peer_pieces, message.index)
+                elif isinstance(message, BitField):
+                    piece_manager.remove_peer(peer_pieces)
+                    peer_pieces.set_bitfield(message.bitfield.tobytes())
+                    piece_manager.add_peer(peer_pieces)
+                elif isinstance(message, Unchoke):
+                    choked = False
+                elif isinstance(message, Choke):
+                    # The peer drops our requests: pick their blocks again, from anyone. A
+                    # block being received in place stops being written to its piece first.
+                    choked = True
+                    if isinstance(messages, PeerWireProtocol):
+                        messages.drop_block()
+                    for request in pipeline.drain():
+                        piece_manager.release_request(request, pipeline)
                 
             writer.close()
             await writer.wait_closed()
@@ -357,8 +714,19 @@ class TorrentPeer:
         except Exception as e:
             logger.error(f"An unexpected error occurred at download_from_peer: {e}")
         finally:
+            if isinstance(messages, PeerWireProtocol):
+                messages.drop_block()
+            if pipeline is not None:
+                for request in pipeline.drain():
+                    piece_manager.release_request(request, pipeline)
+            if peer_pieces is not None:
+                piece_manager.remove_peer(peer_pieces)
+            if writer is not None:
+                self._remove_connection(torrent.info_hash, writer)
+                writer.close()
             if piece_manager and (peer in piece_manager.active_peers):
                 piece_manager.active_peers.remove(peer)
+                self.announcer.peers_changed(torrent.info_hash)
             
 
     async def download(self, torrent_filepath: str, pbar_position: int, output_dir: str = None):
@@ -366,49 +734,106 @@ class TorrentPeer:
         torrent = TorrentFile(torrent_filepath)
         tqdm.write(f"Start downloading {torrent.info_hash}")
 
-        piece_manager = PieceManager(torrent, output_dir)
-        total_pieces = len(piece_manager.pieces_status)
+        # Continue where an earlier run stopped if its state was saved
+        piece_manager = PieceManager(torrent, output_dir, resume=ResumeData.load(torrent.info_hash))
+        await piece_manager.restore()
+        # Serve the downloaded pieces to other leechers while downloading, reading them from
+        # the storage the download writes to (it stays in use for seeding afterwards)
+        self.leeching_torrents[torrent.info_hash] = piece_manager
+        self.storages[torrent.info_hash] = piece_manager.storage
+        total_pieces = piece_manager.number_of_pieces
         with tqdm_asyncio(total=total_pieces, 
+                          initial=piece_manager.downloaded_pieces,
                           desc=f"Downloading {os.path.basename(piece_manager.output_name)}", 
                           position=pbar_position, 
                           leave=False,
                           unit="piece") as pbar:
+            # Set once the download completes, or enough pieces were written to save its state
+            wakeup = asyncio.Event()
+            unsaved = 0
+            # Pieces are announced and counted once they are on disk
+            def piece_written(index: int):
+                nonlocal unsaved
+                self.broadcast_have(torrent.info_hash, index)
+                pbar.update(1)
+                pbar.refresh()
+                unsaved += 1
+                if piece_manager.completed or unsaved >= RESUME_PIECES:
+                    wakeup.set()
+            piece_manager.on_piece_written = piece_written
+
+            # Connect to the peers of every announce that we are not connected to yet
+            def connect(peers: List[Dict[str, Any]]):
+                for peer in peers:
+                    if self._is_own_address(peer):
+                        continue
+                    if peer not in piece_manager.active_peers:
+                        asyncio.create_task(self.download_from_peer(piece_manager, torrent, peer))
             try:
+                if not piece_manager.completed:
+                    self.announcer.add(torrent.info_hash, torrent.tracker_url,
+                                       on_peers=connect,
+                                       peer_count=lambda: len(piece_manager.active_peers))
                 while not piece_manager.completed:
-                    peers = self.get_peers(torrent_filepath)
-                    for peer in peers:
-                        if peer not in piece_manager.active_peers:
-                            asyncio.create_task(self.download_from_peer(piece_manager, torrent, peer, pbar))
-                    await asyncio.sleep(INTERVAL)
-
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), timeout=RESUME_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    wakeup.clear()
+                    if not piece_manager.completed:
+                        unsaved = 0
+                        await piece_manager.save_resume_data()
+
+                await piece_manager.disk.close()
+                ResumeData.discard(torrent.info_hash)
                 logger.info("Download successfully!")
                 logger.info(f"File is saved at {piece_manager.output_name}.")
                 # Start seeding file after downloading successfully.
-                self._seed_after_downloading(
+                await self._seed_after_downloading(
                     input_path = piece_manager.output_name,
-                    input_torrent_filepath = piece_manager.torrent.filepath) 
+                    input_torrent_filepath = piece_manager.torrent.filepath,
+                    event = "completed") 
                 logger.info(f"Start seeding file after downloading successfully.")
             except Exception as e:
                 tqdm.write(f"Exception occured at download function: {e}")
+            finally:
+                self.leeching_torrents.pop(torrent.info_hash, None)
+                if not piece_manager.completed:
+                    if torrent.info_hash not in self.seeding_torrents:
+                        await self.announcer.remove(torrent.info_hash)
+                    # Everything queued is on disk after closing, so the saved state is exact
+                    await piece_manager.disk.close()
+                    await piece_manager.save_resume_data()
+                    if torrent.info_hash not in self.seeding_torrents:
+                        self._close_connections(torrent.info_hash)
+                    if self.storages.get(torrent.info_hash) is piece_manager.storage:
+                        del self.storages[torrent.info_hash]
+                    piece_manager.storage.close()
 
     async def start_seeding(self):
         try:
             """
             Main coroutine to start the server.
             """
-            server = await asyncio.start_server(self.handle_client, host='0.0.0.0', port=self.port)
+            server = await start_peer_server(self.handle_client, host='0.0.0.0', port=self.port)
             logger.info(f"Start seeding on port {self.port}")
             addr = server.sockets[0].getsockname()
 
-            async with server:
-                await server.serve_forever()
+            rechoker = asyncio.create_task(self._rechoke())
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                rechoker.cancel()
         except KeyboardInterrupt:
             tqdm.write("Program terminated using Ctr+C")
         except Exception as e:
             tqdm.write(f"Exception appeared when start server: {e}")
         finally:
-            for value in self.seeding_torrents.values():
-                self._send_request_to_tracker(value["torrent_filepath"], "stopped")
+            for storage in self.storages.values():
+                storage.close()
+            await self.announcer.stop()
+            await self.tracker.close()
     ##### For downloading - BEGIN #####
 
 
@@ -17,8 +17,19 @@
 # limitations under the License.
 
 import struct
+from typing import Dict, Optional, Tuple, Type
 import bitstring
 
+# Layouts of the messages, compiled once. `_BLOCK` is the payload of Request and Cancel.
+_LENGTH = struct.Struct('>I')
+_SIGNAL = struct.Struct('>Ib')
+_HANDSHAKE = struct.Struct('>B19s8s20s20s')
+_HAVE = struct.Struct('>IbI')
+_REQUEST = struct.Struct('>IbIII')
+_BLOCK = struct.Struct('>III')
+_PIECE_HEADER = struct.Struct('>IbII')
+_PIECE_PAYLOAD = struct.Struct('>II')
+
 class PeerMessage:
     """
     A message between two peers.
@@ -68,6 +79,14 @@ class PeerMessage:
         """
         pass
 
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        """
+        Decodes the payload of a message (what follows its message ID) into an
+        instance for the implementing type. Messages without payload by default.
+        """
+        return cls()
+
 
 class Handshake(PeerMessage):
     """
@@ -89,7 +108,7 @@ class Handshake(PeerMessage):
     """
     length = 49 + 19
 
-    def __init__(self, info_hash: bytes | str):
+    def __init__(self, info_hash: bytes | str, peer_id: bytes = b"\x00" * 20):
         """
         Construct the handshake message
 
@@ -99,19 +118,19 @@ class Handshake(PeerMessage):
         if isinstance(info_hash, str):
             info_hash = info_hash.encode('utf-8')
         self.info_hash: bytes = info_hash
+        self.peer_id: bytes = peer_id
 
     def encode(self) -> bytes:
         """
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        return struct.pack(
-            '>B19s8s20s20s',
+        return _HANDSHAKE.pack(
             19,                         # Single byte (B)
             b'BitTorrent protocol',     # String 19s
             b"\x00" * 8,                # Reserved 8x (pad byte, no value)
             self.info_hash,             # String 20s
-            b"\x00" * 20)               # String 20s
+            self.peer_id)               # String 20s
 
     @classmethod
     def decode(cls, data: bytes):
@@ -121,8 +140,8 @@ class Handshake(PeerMessage):
         """
         if len(data) < (49 + 19):
             raise ValueError("Invalid Handshake message length")
-        parts = struct.unpack('>B19s8s20s20s', data)
-        return cls(info_hash=parts[3])
+        parts = _HANDSHAKE.unpack(data)
+        return cls(info_hash=parts[3], peer_id=parts[4])
     
     @classmethod
     def is_valid(cls, data: bytes):
@@ -147,7 +166,7 @@ class KeepAlive(PeerMessage):
         return 'KeepAlive'
     
     def encode(self) -> bytes:
-        return struct.pack('>I', 0) # Message length = 0
+        return _LENGTH.pack(0) # Message length = 0
     
 class Choke(PeerMessage):
     """
@@ -161,8 +180,7 @@ class Choke(PeerMessage):
         return 'Choke'
     
     def encode(self) -> bytes:
-        return struct.pack(">Ib",
-                           1,       #Message length
+        return _SIGNAL.pack(1,       #Message length
                             PeerMessage.Choke)
 
 class Unchoke(PeerMessage):
@@ -177,8 +195,7 @@ class Unchoke(PeerMessage):
         return 'Unchoke'
     
     def encode(self):
-        return struct.pack(">Ib",
-                           1,       #Message length
+        return _SIGNAL.pack(1,       #Message length
                             PeerMessage.Unchoke)
 
 class Interested(PeerMessage):
@@ -196,9 +213,8 @@ class Interested(PeerMessage):
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        return struct.pack('>Ib',
-                           1,  # Message length
-                           PeerMessage.Interested)
+        return _SIGNAL.pack(1,  # Message length
+                            PeerMessage.Interested)
 
     def __str__(self):
         return 'Interested'
@@ -211,8 +227,10 @@ class BitField(PeerMessage):
     Message format:
         <len=0001+X><id=5><bitfield>
     """
-    def __init__(self, bitfield: bitstring.BitArray):
+    def __init__(self, bitfield: bitstring.BitArray | bytes):
         # self.bitfield = bitstring.BitArray(bytes=data) # Original code
+        if isinstance(bitfield, (bytes, bytearray)):
+            bitfield = bitstring.BitArray(bytes(bitfield))
         self.bitfield = bitfield
 
     def encode(self) -> bytes:
@@ -220,11 +238,11 @@ class BitField(PeerMessage):
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        bitfield_len = len(self.bitfield) / 8
-        return struct.pack(f'>Ib{bitfield_len}s',
-                           1 + bitfield_len,
+        bitfield = self.bitfield.tobytes()
+        return struct.pack(f'>Ib{len(bitfield)}s',
+                           1 + len(bitfield),
                            PeerMessage.BitField,
-                           self.bitfield)
+                           bitfield)
     # Original code
     # @classmethod
     # def decode(cls, data: bytes):
@@ -242,10 +260,14 @@ class BitField(PeerMessage):
         if message_id != cls.BitField:
             raise TypeError("Not a BitField message")
 
-        bitfield = bitstring.BitArray(bytes = data[5:5 + bitfield_length])
+        bitfield = bitstring.BitArray(bytes(data[5:5 + bitfield_length]))
 
         return BitField(bitfield)
 
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(bytes(payload))
+
     def __str__(self):
         return 'BitField'
 
@@ -261,6 +283,10 @@ class NotInterested(PeerMessage):
     def __str__(self):
         return 'NotInterested'
 
+    def encode(self) -> bytes:
+        return _SIGNAL.pack(1,  # Message length
+                            PeerMessage.NotInterested)
+
 
 class Have(PeerMessage):
     """
@@ -271,16 +297,19 @@ class Have(PeerMessage):
         self.index = index
 
     def encode(self):
-        return struct.pack('>IbI',
-                           5,  # Message length
-                           PeerMessage.Have,
-                           self.index)
+        return _HAVE.pack(5,  # Message length
+                          PeerMessage.Have,
+                          self.index)
 
     @classmethod
     def decode(cls, data: bytes):
-        index = struct.unpack('>IbI', data)[2]
+        index = _HAVE.unpack(data)[2]
         return cls(index)
 
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(_LENGTH.unpack(payload)[0])
+
     def __str__(self):
         return 'Have'
 
@@ -309,19 +338,22 @@ class Request(PeerMessage):
         self.length = length
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           PeerMessage.Request,
-                           self.index,
-                           self.begin,
-                           self.length)
+        return _REQUEST.pack(13,
+                             PeerMessage.Request,
+                             self.index,
+                             self.begin,
+                             self.length)
 
     @classmethod
     def decode(cls, data: bytes):
         # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
+        parts = _REQUEST.unpack(data)
         return cls(parts[2], parts[3], parts[4])
 
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(*_BLOCK.unpack(payload))
+
     def __str__(self):
         return 'Request'
 
@@ -354,20 +386,37 @@ class Piece(PeerMessage):
         self.block = block
 
     def encode(self):
-        message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
-                           PeerMessage.Piece,
-                           self.index,
-                           self.begin,
-                           self.block)
+        # The block may be any bytes-like object (e.g. a memoryview over a read buffer)
+        return Piece.encode_header(self.index, self.begin, len(self.block)) + self.block
+
+    def encode_buffers(self) -> Tuple[bytes, bytes]:
+        """
+        The header and the block as separate buffers, to be sent with `writelines`
+        without copying the block into a new message.
+        """
+        return Piece.encode_header(self.index, self.begin, len(self.block)), self.block
+
+    @staticmethod
+    def encode_header(index: int, begin: int, block_length: int) -> bytes:
+        """
+        Encodes the 13 bytes preceding the block, so the block itself can be sent
+        separately (e.g. with sendfile).
+        """
+        return _PIECE_HEADER.pack(Piece.length + block_length,
+                                  PeerMessage.Piece,
+                                  index,
+                                  begin)
 
     @classmethod
     def decode(cls, data: bytes):
-        length = struct.unpack('>I', data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's',
-                              data[:length+4])
-        return cls(parts[2], parts[3], parts[4])
+        length, _, index, begin = _PIECE_HEADER.unpack_from(data)
+        return cls(index, begin, data[4 + Piece.length:4 + length])
+
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        """ The block is a view of `payload`, not a copy """
+        index, begin = _PIECE_PAYLOAD.unpack_from(payload)
+        return cls(index, begin, payload[_PIECE_PAYLOAD.size:])
 
     def __str__(self):
         return 'Piece'
@@ -387,18 +436,46 @@ class Cancel(PeerMessage):
         self.length = length
 
     def encode(self):
-        return struct.pack('>IbIII',
-                           13,
-                           PeerMessage.Cancel,
-                           self.index,
-                           self.begin,
-                           self.length)
+        return _REQUEST.pack(13,
+                             PeerMessage.Cancel,
+                             self.index,
+                             self.begin,
+                             self.length)
 
     @classmethod
     def decode(cls, data: bytes):
         # Tuple with (message length, id, index, begin, length)
-        parts = struct.unpack('>IbIII', data)
+        parts = _REQUEST.unpack(data)
         return cls(parts[2], parts[3], parts[4])
 
+    @classmethod
+    def from_payload(cls, payload: memoryview):
+        return cls(*_BLOCK.unpack(payload))
+
     def __str__(self):
-        return 'Cancel'
\ No newline at end of file
+        return 'Cancel'
+
+
+# Message class of every message ID, used to decode received messages
+MESSAGE_TYPES: Dict[int, Type[PeerMessage]] = {
+    PeerMessage.Choke: Choke,
+    PeerMessage.Unchoke: Unchoke,
+    PeerMessage.Interested: Interested,
+    PeerMessage.NotInterested: NotInterested,
+    PeerMessage.Have: Have,
+    PeerMessage.BitField: BitField,
+    PeerMessage.Request: Request,
+    PeerMessage.Piece: Piece,
+    PeerMessage.Cancel: Cancel,
+}
+
+def decode_message(body: memoryview) -> Optional[PeerMessage]:
+    """
+    Decodes a message without its length prefix (`<message ID><payload>`). Returns None
+    for message IDs that are not supported. Raises `struct.error` if the payload does not
+    have the size of its message.
+    """
+    message_type = MESSAGE_TYPES.get(body[0])
+    if message_type is None:
+        return None
+    return message_type.from_payload(body[1:])
@@ -1,114 +1,481 @@
-from torrent_peer.torrent_file import TorrentFile
-from typing import List
-import struct
+from torrent_peer.torrent_file import TorrentFile, Metainfo
+from typing import Any, Callable, Container, Dict, List, Optional, Tuple
+from functools import partial as bind
 import os
-from torrent_peer.peer_message import Request, PeerMessage
-from enum import Enum
+from torrent_peer.peer_message import Request, Piece
+from enum import IntEnum
 import hashlib
-import aiofiles
+import asyncio
+import logging
+from torrent_peer.piece_picker import PiecePicker, PeerPieces
+from torrent_peer.request_pipeline import RequestPipeline
 from torrent_peer.utils import get_unique_filename
+from torrent_peer.storage import FileStorage, open_storage
+from torrent_peer.disk_io import DiskIO
+from torrent_peer.resume import ResumeData
+from torrent_peer.config_loader import BLOCK_SIZE
 
-class PieceStatus(Enum):
+logger = logging.getLogger(__name__)
+
+# Maximum number of connections a block is requested on at the same time in endgame mode
+MAX_ENDGAME_REQUESTERS = 3
+
+class PieceStatus(IntEnum):
     EMPTY = 0
     PENDING = 1
     DOWNLOADED = 2
+    VERIFYING = 3   # Every block has arrived, the piece is being hashed
+
+class BlockStatus:
+    MISSING = 0
+    REQUESTED = 1
+    RECEIVED = 2
+
+class PartialPiece:
+    """
+    A piece that is being downloaded block by block.
+
+    Blocks are assembled into a single buffer of the piece's size, which is hashed once
+    every block has arrived. A block may also be received in place (`block_buffer`):
+    until it has arrived, copies of it from other connections are dropped, so the
+    buffer is never hashed while it is still being written to.
+    """
+    def __init__(self, index: int, size: int, block_size: int) -> None:
+        self.index = index
+        self.size = size
+        self.block_size = block_size
+        self.number_of_blocks = (size + block_size - 1) // block_size
+        self.blocks = bytearray(self.number_of_blocks) # BlockStatus of each block
+        self.received = 0
+        self.missing = self.number_of_blocks
+        self.data = bytearray(size)
+        self.receiving: Dict[int, Any] = {}  # Blocks received in place, by receiving connection
+
+    def block_length(self, block: int) -> int:
+        return min(self.block_size, self.size - block * self.block_size)
+
+    def next_request(self, outstanding: Container[Tuple[int, int]]) -> Request:
+        """ Next MISSING block to request """
+        block = self.blocks.find(BlockStatus.MISSING)
+        if block == -1:
+            return None
+        self.missing -= 1
+        self.blocks[block] = BlockStatus.REQUESTED
+        return Request(self.index, block * self.block_size, self.block_length(block))
+
+    def duplicate_request(self, 
+                          outstanding: Container[Tuple[int, int]], 
+                          requesters: Dict[Tuple[int, int], list], 
+                          max_requesters: int) -> Request:
+        """ A REQUESTED block that is not in `outstanding` and has fewer than `max_requesters` """
+        block = self.blocks.find(BlockStatus.REQUESTED)
+        while block != -1:
+            key = (self.index, block * self.block_size)
+            if key not in outstanding and len(requesters.get(key, ())) < max_requesters:
+                return Request(self.index, key[1], self.block_length(block))
+            block = self.blocks.find(BlockStatus.REQUESTED, block + 1)
+        return None
+
+    def release(self, begin: int) -> None:
+        block = begin // self.block_size
+        if self.blocks[block] == BlockStatus.REQUESTED:
+            self.blocks[block] = BlockStatus.MISSING
+            self.missing += 1
+
+    def reset(self, outstanding: Container[int]) -> None:
+        """
+        Forget every received block after the piece failed its hash check. The blocks
+        whose `begin` is in `outstanding` (still requested from some peer) stay REQUESTED
+        and are replaced when their copy arrives, the others are MISSING again.
+        """
+        self.received = 0
+        self.missing = 0
+        for block in range(self.number_of_blocks):
+            if block * self.block_size in outstanding:
+                self.blocks[block] = BlockStatus.REQUESTED
+            else:
+                self.blocks[block] = BlockStatus.MISSING
+                self.missing += 1
+
+    def block_buffer(self, begin: int, length: int, owner: Any) -> Optional[memoryview]:
+        """
+        The place of a block in the piece buffer, for `owner` to receive it into, or None
+        if the block was received (or is being received in place) already.
+        """
+        if begin % self.block_size or begin >= self.size:
+            return None
+        block = begin // self.block_size
+        if length != self.block_length(block) or block in self.receiving \
+                or self.blocks[block] == BlockStatus.RECEIVED:
+            return None
+        self.receiving[block] = owner
+        return memoryview(self.data)[begin:begin + length]
+
+    def stop_receiving(self, begin: int, owner: Any) -> None:
+        """ `owner` will not finish receiving the block in place (its connection dropped) """
+        block = begin // self.block_size
+        if self.receiving.get(block) is owner:
+            del self.receiving[block]
+
+    def add_block(self, begin: int, data: bytes) -> bool:
+        """ Store a received block. Returns False if it does not fit the piece's layout. """
+        if begin % self.block_size or begin >= self.size:
+            return False
+        block = begin // self.block_size
+        if len(data) != self.block_length(block):
+            return False
+        if block in self.receiving:
+            if not (isinstance(data, memoryview) and data.obj is self.data):
+                return True     # Another copy, still being received in place
+            del self.receiving[block]
+        elif self.blocks[block] != BlockStatus.RECEIVED:
+            self.data[begin:begin + len(data)] = data
+        if self.blocks[block] != BlockStatus.RECEIVED:
+            if self.blocks[block] == BlockStatus.MISSING:
+                self.missing -= 1
+            self.blocks[block] = BlockStatus.RECEIVED
+            self.received += 1
+        return True
+
+    @property
+    def is_complete(self) -> bool:
+        return self.received == self.number_of_blocks
 
 class PieceManager:
-    def __init__(self, torrent: TorrentFile, output_dir: str) -> None:
+    """
+    Downloads the pieces of one torrent into `output_dir`.
+
+    With `resume` (the saved state of an earlier run) the existing output is reused instead
+    of a new one being created; `restore` then works out which of its pieces are done.
+    """
+    def __init__(self, 
+                 torrent: TorrentFile, 
+                 output_dir: str, 
+                 block_size: int = BLOCK_SIZE,
+                 resume: ResumeData = None) -> None:
         self.torrent: TorrentFile = torrent
-        self.pieces_status: List[int] = [PieceStatus.EMPTY for _ in range(int(self.torrent.number_of_pieces))] 
-        self.completed = False
-        self.output_name: str = get_unique_filename(
-            os.path.join(output_dir, self.torrent.torrent_data[b"info"][b"name"].decode("utf-8"))
-        )
-        self.haveMultiFile =  True if torrent.files else False
+        self.block_size = block_size
+        self.partial_pieces: Dict[int, PartialPiece] = {}
+        # Connections each outstanding block has been requested on
+        self.requesters: Dict[Tuple[int, int], List[RequestPipeline]] = {}
+        self.metainfo: Metainfo = torrent.metainfo
+        # One PieceStatus byte per piece. EMPTY pieces are kept by `picker` ordered by how many
+        # connected peers have them, the PENDING and VERIFYING pieces are exactly the keys of
+        # `partial_pieces` and `have` is the bitfield of the DOWNLOADED pieces that are
+        # written to disk (the others are still queued in `disk`).
+        self.number_of_pieces: int = self.metainfo.number_of_pieces
+        self.pieces_status = bytearray(self.number_of_pieces)
+        self.picker = PiecePicker(self.number_of_pieces)
+        self.have = PeerPieces(self.number_of_pieces)
+        # Pieces each connected peer has and `have` misses, kept up to date as pieces arrive
+        self.wanted: Dict[PeerPieces, int] = {}
+        self.downloaded_pieces = 0
+        self.completed = self.number_of_pieces == 0
+        if resume is not None and not os.path.exists(resume.output_name):
+            logger.info(f"{resume.output_name} no longer exists, downloading from scratch.")
+            resume = None
+        self.resume = resume
+        if resume is not None:
+            self.output_name: str = resume.output_name
+        else:
+            self.output_name: str = get_unique_filename(os.path.join(output_dir, self.metainfo.name))
+        self.haveMultiFile =  True if self.metainfo.files else False
         self.active_peers = []
+        self.total_length = self.metainfo.total_length
 
-        if self.haveMultiFile: # In case of multi files
-            # Calculate file offset + total length
-            self.file_limit = []
-            self.total_length = 0
-            for (path, length) in torrent.files:
-                self.total_length += length
-                self.file_limit.append((path, length, self.total_length))
-
-            os.makedirs(self.output_name, exist_ok=True) 
-            for (rel_path, length) in torrent.files: 
-                filepath = os.path.join(self.output_name, rel_path)
-                os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                with open(filepath, "wb") as file:
-                    file.truncate(length)
-        else:
-            length = self.torrent.torrent_data[b"info"][b"length"]
-            with open(self.output_name, "wb") as file:
+        # Create the output files with their final size. Files of a resumed download are
+        # kept, unless one is missing.
+        for filepath, length in zip(self.output_files, self.file_lengths):
+            os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+            if resume is not None and os.path.exists(filepath):
+                if os.path.getsize(filepath) != length:
+                    with open(filepath, "r+b") as file:
+                        file.truncate(length)
+                continue
+            with open(filepath, "wb") as file:
                 file.truncate(length)
+        # Opened once for the whole download, and reused to upload the file afterwards
+        self.storage: FileStorage = open_storage(self.output_name, self.metainfo.files, 
+                                                 self.total_length, writable=True)
+        self.disk = DiskIO(self.storage)
+        # Called with the index of every piece once it is written to disk
+        self.on_piece_written: Callable[[int], None] = None
+
+    @property
+    def output_files(self) -> List[str]:
+        if self.haveMultiFile:
+            return [os.path.join(self.output_name, rel_path) for rel_path, _ in self.metainfo.files]
+        return [self.output_name]
+
+    @property
+    def file_lengths(self) -> List[int]:
+        if self.haveMultiFile:
+            return [length for _, length in self.metainfo.files]
+        return [self.total_length]
 
     @property
     def percent_of_downloaded(self):
-        """Calculate the percentage of EMPTY pieces."""
-        total_pieces = len(self.pieces_status)
-        empty_pieces = self.pieces_status.count(PieceStatus.EMPTY)
-        return (1 - empty_pieces / total_pieces) * 100 if total_pieces > 0 else 0
-
-    def get_request_msg(self) -> Request:
-        piece_length = self.torrent.piece_length
-        length = self.total_length if self.haveMultiFile \
-                else self.torrent.torrent_data[b"info"][b"length"]
-        # Request for EMPTY Piece first before requesting for PENDING Piece
-        for status in (PieceStatus.EMPTY, PieceStatus.PENDING):
-            for i, value in enumerate(self.pieces_status):
-                if value == status:
-                    self.pieces_status[i] = PieceStatus.PENDING
-                    requested_length = length % piece_length \
-                                        if i == self.torrent.number_of_pieces - 1 \
-                                        else piece_length
-                    return Request(i, 0, requested_length).encode()
+        """Calculate the percentage of DOWNLOADED pieces."""
+        total_pieces = self.number_of_pieces
+        return self.downloaded_pieces / total_pieces * 100 if total_pieces > 0 else 0
+
+    @property
+    def endgame(self) -> bool:
+        """
+        True once every remaining block has been requested at least once. From then on the
+        blocks still in flight are also requested from other peers (at most
+        `MAX_ENDGAME_REQUESTERS` at a time) and the slower copies are cancelled.
+        """
+        return self.picker.size == 0 and not any(partial.missing for partial in self.partial_pieces.values())
+
+    def get_request_msg(self, 
+                        pipeline: RequestPipeline, 
+                        peer_pieces: PeerPieces = None) -> Request:
+        """
+        Pick the next block to request from a peer.
+
+        Blocks of pieces that are already in progress come first so that pieces complete
+        (and their buffers are freed) as early as possible. After that the rarest EMPTY
+        piece the peer has is started, and in endgame mode blocks already requested from
+        other peers are handed out again.
+
+        Args:
+            pipeline: The requests outstanding on the calling connection; they are never
+                handed out again to that same connection.
+            peer_pieces: The pieces the peer has (None means every piece).
+        """
+        request = self._next_request(pipeline, peer_pieces)
+        if request is not None:
+            self.requesters.setdefault((request.index, request.begin), []).append(pipeline)
+        return request
+
+    def _next_request(self, pipeline: RequestPipeline, peer_pieces: PeerPieces) -> Request:
+        def peer_has(index):
+            return peer_pieces is None or peer_pieces.has(index)
+
+        for partial in self.partial_pieces.values():
+            if partial.missing and peer_has(partial.index):
+                request = partial.next_request(pipeline)
+                if request is not None:
+                    return request
+
+        i = self.picker.pick(peer_pieces)
+        if i is not None:
+            self.picker.remove(i)
+            self.pieces_status[i] = PieceStatus.PENDING
+            partial = PartialPiece(i, self.metainfo.piece_size(i), self.block_size)
+            self.partial_pieces[i] = partial
+            return partial.next_request(pipeline)
+
+        if self.endgame:
+            for partial in self.partial_pieces.values():
+                if peer_has(partial.index):
+                    request = partial.duplicate_request(pipeline, self.requesters, MAX_ENDGAME_REQUESTERS)
+                    if request is not None:
+                        return request
         return None
+
+    def release_request(self, request: Request, pipeline: RequestPipeline) -> None:
+        """ Give back a request that will never be answered so the block is picked again first """
+        key = (request.index, request.begin)
+        partial = self.partial_pieces.get(request.index)
+        if partial is not None:
+            partial.stop_receiving(request.begin, pipeline)
+        requesters = self.requesters.get(key)
+        if requesters is not None and pipeline in requesters:
+            requesters.remove(pipeline)
+            if requesters:
+                return  # Still requested from another peer
+            del self.requesters[key]
+        if partial is not None:
+            partial.release(request.begin)
+
+    def block_buffer(self, index: int, begin: int, length: int, pipeline: RequestPipeline) -> Optional[memoryview]:
+        """
+        Where to receive a block requested on `pipeline` in place: its slice of the piece
+        buffer. None if the block is not outstanding there or must not be received in place.
+        """
+        if (index, begin) not in pipeline:
+            return None
+        partial = self.partial_pieces.get(index)
+        if partial is None:
+            return None
+        return partial.block_buffer(begin, length, pipeline)
+
+    def _cancel_piece_requests(self, partial: PartialPiece) -> None:
+        """ Cancel every request for the blocks of `partial` still outstanding on any connection """
+        for begin in range(0, partial.size, partial.block_size):
+            for pipeline in self.requesters.pop((partial.index, begin), ()):
+                pipeline.cancel(partial.index, begin)
     
+    def add_peer(self, peer_pieces: PeerPieces) -> None:
+        """ Count the pieces of a newly connected peer (after its BitField) """
+        for index in peer_pieces.indices():
+            self.picker.increment(index)
+        self.wanted[peer_pieces] = bin(int.from_bytes(peer_pieces.bits, "big")
+                                       & ~int.from_bytes(self.have.bits, "big")).count("1")
+
+    def peer_has(self, peer_pieces: PeerPieces, index: int) -> None:
+        """ Record a Have message from a connected peer """
+        if peer_pieces.add(index):
+            self.picker.increment(index)
+            if not self.have.has(index):
+                self.wanted[peer_pieces] = self.wanted.get(peer_pieces, 0) + 1
+
+    def wants_from(self, peer_pieces: PeerPieces) -> bool:
+        """ Whether the peer has pieces we do not have yet, i.e. we are interested in it """
+        return self.wanted.get(peer_pieces, 0) > 0
+
+    def remove_peer(self, peer_pieces: PeerPieces) -> None:
+        """ Forget the pieces of a disconnected peer """
+        for index in peer_pieces.indices():
+            self.picker.decrement(index)
+        self.wanted.pop(peer_pieces, None)
+
+    def _add_have(self, index: int) -> bool:
+        """ Add `index` to `have`, and take it off what the peers that have it can give us """
+        if not self.have.add(index):
+            return False
+        for peer_pieces in self.wanted:
+            if peer_pieces.has(index):
+                self.wanted[peer_pieces] -= 1
+        return True
+
     def validate_received_piece(self, piece_data, index):
-        expected_hash = self.torrent.torrent_data[b"info"][b"pieces"][index*20:index*20 + 20]
-        hashed_data = hashlib.sha1(piece_data).digest() 
-        return expected_hash == hashed_data
+        return hashlib.sha1(piece_data).digest() == self.metainfo.piece_hash(index)
     
-    async def write_piece_to_file(self, index, data):
-        piece_length = self.torrent.piece_length
-        if self.haveMultiFile:
-            lower_offset = index * piece_length
-            upper_offset = lower_offset + len(data) - 1
-            curr = 0
-            for (path, file_length, upper_limit) in self.file_limit:
-                if lower_offset + curr >= upper_limit:
-                    continue
-                writing_position = lower_offset + curr - upper_limit + file_length
-                if upper_offset < upper_limit:
-                    async with aiofiles.open(os.path.join(self.output_name, path), "rb+") as file:
-                        await file.seek(writing_position)
-                        await file.write(data[curr:])
-                    break
-                else:
-                    writing_length = upper_limit - (lower_offset + curr)
-                    async with aiofiles.open(os.path.join(self.output_name, path), "rb+") as file:
-                        await file.seek(writing_position)
-                        await file.write(data[curr:curr+writing_length])
-                    curr += writing_length     
-        else:
-            async with aiofiles.open(self.output_name, "rb+") as file:
-                await file.seek(index * self.torrent.piece_length)
-                await file.write(data)
-
-    async def receive_piece(self, piece: bytes):
-        (id, index, begin) = struct.unpack(f'>bII', piece[:9])
-        data = piece[9:]        
-
-        if (id != PeerMessage.Piece):
-            raise Exception("Not a valid Piece!")
-        if not self.validate_received_piece(data, index):
-            raise Exception(f"Received piece is not a valid piece {index}")
-        if self.pieces_status[index] == PieceStatus.DOWNLOADED:
+    async def write_piece_to_file(self, index: int, data: bytes) -> asyncio.Future:
+        """ Queue a verified piece for writing. Returns the future of the write. """
+        return await self.disk.write(index * self.metainfo.piece_length, data)
+
+    def _piece_written(self, index: int, write: asyncio.Future) -> None:
+        if write.cancelled() or write.exception() is not None:
+            logger.error(f"Piece {index} could not be written, downloading it again.")
+            self.pieces_status[index] = PieceStatus.EMPTY
+            self.picker.add(index)
+            return
+        self._add_have(index)
+        self.downloaded_pieces += 1
+        self.completed = self.downloaded_pieces == self.number_of_pieces
+        if self.on_piece_written is not None:
+            self.on_piece_written(index)
+
+    async def receive_piece(self, piece: Piece, pipeline: RequestPipeline = None):
+        """
+        Store a received block (the block of `piece` may be a view of the receive buffer:
+        it is copied into the piece, unless it was received in place from `block_buffer`).
+        Once every block of its piece has arrived the piece is hashed on a worker thread,
+        VERIFYING meanwhile (copies of its blocks arriving then are dropped). A valid piece
+        is queued for writing and the duplicate requests for it (endgame) are cancelled; a
+        corrupt one is downloaded again, keeping the duplicates still in flight. The
+        piece only counts as downloaded (`have`, `on_piece_written`) once it is on disk;
+        this waits only if the write-back buffer of `disk` is full.
+
+        Returns:
+            The index of the piece if this block completed it, otherwise None.
+        """
+        index, begin, data = piece.index, piece.begin, piece.block
+        requesters = self.requesters.get((index, begin))
+        if requesters is not None and pipeline in requesters:
+            requesters.remove(pipeline)
+        partial = self.partial_pieces.get(index)
+        if partial is None: # Already downloaded or never requested
             return None
-        
-        await self.write_piece_to_file(index, data)    
+        if not partial.add_block(begin, data):
+            raise Exception(f"Received block ({index}, {begin}, {len(data)}) does not match the piece layout")
+        if not partial.is_complete or self.pieces_status[index] == PieceStatus.VERIFYING:
+            return None
+
+        self.pieces_status[index] = PieceStatus.VERIFYING
+        valid = await asyncio.to_thread(self.validate_received_piece, partial.data, index)
+        if not valid:
+            logger.warning(f"Piece {index} failed hash validation, downloading it again.")
+            self.pieces_status[index] = PieceStatus.PENDING
+            partial.reset({begin for begin in range(0, partial.size, partial.block_size)
+                           if self.requesters.get((index, begin))})
+            return None
+        del self.partial_pieces[index]
+        self._cancel_piece_requests(partial)
+
+        write = await self.write_piece_to_file(index, partial.data)
         self.pieces_status[index] = PieceStatus.DOWNLOADED
-        self.completed = all([x == PieceStatus.DOWNLOADED for x in self.pieces_status])
- 
-        return index
\ No newline at end of file
+        write.add_done_callback(bind(self._piece_written, index))
+        return index
+
+    def _mark_downloaded(self, index: int) -> None:
+        self.picker.remove(index)
+        self.pieces_status[index] = PieceStatus.DOWNLOADED
+        if self._add_have(index):
+            self.downloaded_pieces += 1
+        self.completed = self.downloaded_pieces == self.number_of_pieces
+
+    def verify_pieces(self, indices: List[int]) -> List[int]:
+        """ The pieces among `indices` whose data on disk matches their hash. Blocks on disk I/O. """
+        buffer = bytearray(self.metainfo.piece_length)
+        valid = []
+        for index in indices:
+            with memoryview(buffer)[:self.metainfo.piece_size(index)] as view:
+                read = self.storage.readinto(index * self.metainfo.piece_length, view)
+                if read == len(view) and self.validate_received_piece(view, index):
+                    valid.append(index)
+        return valid
+
+    async def restore(self) -> None:
+        """
+        Mark the pieces of a resumed download that are already on disk as downloaded.
+
+        The resume data's bitfield is trusted if every output file still has its recorded
+        size and is no older than recorded; only the pieces that were in flight at the save
+        are hashed then. A piece started after the save is downloaded again even if it
+        reached the disk before a crash, which `save_resume_data` being called every few
+        pieces keeps cheap. Otherwise the files were changed behind our back and every
+        piece is hashed.
+        """
+        resume = self.resume
+        if resume is None:
+            return
+        trusted = PeerPieces(self.number_of_pieces)
+        stats = await asyncio.to_thread(ResumeData.stat_files, self.output_files)
+        try:
+            if len(stats) != len(resume.file_stats) or any(
+                    size != saved_size or mtime < saved_mtime
+                    for (size, mtime), (saved_size, saved_mtime) in zip(stats, resume.file_stats)):
+                raise ValueError("file sizes differ or files are older")
+            trusted.set_bitfield(resume.have)
+            candidates = sorted({index for index in resume.in_flight
+                                 if 0 <= index < self.number_of_pieces and not trusted.has(index)})
+        except ValueError:
+            trusted = PeerPieces(self.number_of_pieces)
+            logger.info(f"{self.output_name} changed since it was last saved, checking every piece.")
+            candidates = list(range(self.number_of_pieces))
+        for index in trusted.indices():
+            self._mark_downloaded(index)
+        for index in await asyncio.to_thread(self.verify_pieces, candidates):
+            self._mark_downloaded(index)
+        logger.info(f"Resuming {self.output_name} with {self.downloaded_pieces}/{self.number_of_pieces} pieces.")
+
+    def resume_data(self, file_stats: List[Tuple[int, int]]) -> ResumeData:
+        """
+        Snapshot of the download for `ResumeData.save`, with `file_stats` taken just before.
+        The pieces in flight are those being downloaded, hashed or written: any of them may
+        be on disk by the time the download stops.
+        """
+        in_flight = [index for index, status in enumerate(self.pieces_status)
+                     if status != PieceStatus.EMPTY and not self.have.has(index)]
+        return ResumeData(
+            info_hash=self.metainfo.info_hash,
+            torrent_filepath=self.torrent.filepath,
+            output_name=self.output_name,
+            have=self.have.bits,
+            in_flight=in_flight,
+            file_stats=file_stats,
+        )
+
+    async def save_resume_data(self) -> None:
+        """
+        Save the state of the download, touching the disk on worker threads. The files are
+        stat'ed before the bitfield is taken, so a piece written after the snapshot leaves
+        its file newer than recorded, not older.
+        """
+        file_stats = await asyncio.to_thread(ResumeData.stat_files, self.output_files)
+        await asyncio.to_thread(self.resume_data(file_stats).save)
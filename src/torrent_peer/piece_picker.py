@@ -0,0 +1,156 @@
+"""Rarest-first piece selection based on the pieces announced by connected peers"""
+import random
+from array import array
+from typing import Optional
+
+class PeerPieces:
+    """
+    The pieces one remote peer has, as announced by its BitField and Have messages.
+    Stored as a bitfield in wire format (high bit of the first byte is piece 0).
+    """
+    def __init__(self, number_of_pieces: int) -> None:
+        self.number_of_pieces = number_of_pieces
+        self.bits = bytearray((number_of_pieces + 7) // 8)
+        self.count = 0
+
+    @classmethod
+    def full(cls, number_of_pieces: int) -> "PeerPieces":
+        """ The pieces of a seed, i.e. every piece """
+        pieces = cls(number_of_pieces)
+        pieces.bits[:] = b"\xff" * len(pieces.bits)
+        spare_bits = len(pieces.bits) * 8 - number_of_pieces
+        if spare_bits:
+            pieces.bits[-1] &= 0xff << spare_bits & 0xff
+        pieces.count = number_of_pieces
+        return pieces
+
+    @property
+    def is_seed(self) -> bool:
+        return self.count == self.number_of_pieces
+
+    def has(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def add(self, index: int) -> bool:
+        """ Mark `index` as available. Returns False if it already was. """
+        if self.has(index):
+            return False
+        self.bits[index >> 3] |= 0x80 >> (index & 7)
+        self.count += 1
+        return True
+
+    def set_bitfield(self, bitfield: bytes) -> None:
+        if len(bitfield) != len(self.bits):
+            raise ValueError(f"BitField has {len(bitfield)} bytes, expected {len(self.bits)}")
+        spare_bits = len(self.bits) * 8 - self.number_of_pieces
+        if spare_bits and bitfield[-1] & ((1 << spare_bits) - 1):
+            raise ValueError("BitField has spare bits set")
+        self.bits[:] = bitfield
+        self.count = sum(bin(byte).count("1") for byte in self.bits)
+
+    def indices(self):
+        """ Iterate over the indices of the available pieces """
+        for i, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield i * 8 + bit
+
+
+class PiecePicker:
+    """
+    Keeps the wanted pieces (the ones not started yet) ordered by availability, i.e. the
+    number of connected peers that have them, so the rarest piece a peer can give us is the
+    first match when scanning from the front.
+
+    `order[:size]` holds the wanted pieces sorted by availability, `pos` is its inverse and
+    `ends[a]` is one past the last position of the pieces with availability `a`. Every
+    update is a constant number of swaps per availability level, never a re-sort. The
+    initial order is shuffled so pieces that are equally rare are picked in a different
+    order by every downloader.
+    """
+    def __init__(self, number_of_pieces: int) -> None:
+        self.number_of_pieces = number_of_pieces
+        indices = list(range(number_of_pieces))
+        random.shuffle(indices)
+        self.order = array("I", indices)
+        self.pos = array("I", bytes(4 * number_of_pieces))
+        for position, index in enumerate(self.order):
+            self.pos[index] = position
+        self.availability = array("I", bytes(4 * number_of_pieces))
+        self.size = number_of_pieces
+        self.ends = [number_of_pieces]
+
+    def is_wanted(self, index: int) -> bool:
+        return self.pos[index] < self.size
+
+    def _swap(self, a: int, b: int) -> None:
+        order, pos = self.order, self.pos
+        order[a], order[b] = order[b], order[a]
+        pos[order[a]] = a
+        pos[order[b]] = b
+
+    def increment(self, index: int) -> None:
+        """ One more peer has `index` """
+        level = self.availability[index]
+        self.availability[index] = level + 1
+        if not self.is_wanted(index):
+            return
+        if level + 1 == len(self.ends):
+            self.ends.append(self.ends[level])
+        # Move to the last slot of its bucket, which becomes the first slot of the next one
+        last = self.ends[level] - 1
+        self._swap(self.pos[index], last)
+        self.ends[level] -= 1
+
+    def decrement(self, index: int) -> None:
+        """ One peer less has `index` """
+        level = self.availability[index]
+        if level == 0:
+            return
+        self.availability[index] = level - 1
+        if not self.is_wanted(index):
+            return
+        # Move to the first slot of its bucket, which becomes the last slot of the previous one
+        first = self.ends[level - 1]
+        self._swap(self.pos[index], first)
+        self.ends[level - 1] += 1
+
+    def remove(self, index: int) -> None:
+        """ Stop considering `index` (it has been started or downloaded) """
+        if not self.is_wanted(index):
+            return
+        for level in range(self.availability[index], len(self.ends)):
+            last = self.ends[level] - 1
+            self._swap(self.pos[index], last)
+            self.ends[level] -= 1
+        self.size -= 1
+
+    def add(self, index: int) -> None:
+        """ Consider `index` again (e.g. it failed hash validation) """
+        if self.is_wanted(index):
+            return
+        while len(self.ends) <= self.availability[index]:
+            self.ends.append(self.ends[-1])
+        self._swap(self.pos[index], self.size)
+        self.size += 1
+        self.ends[-1] += 1
+        for level in range(len(self.ends) - 1, self.availability[index], -1):
+            first = self.ends[level - 1]
+            self._swap(self.pos[index], first)
+            self.ends[level - 1] += 1
+
+    def pick(self, peer_pieces: Optional[PeerPieces] = None) -> Optional[int]:
+        """
+        Return the rarest wanted piece that `peer_pieces` has (any wanted piece if it is
+        None), without removing it.
+        """
+        # Pieces nobody has are at the front and can be skipped right away
+        start = self.ends[0] if peer_pieces is not None else 0
+        if peer_pieces is None or peer_pieces.is_seed:
+            return self.order[start] if start < self.size else None
+        for position in range(start, self.size):
+            index = self.order[position]
+            if peer_pieces.has(index):
+                return index
+        return None
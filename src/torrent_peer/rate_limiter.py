@@ -0,0 +1,105 @@
+"""Token-bucket bandwidth limits of the daemon and of single torrents"""
+import time
+import asyncio
+from typing import Any, Dict, Optional
+from torrent_peer.config_loader import MAX_UPLOAD_RATE, MAX_DOWNLOAD_RATE
+
+# Seconds of the rate a bucket may save up while idle, and the least it may save (one block)
+BURST_SECONDS = 0.25
+MIN_BURST = 2**14
+
+class TokenBucket:
+    """
+    Lets `rate` bytes per second through on average (0: no limit), in bursts of up to
+    `burst` bytes after idling.
+
+    A transfer reserves its bytes up front with `reserve`, which may leave the bucket in
+    debt, and waits until the debt is paid back by the refill. Reservations are paid in
+    the order they are made, so the connections sharing a bucket take turns block by
+    block and share its rate evenly. Waiting is a single sleep per transfer: nothing
+    polls, and nothing is counted per byte.
+    """
+    def __init__(self, rate: float = 0, burst: float = None) -> None:
+        self.rate = 0.0
+        self.burst = float(MIN_BURST)
+        self._tokens = float(MIN_BURST)
+        self._updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: float = None) -> None:
+        if rate < 0:
+            raise ValueError(f"Rate cannot be negative: {rate}")
+        self._refill(time.monotonic())
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(self.rate * BURST_SECONDS, MIN_BURST)
+        self._tokens = min(self._tokens, self.burst)
+
+    def _refill(self, now: float) -> None:
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: int) -> float:
+        """ Take `amount` bytes from the bucket. Returns the seconds to wait before sending them. """
+        if not self.rate:
+            return 0.0
+        self._refill(time.monotonic())
+        self._tokens -= amount
+        return max(0.0, -self._tokens / self.rate)
+
+class BandwidthLimits:
+    """
+    The upload and download limits of the daemon, and of the torrents given their own.
+
+    A transfer of a torrent with its own limits waits for both its torrent's bucket and
+    the daemon's, whichever is slower.
+    """
+    def __init__(self, upload_rate: float = MAX_UPLOAD_RATE, download_rate: float = MAX_DOWNLOAD_RATE) -> None:
+        self.upload = TokenBucket(upload_rate)
+        self.download = TokenBucket(download_rate)
+        self.torrents: Dict[bytes, Dict[str, TokenBucket]] = {}
+
+    def set(self, upload: float = None, download: float = None, info_hash: bytes = None) -> None:
+        """
+        Change the limits (bytes per second, 0: no limit) of the daemon, or of one torrent
+        with `info_hash`. A limit that is None is left as it is.
+        """
+        for rate in (upload, download):
+            if rate is not None and rate < 0:
+                raise ValueError(f"Rate cannot be negative: {rate}")
+        if info_hash is None:
+            buckets = {"upload": self.upload, "download": self.download}
+        else:
+            buckets = self.torrents.setdefault(info_hash, {"upload": TokenBucket(), "download": TokenBucket()})
+        if upload is not None:
+            buckets["upload"].set_rate(upload)
+        if download is not None:
+            buckets["download"].set_rate(download)
+        if info_hash is not None and not buckets["upload"].rate and not buckets["download"].rate:
+            del self.torrents[info_hash]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "upload": self.upload.rate,
+            "download": self.download.rate,
+            "torrents": {
+                info_hash.hex(): {direction: bucket.rate for direction, bucket in buckets.items()}
+                for info_hash, buckets in self.torrents.items()
+            }
+        }
+
+    async def throttle_upload(self, info_hash: bytes, amount: int) -> None:
+        """ Wait until `amount` bytes of the torrent may be sent """
+        await self._throttle("upload", info_hash, amount)
+
+    async def throttle_download(self, info_hash: bytes, amount: int) -> None:
+        """ Wait until the next `amount` bytes of the torrent may be received """
+        await self._throttle("download", info_hash, amount)
+
+    async def _throttle(self, direction: str, info_hash: bytes, amount: int) -> None:
+        delay = getattr(self, direction).reserve(amount)
+        buckets: Optional[Dict[str, TokenBucket]] = self.torrents.get(info_hash)
+        if buckets is not None:
+            delay = max(delay, buckets[direction].reserve(amount))
+        if delay > 0:
+            await asyncio.sleep(delay)
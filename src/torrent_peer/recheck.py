@@ -0,0 +1,189 @@
+"""Verification of data already on disk against the piece hashes of its torrent"""
+import os
+import time
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+from torrent_peer.torrent_file import Metainfo, metainfo_registry
+from torrent_peer.piece_picker import PeerPieces
+from torrent_peer.resume import ResumeData
+
+logger = logging.getLogger(__name__)
+
+# Files are streamed in reads of (at least) this many bytes: several pieces at a time when
+# pieces are small
+READ_SIZE = 2**22
+
+class RecheckResult:
+    """ The pieces of `path` that match the torrent, and how fast they were checked """
+    def __init__(self,
+                 metainfo: Metainfo,
+                 path: str,
+                 have: PeerPieces,
+                 bytes_checked: int,
+                 elapsed: float) -> None:
+        self.metainfo = metainfo
+        self.path = path
+        self.have = have
+        self.bytes_checked = bytes_checked
+        self.elapsed = elapsed
+
+    @property
+    def complete(self) -> bool:
+        return self.have.is_seed
+
+    @property
+    def throughput(self) -> float:
+        """ Bytes checked per second """
+        return self.bytes_checked / self.elapsed if self.elapsed > 0 else 0.0
+
+    def resume_data(self) -> ResumeData:
+        """ Resume data that lets a download of the torrent continue from the checked data """
+        return ResumeData(
+            info_hash=self.metainfo.info_hash,
+            torrent_filepath=self.metainfo.filepath,
+            output_name=self.path,
+            have=self.have.bits,
+            in_flight=[],
+            file_stats=ResumeData.stat_files([path for path, _ in _files_of(self.metainfo, self.path)]),
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "info_hash": self.metainfo.info_hash.hex(),
+            "name": self.metainfo.name,
+            "path": self.path,
+            "pieces": self.metainfo.number_of_pieces,
+            "valid_pieces": self.have.count,
+            "bytes_checked": self.bytes_checked,
+            "seconds": round(self.elapsed, 3),
+            "throughput": round(self.throughput),
+        }
+
+def _files_of(metainfo: Metainfo, path: str) -> List[Tuple[str, int]]:
+    if metainfo.files:
+        return [(os.path.join(path, rel_path), length) for rel_path, length in metainfo.files]
+    return [(path, metainfo.total_length)]
+
+def recheck(metainfo: Metainfo,
+            path: str,
+            workers: int = None,
+            progress: Callable[[int, int], None] = None) -> RecheckResult:
+    """
+    Check which pieces of the data at `path` match the piece hashes of a torrent.
+
+    The files are streamed in torrent order with large sequential reads (`READ_SIZE`, or
+    one piece if pieces are larger) into a ring of reusable buffers, and the pieces of every
+    buffer are hashed on a thread pool, so reading and hashing overlap and hashing uses
+    every core (hashlib releases the GIL). A missing or short file is not an error: the
+    pieces it covers are simply not valid, and are not hashed.
+
+    Args:
+        `metainfo`: The torrent to check against
+        `path`: The file of a single-file torrent, or the directory of a multi-file one
+        `workers`: Number of hashing threads (default: number of CPUs)
+        `progress`: Called as `progress(bytes_done, total_bytes)` after every read
+
+    Returns:
+        The bitfield of the valid pieces, with the number of bytes read and the time taken
+    """
+    workers = workers or os.cpu_count() or 1
+    piece_length = metainfo.piece_length
+    chunk_size = max(1, READ_SIZE // piece_length) * piece_length
+    total_bytes = metainfo.total_length
+    have = PeerPieces(metainfo.number_of_pieces)
+    missing = bytearray(metainfo.number_of_pieces)  # 1 for the pieces covering absent data
+    buffers = deque(bytearray(chunk_size) for _ in range(workers + 2))
+    in_flight = deque()   # (future, buffer, length) in offset order
+    checked_bytes = 0
+    read_bytes = 0      # Only the data actually there
+    start = time.monotonic()
+
+    def verify(view: memoryview, first_index: int) -> List[int]:
+        valid = []
+        for begin in range(0, len(view), piece_length):
+            index = first_index + begin // piece_length
+            if not missing[index] and \
+                    hashlib.sha1(view[begin:begin + piece_length]).digest() == metainfo.piece_hash(index):
+                valid.append(index)
+        return valid
+
+    def collect_oldest():
+        nonlocal checked_bytes
+        future, buffer, length = in_flight.popleft()
+        for index in future.result():
+            have.add(index)
+        buffers.append(buffer)
+        checked_bytes += length
+        if progress is not None:
+            progress(checked_bytes, total_bytes)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        buffer = buffers.popleft()
+        view = memoryview(buffer)
+        chunk_offset = 0    # Torrent offset of the first byte of `buffer`
+        filled = 0
+
+        def submit():
+            nonlocal buffer, view, chunk_offset, filled
+            in_flight.append((executor.submit(verify, view[:filled], chunk_offset // piece_length),
+                              buffer, filled))
+            if not buffers:
+                collect_oldest()
+            chunk_offset += filled
+            buffer = buffers.popleft()
+            view = memoryview(buffer)
+            filled = 0
+
+        for file_path, length in _files_of(metainfo, path):
+            remaining = length
+            try:
+                file = open(file_path, "rb", buffering=0)
+            except OSError:
+                file = None
+            try:
+                while remaining:
+                    n = min(remaining, chunk_size - filled)
+                    read = file.readinto(view[filled:filled + n]) if file is not None else 0
+                    read_bytes += read
+                    if not read:
+                        # Absent data: skip over it (the buffer keeps stale bytes there) and
+                        # mark the pieces it belongs to, so they are never hashed
+                        gap_start = chunk_offset + filled
+                        first = gap_start // piece_length
+                        last = (gap_start + remaining - 1) // piece_length
+                        missing[first:last + 1] = b"\x01" * (last + 1 - first)
+                        read = n
+                    filled += read
+                    remaining -= read
+                    if filled == chunk_size:
+                        submit()
+            finally:
+                if file is not None:
+                    file.close()
+        if filled:
+            submit()
+        while in_flight:
+            collect_oldest()
+
+    return RecheckResult(metainfo, path, have, read_bytes, time.monotonic() - start)
+
+def torrents_in_directory(torrent_dir: str, data_dir: str) -> List[Tuple[str, str]]:
+    """
+    `(torrent_filepath, data_path)` of every .torrent file in `torrent_dir`, where the data
+    of a torrent is expected at `data_dir/<name of the torrent>`.
+    """
+    pairs = []
+    for filename in sorted(os.listdir(torrent_dir)):
+        if not filename.endswith(".torrent"):
+            continue
+        torrent_filepath = os.path.join(torrent_dir, filename)
+        try:
+            metainfo = metainfo_registry.load(torrent_filepath)
+        except Exception as e:
+            logger.warning(f"Skipping {torrent_filepath}: {e}")
+            continue
+        pairs.append((torrent_filepath, os.path.join(data_dir, metainfo.name)))
+    return pairs
@@ -0,0 +1,114 @@
+"""Per-connection pipeline of outstanding block requests"""
+import asyncio
+import math
+import time
+from typing import Dict, List, Tuple
+from torrent_peer.peer_message import Request, Cancel
+from torrent_peer.config_loader import BLOCK_SIZE, MAX_PIPELINE_DEPTH
+
+class RequestPipeline:
+    """
+    Keeps track of the block requests sent to one peer that have not been answered yet.
+
+    The number of requests kept in flight (`depth`) follows the bandwidth-delay product of
+    the connection: the receive rate is averaged over short windows and multiplied by the
+    smallest round trip time seen recently (the propagation delay, without the queueing
+    delay our own requests add). Keeping twice that many bytes outstanding fills the link
+    without letting the queue on the remote side grow forever.
+
+    Replies are matched by `(index, begin)`, so they may arrive in any order. Requests
+    cancelled through `cancel` are sent a Cancel message on `writer`, and late replies to
+    them are ignored.
+    """
+    MIN_DEPTH = 2
+    INITIAL_DEPTH = 4
+    RATE_WINDOW = 0.25      # Seconds between receive rate samples
+    RTT_WINDOW = 10         # Seconds the minimum RTT sample is kept
+
+    def __init__(self,
+                 writer: asyncio.StreamWriter = None,
+                 block_size: int = BLOCK_SIZE,
+                 max_depth: int = MAX_PIPELINE_DEPTH) -> None:
+        self.writer = writer
+        self.block_size = block_size
+        self.max_depth = max(max_depth, self.MIN_DEPTH)
+        self.depth = min(self.INITIAL_DEPTH, self.max_depth)
+        self.outstanding: Dict[Tuple[int, int], Tuple[Request, float]] = {}
+        self.rate = 0.0         # Bytes per second
+        self.min_rtt = None     # Seconds
+
+        now = time.monotonic()
+        self._rate_start = now
+        self._rate_bytes = 0
+        self._rtt_start = now
+        self._rtt_window_min = None
+
+    def __len__(self) -> int:
+        return len(self.outstanding)
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self.outstanding
+
+    def can_request(self) -> bool:
+        return len(self.outstanding) < self.depth
+
+    def add(self, request: Request) -> None:
+        self.outstanding[(request.index, request.begin)] = (request, time.monotonic())
+
+    def complete(self, index: int, begin: int, length: int) -> Request:
+        """
+        Match a received block with its request and update the link estimates.
+        Returns the matching request, or None if the block was never requested (or was
+        already answered).
+        """
+        entry = self.outstanding.pop((index, begin), None)
+        if entry is None:
+            return None
+        request, sent_at = entry
+        now = time.monotonic()
+        self._sample_rtt(now - sent_at, now)
+        self._sample_rate(length, now)
+        self._update_depth()
+        return request
+
+    def cancel(self, index: int, begin: int) -> None:
+        """ Withdraw an outstanding request and tell the peer not to send it """
+        entry = self.outstanding.pop((index, begin), None)
+        if entry is None:
+            return
+        request = entry[0]
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(Cancel(request.index, request.begin, request.length).encode())
+
+    def drain(self) -> List[Request]:
+        """ Remove and return every outstanding request (e.g. when the connection drops) """
+        requests = [request for request, _ in self.outstanding.values()]
+        self.outstanding.clear()
+        return requests
+
+    def _sample_rtt(self, rtt: float, now: float) -> None:
+        if self._rtt_window_min is None or rtt < self._rtt_window_min:
+            self._rtt_window_min = rtt
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        # Forget old minimums so a route change is eventually noticed
+        if now - self._rtt_start >= self.RTT_WINDOW:
+            self.min_rtt = self._rtt_window_min
+            self._rtt_window_min = None
+            self._rtt_start = now
+
+    def _sample_rate(self, length: int, now: float) -> None:
+        self._rate_bytes += length
+        elapsed = now - self._rate_start
+        if elapsed < self.RATE_WINDOW:
+            return
+        sample = self._rate_bytes / elapsed
+        self.rate = sample if self.rate == 0 else 0.7 * self.rate + 0.3 * sample
+        self._rate_start = now
+        self._rate_bytes = 0
+
+    def _update_depth(self) -> None:
+        if self.rate == 0 or self.min_rtt is None:
+            return
+        bdp = self.rate * self.min_rtt / self.block_size
+        self.depth = max(self.MIN_DEPTH, min(self.max_depth, math.ceil(2 * bdp) + 1))
@@ -0,0 +1,106 @@
+"""Fast-resume state of unfinished downloads"""
+import os
+import logging
+from typing import List, Optional, Sequence, Tuple
+import bencodepy
+from torrent_peer.config_loader import RESUME_DIR
+
+logger = logging.getLogger(__name__)
+
+class ResumeData:
+    """
+    What a download needs to continue after a restart without hashing everything again.
+
+    It records the output path, the bitfield of the pieces known to be on disk, the pieces
+    being downloaded, hashed or written (`in_flight`, they may or may not be on disk) and the
+    `(size, mtime_ns)` of every output file, taken just before the bitfield. The bitfield
+    can be trusted as long as the files keep their size and are not older: a file written
+    to since then only received pieces missing from the bitfield. Those are `in_flight`, or
+    were started after the save and are downloaded again.
+
+    Saved bencoded as `<RESUME_DIR>/<info_hash>.resume` and replaced atomically.
+    """
+    def __init__(self,
+                 info_hash: bytes,
+                 torrent_filepath: str,
+                 output_name: str,
+                 have: bytes,
+                 in_flight: Sequence[int],
+                 file_stats: Sequence[Tuple[int, int]]) -> None:
+        self.info_hash = info_hash
+        self.torrent_filepath = torrent_filepath
+        self.output_name = output_name
+        self.have = bytes(have)
+        self.in_flight = list(in_flight)
+        self.file_stats = [tuple(stat) for stat in file_stats]
+
+    @staticmethod
+    def path(info_hash: bytes, resume_dir: str = RESUME_DIR) -> str:
+        return os.path.join(resume_dir, info_hash.hex() + ".resume")
+
+    @staticmethod
+    def stat_files(paths: Sequence[str]) -> List[Tuple[int, int]]:
+        """ `(size, mtime_ns)` of each file, `(-1, 0)` for a missing one """
+        stats = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append((-1, 0))
+        return stats
+
+    def save(self, resume_dir: str = RESUME_DIR) -> None:
+        os.makedirs(resume_dir, exist_ok=True)
+        path = self.path(self.info_hash, resume_dir)
+        data = bencodepy.encode({
+            b"info_hash": self.info_hash,
+            b"torrent": self.torrent_filepath.encode("utf-8"),
+            b"output": self.output_name.encode("utf-8"),
+            b"have": self.have,
+            b"in_flight": self.in_flight,
+            b"files": [list(stat) for stat in self.file_stats],
+        })
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, info_hash: bytes, resume_dir: str = RESUME_DIR) -> Optional["ResumeData"]:
+        """ The saved state of a torrent, or None if there is none (or it is unreadable) """
+        return cls.load_file(cls.path(info_hash, resume_dir))
+
+    @classmethod
+    def load_file(cls, path: str) -> Optional["ResumeData"]:
+        try:
+            with open(path, "rb") as file:
+                data = bencodepy.decode(file.read())
+            return cls(
+                info_hash=data[b"info_hash"],
+                torrent_filepath=data[b"torrent"].decode("utf-8"),
+                output_name=data[b"output"].decode("utf-8"),
+                have=data[b"have"],
+                in_flight=data[b"in_flight"],
+                file_stats=data[b"files"],
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable resume file {path}: {e}")
+            return None
+
+    @classmethod
+    def load_all(cls, resume_dir: str = RESUME_DIR) -> List["ResumeData"]:
+        """ The saved state of every unfinished download """
+        if not os.path.isdir(resume_dir):
+            return []
+        resumes = (cls.load_file(os.path.join(resume_dir, name))
+                   for name in sorted(os.listdir(resume_dir)) if name.endswith(".resume"))
+        return [resume for resume in resumes if resume is not None]
+
+    @classmethod
+    def discard(cls, info_hash: bytes, resume_dir: str = RESUME_DIR) -> None:
+        try:
+            os.remove(cls.path(info_hash, resume_dir))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,261 @@
+"""Positional access to the files of a torrent"""
+import mmap
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+from torrent_peer.config_loader import MAX_OPEN_FILES, STORAGE_BACKEND
+
+class FileStorage:
+    """
+    The files of one torrent seen as a single range of bytes, as pieces are laid out.
+
+    Open files are kept in a small LRU pool so that serving a block does not open, seek
+    and close the file every time, and data is read with positional reads (`os.preadv`)
+    straight into the caller's buffer. The files a range spans are found with a bisect
+    over their cumulative offsets.
+
+    Reads and writes may run on several threads at once. The pool is guarded by a lock,
+    and a file is pinned while it is being read or written, so that it is never closed
+    (and its descriptor reused) under a running operation: the pool may then briefly
+    hold more than `max_open_files` files.
+
+    Args:
+        root_path: The file of a single-file torrent, or the directory of a multi-file one.
+        files: `(relative_path, length)` of every file of a multi-file torrent, None for a
+            single file.
+        total_length: Total number of bytes of the torrent.
+        writable: Open the files for writing too (they must exist with their final size).
+    """
+    def __init__(self,
+                 root_path: str,
+                 files: Optional[Sequence[Tuple[str, int]]],
+                 total_length: int,
+                 writable: bool = False,
+                 max_open_files: int = MAX_OPEN_FILES) -> None:
+        self.root_path = root_path
+        if files:
+            self.files: List[Tuple[str, int]] = [(os.path.join(root_path, path), length)
+                                                 for path, length in files]
+        else:
+            self.files = [(root_path, total_length)]
+        self.total_length = total_length
+        self.writable = writable
+        self.max_open_files = max(1, max_open_files)
+        self.offsets: List[int] = []    # Offset of the first byte of each file
+        offset = 0
+        for _, length in self.files:
+            self.offsets.append(offset)
+            offset += length
+        self._pool: "OrderedDict[int, BinaryIO]" = OrderedDict()
+        self._pins: Dict[int, int] = {}     # Operations using each file of the pool
+        self._dirty: Set[int] = set()       # Files written to since the last flush
+        self._lock = threading.Lock()
+
+    def _acquire(self, file_index: int) -> BinaryIO:
+        """ Open a file (or take it from the pool) and pin it there until `_release` """
+        with self._lock:
+            file = self._pool.get(file_index)
+            if file is None:
+                file = open(self.files[file_index][0], "r+b" if self.writable else "rb", buffering=0)
+                self._pool[file_index] = file
+            else:
+                self._pool.move_to_end(file_index)
+            self._pins[file_index] = self._pins.get(file_index, 0) + 1
+            self._evict()
+            return file
+
+    def _release(self, file_index: int) -> None:
+        with self._lock:
+            self._pins[file_index] -= 1
+            if not self._pins[file_index]:
+                del self._pins[file_index]
+            self._evict()
+
+    def _evict(self) -> None:
+        """ Close the least recently used unpinned files beyond `max_open_files` (lock held) """
+        excess = len(self._pool) - self.max_open_files
+        for file_index in list(self._pool):
+            if excess <= 0:
+                break
+            if file_index not in self._pins:
+                self._pool.pop(file_index).close()
+                excess -= 1
+
+    @contextmanager
+    def _file(self, file_index: int) -> Iterator[BinaryIO]:
+        file = self._acquire(file_index)
+        try:
+            yield file
+        finally:
+            self._release(file_index)
+
+    def spans(self, offset: int, length: int) -> Iterator[Tuple[int, int, int]]:
+        """ `(file_index, offset_in_file, length)` of each file the range covers """
+        file_index = bisect_right(self.offsets, offset) - 1
+        while length > 0 and file_index < len(self.files):
+            file_offset = offset - self.offsets[file_index]
+            n = min(length, self.files[file_index][1] - file_offset)
+            if n > 0:
+                yield file_index, file_offset, n
+                offset += n
+                length -= n
+            file_index += 1
+
+    @contextmanager
+    def file_range(self, offset: int, length: int) -> Iterator[Optional[Tuple[BinaryIO, int]]]:
+        """
+        Context manager giving `(file, offset_in_file)` if the range lies within a single
+        file, otherwise None. The file belongs to the pool and stays pinned there (open)
+        until the `with` block ends: use positional I/O only and do not close it.
+        """
+        spans = self.spans(offset, length)
+        file_index, file_offset, n = next(spans, (None, 0, 0))
+        if file_index is None or n != length:
+            yield None
+            return
+        with self._file(file_index) as file:
+            yield file, file_offset
+
+    def readinto(self, offset: int, buffer: memoryview) -> int:
+        """ Read `len(buffer)` bytes starting at `offset` into `buffer`. Returns the bytes read. """
+        filled = 0
+        for file_index, file_offset, n in self.spans(offset, len(buffer)):
+            view = buffer[filled:filled + n]
+            with self._file(file_index) as file:
+                if hasattr(os, "preadv"):
+                    read = os.preadv(file.fileno(), [view], file_offset)
+                else:
+                    file.seek(file_offset)
+                    read = file.readinto(view)
+            filled += read
+            if read < n: # File is shorter than the torrent says
+                break
+        return filled
+
+    def read(self, offset: int, length: int) -> bytearray:
+        buffer = bytearray(length)
+        with memoryview(buffer) as view:
+            filled = self.readinto(offset, view)
+        del buffer[filled:]
+        return buffer
+
+    def write(self, offset: int, data) -> None:
+        """ Write `data` starting at `offset` with positional writes """
+        with memoryview(data) as view:
+            written = 0
+            for file_index, file_offset, n in self.spans(offset, len(view)):
+                chunk = view[written:written + n]
+                with self._file(file_index) as file:
+                    while chunk:
+                        if hasattr(os, "pwrite"):
+                            count = os.pwrite(file.fileno(), chunk, file_offset)
+                        else:
+                            file.seek(file_offset)
+                            count = file.write(chunk)
+                        chunk = chunk[count:]
+                        file_offset += count
+                # Marked once written, so that a flush running meanwhile does not miss it
+                with self._lock:
+                    self._dirty.add(file_index)
+                written += n
+
+    def flush(self, offset: int = 0, length: int = None) -> None:
+        """
+        Make the written data durable (the range is a hint, written files are synced whole).
+        Files written since the last flush are synced even if the pool closed them since.
+        """
+        with self._lock:
+            dirty, self._dirty = sorted(self._dirty), set()
+        for i, file_index in enumerate(dirty):
+            try:
+                with self._file(file_index) as file:
+                    os.fsync(file.fileno())
+            except BaseException:
+                with self._lock:
+                    self._dirty.update(dirty[i:])
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            while self._pool:
+                _, file = self._pool.popitem()
+                file.close()
+            self._pins.clear()
+
+
+class MmapStorage(FileStorage):
+    """
+    A `FileStorage` that maps every (non-empty) file into memory once.
+
+    Writes are plain copies into the shared mappings and reads copy straight out of them,
+    so there is no system call per block. The file descriptors stay open next to the
+    mappings, so `file_range` (and therefore sendfile) keeps working on the same pages.
+    `flush` writes dirty pages back with msync; when that happens is up to the caller.
+    """
+    def __init__(self,
+                 root_path: str,
+                 files: Optional[Sequence[Tuple[str, int]]],
+                 total_length: int,
+                 writable: bool = False) -> None:
+        # Every file stays open for the lifetime of the mappings
+        super().__init__(root_path, files, total_length, writable, max_open_files=len(files or ()) + 1)
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._maps: List[Optional[mmap.mmap]] = []
+        self._views: List[Optional[memoryview]] = []
+        for file_index, (_, length) in enumerate(self.files):
+            if length == 0:
+                self._maps.append(None)
+                self._views.append(None)
+                continue
+            with self._file(file_index) as file:
+                mapping = mmap.mmap(file.fileno(), length, access=access)
+            self._maps.append(mapping)
+            self._views.append(memoryview(mapping))
+
+    def readinto(self, offset: int, buffer: memoryview) -> int:
+        filled = 0
+        for file_index, file_offset, n in self.spans(offset, len(buffer)):
+            buffer[filled:filled + n] = self._views[file_index][file_offset:file_offset + n]
+            filled += n
+        return filled
+
+    def write(self, offset: int, data) -> None:
+        with memoryview(data) as view:
+            written = 0
+            for file_index, file_offset, n in self.spans(offset, len(view)):
+                self._views[file_index][file_offset:file_offset + n] = view[written:written + n]
+                written += n
+
+    def flush(self, offset: int = 0, length: int = None) -> None:
+        """ msync the pages covering the range (every mapping by default) """
+        if length is None:
+            length = self.total_length - offset
+        for file_index, file_offset, n in self.spans(offset, length):
+            start = file_offset - file_offset % mmap.ALLOCATIONGRANULARITY
+            self._maps[file_index].flush(start, file_offset + n - start)
+
+    def close(self) -> None:
+        for view in self._views:
+            if view is not None:
+                view.release()
+        for mapping in self._maps:
+            if mapping is not None:
+                mapping.close()
+        self._views, self._maps = [], []
+        super().close()
+
+
+def open_storage(root_path: str,
+                 files: Optional[Sequence[Tuple[str, int]]],
+                 total_length: int,
+                 writable: bool = False,
+                 backend: str = STORAGE_BACKEND) -> FileStorage:
+    """ Open the storage of a torrent with the configured backend ("file" or "mmap") """
+    if backend == "mmap":
+        return MmapStorage(root_path, files, total_length, writable)
+    if backend == "file":
+        return FileStorage(root_path, files, total_length, writable)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -2,9 +2,11 @@ import click
 import requests
 from tabulate import tabulate
 from InquirerPy import inquirer
+import os
 import time
 import logging
-from torrent_peer.config_loader import PORT, TRACKER_URL
+from torrent_peer.torrent_file import TorrentFile
+from torrent_peer.config_loader import PORT, TRACKER_URL, BLOCK_SIZE
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 
@@ -30,6 +32,15 @@ def handle_exceptions(func):
             logging.error(f"An error occurred: {err}")
     return wrapper
 
+def check_piece_length(ctx, param, value):
+    """ Reject a --piece-length the daemon would refuse, before hashing anything """
+    if value is not None:
+        try:
+            TorrentFile.check_piece_length(value, min_length=BLOCK_SIZE)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
 @click.command()
 @click.option('--port', type=int, default=PORT, help="Choost port number of torrent daemon")
 @click.option('--input', 
@@ -39,7 +50,7 @@ def handle_exceptions(func):
               required=True)
 @click.option('--trackers', default=None, help="List of list of tracker URL(comma-separated)")
 @click.option('--private', is_flag=True, help="Don't public the torrent file for everyone to download")
-@click.option('--piece-length', default=None, type=int, help="Piece length for the torrent file.")
+@click.option('--piece-length', default=None, type=int, callback=check_piece_length, help="Piece length for the torrent file (default: chosen from the total size).")
 @click.option('--torrent', 
               'torrent_filepath',
               default=None, 
@@ -58,30 +69,49 @@ def seed(port, input_path, trackers, private, piece_length, torrent_filepath, na
     if name: payload["name"] = name
     if description: payload["description"] = description
 
-    response = requests.post(url, json=payload, timeout=3)
+    # The daemon hashes the whole input before answering, which can take a while
+    response = requests.post(url, json=payload, timeout=None)
     response.raise_for_status()
     logging.info(f"{response.json()['message']}")
 
 @click.command()
 @click.option('--port', type=int, default=PORT, help="Choost port number of torrent daemon")
+@click.option('--search', default=None, help="Only torrents whose name contains this.")
+@click.option('--prefix', default=None, help="Only torrents whose name starts with this.")
+@click.option('--limit', type=int, default=20, help="Number of torrents shown per page (default: 20).")
 @handle_exceptions
-def get_torrent(port):
+def get_torrent(port, search, prefix, limit):
     url = f"http://127.0.0.1:{port}/torrents"
-    # Send a GET request
-    response = requests.get(url)
-    response.raise_for_status()  # Raise an error for HTTP errors
+    next_page = "Next page >>"
+    params = {"limit": limit, "search": search, "prefix": prefix, "health": 1}
+    # Fetch the catalog one page at a time until a torrent is selected
+    while True:
+        response = requests.get(url, params=params)
+        response.raise_for_status()  # Raise an error for HTTP errors
 
-    # Parse and print the response
-    data: dict = response.json()['data']
-    rows = [[key, value["name"], value["description"]] for key, value in data.items()]
-    click.echo(tabulate(rows, headers=["info_hash", "Name", "Description"], tablefmt="grid"))
+        # Parse and print the response
+        page: dict = response.json()['data']
+        data: dict = page["torrents"]
+        if not data:
+            click.echo("No torrents found.")
+            return
+        rows = [[key, value["name"], value["description"], value.get("complete", "-"), value.get("incomplete", "-")]
+                for key, value in data.items()]
+        click.echo(tabulate(rows, headers=["info_hash", "Name", "Description", "Seeders", "Leechers"],
+                            tablefmt="grid"))
 
-    choices = [(key[:5]+' - '+value["name"], key) for key, value in data.items()]
-    selected_file = inquirer.select(
-        message="Select a torrent file to download:",
-        choices= [choice[0] for choice in choices],
-        default= choices[0][0],
-    ).execute()
+        choices = [(key[:5]+' - '+value["name"], key) for key, value in data.items()]
+        labels = [choice[0] for choice in choices]
+        if page["next_cursor"]:
+            labels.append(next_page)
+        selected_file = inquirer.select(
+            message="Select a torrent file to download:",
+            choices= labels,
+            default= labels[0],
+        ).execute()
+        if selected_file != next_page:
+            break
+        params["cursor"] = page["next_cursor"]
 
     info_hash = next(key for label, key in choices if label == selected_file)
 
@@ -111,6 +141,48 @@ def leech(port, torrent_filepath):
     click.echo(f"Go to the torrent-daemon terminal to see details.")
 @click.command()
 @click.option('--port', type=int, default=PORT, help="Port number of the torrent server.")
+@click.option('--torrent', 'torrent_filepath', default=None,
+              type=click.Path(exists=True, file_okay=True, dir_okay=False),
+              help="Torrent file to check the data against.")
+@click.option('--input', 'input_path', default=None,
+              type=click.Path(file_okay=True, dir_okay=True),
+              help="File or directory holding the data of --torrent.")
+@click.option('--torrent-dir', default=None,
+              type=click.Path(exists=True, file_okay=False, dir_okay=True),
+              help="Check every .torrent file of this directory instead.")
+@click.option('--data-dir', default=None,
+              type=click.Path(exists=True, file_okay=False, dir_okay=True),
+              help="Directory holding the data of the torrents of --torrent-dir, by torrent name.")
+@click.option('--seed', is_flag=True, help="Seed the valid pieces afterwards.")
+@click.option('--resume', is_flag=True, help="Let leeching continue from the valid pieces of incomplete data.")
+@handle_exceptions
+def recheck(port, torrent_filepath, input_path, torrent_dir, data_dir, seed, resume):
+    url = f"http://127.0.0.1:{port}/recheck"
+    if torrent_filepath and input_path:
+        payload = {"torrent_filepath": os.path.abspath(torrent_filepath), "input_path": os.path.abspath(input_path)}
+    elif torrent_dir and data_dir:
+        payload = {"torrent_dir": os.path.abspath(torrent_dir), "data_dir": os.path.abspath(data_dir)}
+    else:
+        raise click.UsageError("Give --torrent and --input, or --torrent-dir and --data-dir.")
+    payload["seed"] = seed
+    payload["resume"] = resume
+
+    # The daemon reads all the data before answering, which can take a while
+    response = requests.post(url, json=payload, timeout=None)
+    response.raise_for_status()
+    rows = [[result["info_hash"], result["name"], result["path"], 
+             f"{result['valid_pieces']}/{result['pieces']}",
+             f"{result['bytes_checked'] / 2**20:.0f} MiB",
+             f"{result['seconds']:.1f} s",
+             f"{result['throughput'] / 2**20:.0f} MiB/s"] for result in response.json()["data"]]
+    click.echo(tabulate(
+        rows,
+        headers=["info_hash", "name", "filepath", "valid pieces", "read", "time", "throughput"],
+        tablefmt="grid"
+    ))
+
+@click.command()
+@click.option('--port', type=int, default=PORT, help="Port number of the torrent server.")
 @handle_exceptions
 def status(port):
     url = f"http://127.0.0.1:{port}/status"
@@ -136,6 +208,35 @@ def status(port):
     ))
 
 
+@click.command()
+@click.option('--port', type=int, default=PORT, help="Port number of the torrent server.")
+@click.option('--upload', type=click.FloatRange(min=0), default=None, help="Upload limit in KiB/s (0: no limit).")
+@click.option('--download', type=click.FloatRange(min=0), default=None, help="Download limit in KiB/s (0: no limit).")
+@click.option('--info-hash', default=None, help="Limit this torrent (hex info_hash) instead of the whole daemon.")
+@handle_exceptions
+def limit(port, upload, download, info_hash):
+    """
+    Show the bandwidth limits, or change them with --upload and --download.
+    """
+    url = f"http://127.0.0.1:{port}/limits"
+    if upload is None and download is None:
+        response = requests.get(url)
+    else:
+        payload = {}
+        if upload is not None: payload["upload"] = upload * 1024
+        if download is not None: payload["download"] = download * 1024
+        if info_hash: payload["info_hash"] = info_hash
+        response = requests.post(url, json=payload)
+    response.raise_for_status()
+    data = response.json()
+
+    def rate(value):
+        return f"{value / 1024:g} KiB/s" if value else "no limit"
+    rows = [["daemon", rate(data["upload"]), rate(data["download"])]]
+    rows += [[info_hash, rate(limits["upload"]), rate(limits["download"])]
+             for info_hash, limits in data["torrents"].items()]
+    click.echo(tabulate(rows, headers=["scope", "upload", "download"], tablefmt="grid"))
+
 @click.command()
 @click.option('--port', type=int, default=PORT, help="Port number of the torrent server.")
 @handle_exceptions
@@ -2,15 +2,136 @@
 import os
 import hashlib
 import time
-from typing import List, Tuple
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 import bencodepy
 from torrent_peer.utils import get_unique_filename
 
+# Most memory the piece buffers used while hashing may take, whatever the number of CPUs
+MAX_HASH_BUFFER = 2**26
+
+class Metainfo:
+    """
+    Immutable, decoded view of a metainfo (.torrent) file.
+
+    The file is read and bencode-decoded exactly once; every derived value (info_hash,
+    piece hashes, file list, total length) is computed up front so hot paths such as
+    piece validation only do attribute lookups. The raw file is kept as `data` (bytes).
+    """
+    __slots__ = ("filepath", "mtime_ns", "size", "info_hash", "tracker_url", "name",
+                 "piece_length", "pieces", "number_of_pieces", "files", "total_length",
+                 "data")
+
+    def __init__(self, filepath: str, data: bytes, mtime_ns: int = 0) -> None:
+        try:
+            torrent_data = bencodepy.decode(data)
+        except bencodepy.DecodingError:
+            raise ValueError("The file is not in a valid Bencoded format.")
+        info = torrent_data[b"info"]
+        pieces = info[b"pieces"]
+
+        if b"files" in info:
+            files = tuple(
+                (os.path.join(*[part.decode("utf-8") for part in file[b"path"]]), file[b"length"])
+                for file in info[b"files"]
+            )
+            total_length = sum(length for _, length in files)
+        else:
+            files = None
+            total_length = info[b"length"]
+
+        setattr_ = object.__setattr__
+        setattr_(self, "filepath", filepath)
+        setattr_(self, "mtime_ns", mtime_ns)
+        setattr_(self, "size", len(data))
+        setattr_(self, "info_hash", hashlib.sha1(bencodepy.encode(info)).digest())
+        setattr_(self, "tracker_url", torrent_data[b"announce"].decode("utf-8"))
+        setattr_(self, "name", info[b"name"].decode("utf-8"))
+        setattr_(self, "piece_length", info[b"piece length"])
+        setattr_(self, "pieces", pieces)
+        setattr_(self, "number_of_pieces", len(pieces) // 20)
+        setattr_(self, "files", files)
+        setattr_(self, "total_length", total_length)
+        setattr_(self, "data", bytes(data))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def piece_hash(self, index: int) -> bytes:
+        """ Expected SHA-1 digest of the piece at `index` """
+        return self.pieces[index*20:index*20 + 20]
+
+    def piece_size(self, index: int) -> int:
+        """ Number of bytes in the piece at `index` (the last piece may be shorter) """
+        if index == self.number_of_pieces - 1:
+            return self.total_length - index * self.piece_length
+        return self.piece_length
+
+    @classmethod
+    def from_file(cls, filepath: str) -> "Metainfo":
+        with open(filepath, "rb") as file:
+            mtime_ns = os.fstat(file.fileno()).st_mtime_ns
+            return cls(filepath, file.read(), mtime_ns)
+
+
+class MetainfoRegistry:
+    """
+    Process-wide cache of decoded metainfo files.
+
+    Entries are keyed by absolute path and re-validated against the file's mtime/size,
+    so a .torrent that changes on disk is decoded again. Every loaded metainfo is also
+    indexed by its info_hash.
+    """
+    def __init__(self) -> None:
+        self._by_path: Dict[str, Metainfo] = {}
+        self._by_info_hash: Dict[bytes, Metainfo] = {}
+        self._lock = threading.Lock()
+
+    def load(self, filepath: str) -> Metainfo:
+        """ Return the metainfo for `filepath`, decoding the file only if it changed. """
+        key = os.path.abspath(filepath)
+        try:
+            stat = os.stat(key)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"The file '{filepath}' does not exist.")
+        metainfo = self._by_path.get(key)
+        if metainfo is not None and metainfo.mtime_ns == stat.st_mtime_ns \
+                and metainfo.size == stat.st_size:
+            return metainfo
+
+        metainfo = Metainfo.from_file(key)
+        with self._lock:
+            self._by_path[key] = metainfo
+            self._by_info_hash[metainfo.info_hash] = metainfo
+        return metainfo
+
+    def get(self, info_hash: bytes) -> Optional[Metainfo]:
+        """ Return a previously loaded metainfo by its info_hash, or None. """
+        return self._by_info_hash.get(info_hash)
+
+    def discard(self, filepath: str) -> None:
+        with self._lock:
+            metainfo = self._by_path.pop(os.path.abspath(filepath), None)
+            if metainfo is not None and self._by_info_hash.get(metainfo.info_hash) is metainfo:
+                del self._by_info_hash[metainfo.info_hash]
+
+
+metainfo_registry = MetainfoRegistry()
+
+
 class TorrentFile:
     """
     A class to generate metainfo (torrent) files for files or directories, based on the 
     BitTorrent specification.
 
+    Reading an existing torrent goes through `metainfo_registry`, so the .torrent is decoded
+    once per process and every property below is a plain attribute lookup.
+
     Attributes:
         piece_length (int): The size of each file piece in bytes (default is 256KB).
 
@@ -31,33 +152,19 @@ class TorrentFile:
         if not os.path.isfile(filepath):
             raise FileNotFoundError("File not exists")
         self._filepath = filepath
+        self.metainfo: Metainfo = metainfo_registry.load(filepath)
     
     @property
     def files(self) -> List[Tuple[str, int]]:
-        with open(self.filepath, 'rb') as f:
-            torrent_data = bencodepy.decode(f.read())
-        
-        info = torrent_data[b'info']
-        name = info[b'name'].decode()
-        file_list = info[b'files'] if b'files' in info else None
-        # Extract file details if multifile
-        if file_list:
-            files = [(file[b'path'], file[b'length']) for file in file_list]
-        else:
-            return None
-
-        paths = [(os.path.join(*[part.decode('utf-8') for part in path_parts]), length) 
-                    for path_parts, length in files]
-        return paths
-
+        return list(self.metainfo.files) if self.metainfo.files else None
 
     @property
     def info_hash(self) -> bytes:
-        return TorrentFile.get_info_hash(self.filepath)
+        return self.metainfo.info_hash
 
     @property
     def tracker_url(self) -> str:
-        return TorrentFile.get_tracker_url(self.filepath)
+        return self.metainfo.tracker_url
 
     @property 
     def filepath(self) -> str:
@@ -65,27 +172,142 @@ class TorrentFile:
     
     @property
     def torrent_data(self):
-        """ Return decoded data from torrent file"""
-        with open(self.filepath, 'rb') as file:
-                # Decode the torrent file
-            return bencodepy.decode(file.read())
+        """ Return decoded data from torrent file (a new copy on every access) """
+        return bencodepy.decode(self.metainfo.data)
         
     @property
     def number_of_pieces(self) -> int:
         """ Number of pieces of file """
-        return len(self.torrent_data[b"info"][b"pieces"])/20 
+        return self.metainfo.number_of_pieces
     
     @property
     def piece_length(self) -> int:
         """ Number of bytes in each piece """
-        return self.torrent_data[b"info"][b"piece length"]
+        return self.metainfo.piece_length
+    
+    @property
+    def total_length(self) -> int:
+        """ Total number of bytes of all files """
+        return self.metainfo.total_length
     
     @property
     def filename(self) -> str:
         """ File name"""
-        return self.torrent_data[b"info"][b"name"].decode("utf-8")
+        return self.metainfo.name
     
-    def _generate_file_pieces(file_path: str, piece_length: str=262144):
+    MIN_PIECE_LENGTH = 2**18    # 256 KiB
+    MAX_PIECE_LENGTH = 2**24    # 16 MiB
+    TARGET_NUMBER_OF_PIECES = 1500
+
+    @classmethod
+    def choose_piece_length(cls, total_size: int) -> int:
+        """
+        Pick a power-of-two piece length between 256 KiB and 16 MiB so that the torrent has
+        roughly `TARGET_NUMBER_OF_PIECES` pieces.
+        """
+        piece_length = cls.MIN_PIECE_LENGTH
+        while piece_length < cls.MAX_PIECE_LENGTH and \
+                total_size > piece_length * cls.TARGET_NUMBER_OF_PIECES:
+            piece_length *= 2
+        return piece_length
+
+    @classmethod
+    def check_piece_length(cls, piece_length: int, min_length: int = MIN_PIECE_LENGTH) -> None:
+        """ Raise ValueError unless `piece_length` is a power of two from `min_length` to 16 MiB """
+        if piece_length < min_length or piece_length > cls.MAX_PIECE_LENGTH \
+                or piece_length & (piece_length - 1):
+            raise ValueError(f"piece_length must be a power of two from {min_length} "
+                             f"to {cls.MAX_PIECE_LENGTH} bytes.")
+
+    @staticmethod
+    def get_total_size(input_path: str) -> int:
+        """ Total size in bytes of a file, or of every file inside a directory """
+        if os.path.isfile(input_path):
+            return os.path.getsize(input_path)
+        return sum(os.path.getsize(os.path.join(root, file))
+                   for root, _, files in os.walk(input_path) for file in files)
+
+    @staticmethod
+    def _hash_pieces(file_paths: List[str], 
+                     piece_length: int, 
+                     workers: int = None,
+                     progress: Callable[[int, int], None] = None) -> bytes:
+        """
+        Hash the concatenation of `file_paths` piece by piece.
+
+        The files are streamed with `readinto` into a fixed ring of reusable piece buffers,
+        and the SHA-1 of each full buffer is computed on a thread pool (hashlib releases the
+        GIL while hashing), so reading and hashing overlap and use several cores. Digests
+        are collected in piece order. The ring takes at most `MAX_HASH_BUFFER` bytes (but
+        always two buffers), so large pieces use fewer cores rather than more memory.
+
+        Args:
+            `file_paths`: Files to hash, in torrent order
+            `piece_length`: Number of bytes in each piece
+            `workers`: Number of hashing threads (default: number of CPUs)
+            `progress`: Called as `progress(bytes_hashed, total_bytes)` after every piece
+
+        Returns:
+            Concatenated SHA-1 hashes of all pieces (in binary format)
+        """
+        workers = workers or os.cpu_count() or 1
+        total_bytes = sum(os.path.getsize(path) for path in file_paths)
+        number_of_buffers = max(2, min(2 * workers, MAX_HASH_BUFFER // piece_length))
+        buffers = deque(bytearray(piece_length) for _ in range(number_of_buffers))
+        in_flight = deque()   # (future, buffer, length) in piece order
+        pieces = []
+        hashed_bytes = 0
+
+        def sha1(view: memoryview) -> bytes:
+            return hashlib.sha1(view).digest()
+
+        def collect_oldest():
+            nonlocal hashed_bytes
+            future, buffer, length = in_flight.popleft()
+            pieces.append(future.result())
+            buffers.append(buffer)
+            hashed_bytes += length
+            if progress is not None:
+                progress(hashed_bytes, total_bytes)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            buffer = buffers.popleft()
+            view = memoryview(buffer)
+            filled = 0
+            for path in file_paths:
+                with open(path, 'rb', buffering=0) as f:
+                    while True:
+                        n = f.readinto(view[filled:])
+                        if not n:
+                            break
+                        filled += n
+                        if filled == piece_length:
+                            in_flight.append((executor.submit(sha1, view), buffer, filled))
+                            if not buffers:
+                                collect_oldest()
+                            buffer = buffers.popleft()
+                            view = memoryview(buffer)
+                            filled = 0
+            if filled:
+                in_flight.append((executor.submit(sha1, view[:filled]), buffer, filled))
+            while in_flight:
+                collect_oldest()
+
+        return b''.join(pieces)
+
+    @staticmethod
+    def _list_directory(dir_path: str) -> List[Tuple[str, List[str]]]:
+        """ `(full_path, relative_path_parts)` of every file in a directory, in torrent order """
+        return [
+            (os.path.join(root, file), 
+             os.path.relpath(os.path.join(root, file), start=dir_path).split(os.sep))
+            for root, _, files in os.walk(dir_path) for file in files
+        ]
+
+    def _generate_file_pieces(file_path: str, 
+                              piece_length: str=262144,
+                              workers: int = None,
+                              progress: Callable[[int, int], None] = None):
         """
         Generate concatenated SHA-1 hashes of all file pieces.
 
@@ -95,19 +317,12 @@ class TorrentFile:
         Returns:
             Concatenated SHA-1 hashes of all file pieces (in binary format)
         """
-        pieces = []  # List to hold the SHA-1 hashes of each piece
-
-        with open(file_path, 'rb') as f:  # Open the file in binary mode
-            while True:
-                piece = f.read(piece_length) # Read a chunk of the file with size piece_length
-                if not piece:
-                    break
-                sha1 = hashlib.sha1(piece).digest()  # Generate the SHA-1 hash of the chunk
-                pieces.append(sha1)  # Append the binary SHA-1 hash to the pieces list
-
-        return b''.join(pieces)  # Concatenate all the SHA-1 hashes and return them as a single byte string
+        return TorrentFile._hash_pieces([file_path], piece_length, workers, progress)
     
-    def _generate_file_pieces_for_directory(dir_path: str, piece_length: str = 262144):
+    def _generate_file_pieces_for_directory(dir_path: str, 
+                                            piece_length: str = 262144,
+                                            workers: int = None,
+                                            progress: Callable[[int, int], None] = None):
         """
         Generate SHA-1 hashes for each piece of all files in a directory.
         Concatenate files together and treat them as a single stream of data.
@@ -118,40 +333,23 @@ class TorrentFile:
         Returns: 
             Concatenated SHA-1 hashes of all file pieces and file list metadata
         """
-        pieces = []
-        file_list = []
-        total_data = b''
-
-        # Traverse the directory and process each file
-        for root, _, files in os.walk(dir_path):
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.relpath(full_path, start=dir_path).split(os.sep)
-                # process_file(full_path, relative_path)
-                file_list.append({
-                    'length': os.path.getsize(full_path),
-                    'path': relative_path
-                })
-
-                # Process each file by reading its data in chunks and generating SHA-1 hashes.
-                with open(full_path, 'rb') as f:
-                    while True:
-                        piece = f.read(piece_length)
-                        if not piece:
-                            break
-                        total_data += piece
-                        if len(total_data) >= piece_length:
-                            sha1 = hashlib.sha1(total_data[:piece_length]).digest()
-                            pieces.append(sha1) 
-                            total_data = total_data[piece_length:]
-        if len(total_data) > 0:
-            sha1 = hashlib.sha1(total_data).digest()
-            pieces.append(sha1)
-        
-        return b''.join(pieces), file_list
+        files = TorrentFile._list_directory(dir_path)
+        file_list = [{
+            'length': os.path.getsize(full_path),
+            'path': relative_path
+        } for full_path, relative_path in files]
+        pieces = TorrentFile._hash_pieces([full_path for full_path, _ in files], 
+                                          piece_length, workers, progress)
+        return pieces, file_list
 
     @classmethod
-    def create_torrent_file(cls, input_path: str, trackers: List[List[str]], piece_length: int = 262144, output_path: str = None):
+    def create_torrent_file(cls, 
+                            input_path: str, 
+                            trackers: List[List[str]], 
+                            piece_length: int = 262144, 
+                            output_path: str = None,
+                            workers: int = None,
+                            progress: Callable[[int, int], None] = None):
         """
         Create a metainfo (.torrent) file for the given file. 
         See http://bittorrent.org/beps/bep_0003.html for more.
@@ -161,6 +359,8 @@ class TorrentFile:
             `trackers` ([string]): A list of tracker URLs.
             `metainfo_dir_path` (string): The path to the directory to contain created metainfo file. 
                 (default is None, which means the file is at the same directory as the served file)
+            `workers` (int): Number of threads hashing pieces (default is the number of CPUs).
+            `progress` (callable): Called as `progress(bytes_hashed, total_bytes)` while hashing.
 
         Returns:
             `metainfo_filepath` (string): The path to the created metainfo file.
@@ -187,9 +387,9 @@ class TorrentFile:
             file_size = os.path.getsize(input_path)
 
             torrent_data["info"]["length"] = file_size
-            torrent_data["info"]["pieces"] = cls._generate_file_pieces(input_path, piece_length) # Concatenated SHA-1 hashes of pieces
+            torrent_data["info"]["pieces"] = cls._generate_file_pieces(input_path, piece_length, workers, progress) # Concatenated SHA-1 hashes of pieces
         else: # file_path is a directory
-            pieces, file_list = cls._generate_file_pieces_for_directory(input_path, piece_length)
+            pieces, file_list = cls._generate_file_pieces_for_directory(input_path, piece_length, workers, progress)
 
             torrent_data["info"]["pieces"] = pieces
             torrent_data["info"]["files"] = file_list
@@ -213,40 +413,15 @@ class TorrentFile:
             torrent_file_path (str): The path to the .torrent file.
         
         Returns:
-            str: The hexadecimal representation of the info_hash.
+            bytes: The SHA-1 digest of the Bencoded 'info' dictionary.
         
         Raises:
             FileNotFoundError: If the specified file does not exist.
-            bencodepy.DecoderError: If the file is not in a valid Bencoded format.
+            ValueError: If the file is not in a valid Bencoded format.
         """
-        try:
-            with open(torrent_filepath, 'rb') as file:
-                # Decode the torrent file
-                torrent_data = bencodepy.decode(file.read())
-                
-            # Extract the 'info' dictionary
-            info_dict = torrent_data[b'info']
-
-            # Compute SHA-1 hash of the Bencoded 'info' dictionary
-            info_hash = hashlib.sha1(bencodepy.encode(info_dict)).digest()
-            
-            return info_hash
-
-        except FileNotFoundError:
-            raise FileNotFoundError(f"The file '{torrent_filepath}' does not exist.")
-        except bencodepy.DecodingError:
-            raise ValueError("The file is not in a valid Bencoded format.")
+        return metainfo_registry.load(torrent_filepath).info_hash
 
     @classmethod 
     def get_tracker_url(cls, torrent_filepath: str) -> str:
-        try:
-            with open(torrent_filepath, 'rb') as file:
-                # Decode the torrent file
-                torrent_data = bencodepy.decode(file.read())
-                tracker_url = torrent_data[b"announce"].decode('utf-8')  
-                return tracker_url
-        except FileNotFoundError:
-            raise FileNotFoundError(f"The file '{torrent_filepath}' does not exist.")
-        except bencodepy.DecodingError:
-            raise ValueError("The file is not in a valid Bencoded format.")
+        return metainfo_registry.load(torrent_filepath).tracker_url
 # End-of-file (EOF)
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""Asynchronous HTTP client for the tracker"""
+import socket
+import base64
+import struct
+import asyncio
+import logging
+from typing import Any, Dict, List
+from urllib.parse import urlsplit
+import httpx
+from torrent_peer.config_loader import TRACKER_TIMEOUT, TRACKER_CONNECT_TIMEOUT, TRACKER_MAX_CONNECTIONS
+
+logger = logging.getLogger(__name__)
+
+_PORT = struct.Struct(">H")
+
+def decode_compact_peers(data: bytes, family: int = socket.AF_INET) -> List[Dict[str, Any]]:
+    """ Peers of a compact (BEP 23) peer string: 6 bytes per IPv4 peer, 18 per IPv6 peer """
+    size = 4 if family == socket.AF_INET else 16
+    view = memoryview(data)
+    return [
+        {
+            "ip": socket.inet_ntop(family, view[offset:offset + size]),
+            "port": _PORT.unpack_from(view, offset + size)[0]
+        } for offset in range(0, len(view) - size - 1, size + 2)
+    ]
+
+def _decode_peers(response: Dict[str, Any]) -> Dict[str, Any]:
+    """ Turn the compact peers of an announce response into `{"ip", "port"}` dicts """
+    peers = response.get("peers", [])
+    if isinstance(peers, str):
+        peers = decode_compact_peers(base64.b64decode(peers))
+        if response.get("peers6"):
+            peers += decode_compact_peers(base64.b64decode(response.pop("peers6")), socket.AF_INET6)
+        response["peers"] = peers
+    return response
+
+class TrackerClient:
+    """
+    Talks to trackers without blocking the event loop.
+
+    A single `httpx.AsyncClient` is shared by every torrent, so connections to a tracker are
+    kept alive and reused across announces. At most `max_connections` requests run at the
+    same time per tracker (scheme and host), the others wait for a slot, and every request
+    gives up after `timeout` seconds (`connect_timeout` to establish the connection).
+    Failed requests raise `httpx.HTTPError`.
+    """
+    def __init__(self,
+                 timeout: float = TRACKER_TIMEOUT,
+                 connect_timeout: float = TRACKER_CONNECT_TIMEOUT,
+                 max_connections: int = TRACKER_MAX_CONNECTIONS) -> None:
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_connections = max(1, max_connections)
+        self._client: httpx.AsyncClient = None
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use, so it belongs to the event loop that uses it
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_keepalive_connections=self.max_connections),
+                follow_redirects=True,
+            )
+        return self._client
+
+    def _slot(self, url: str) -> asyncio.Semaphore:
+        parts = urlsplit(url)
+        key = f"{parts.scheme}://{parts.netloc}"
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = asyncio.Semaphore(self.max_connections)
+        return slot
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        async with self._slot(url):
+            response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def announce(self, tracker_url: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """ GET /announce, returns the decoded response (`interval`, `min interval`, `peers`) """
+        response = await self.request("GET", tracker_url + "/announce", params=params)
+        return _decode_peers(response.json())
+
+    async def announce_batch(self, tracker_url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        POST /announce/batch: many torrents of this peer in one request. Returns the decoded
+        response of every torrent by info_hash, `interval` and `min interval` included.
+        """
+        response = (await self.request("POST", tracker_url + "/announce/batch", json=body)).json()
+        common = {key: value for key, value in response.items() if key != "torrents"}
+        return {info_hash: _decode_peers({**common, **torrent})
+                for info_hash, torrent in response["torrents"].items()}
+
+    async def upload(self,
+                     tracker_url: str,
+                     torrent_data: bytes,
+                     filename: str,
+                     data: Dict[str, str],
+                     params: Dict[str, Any]) -> Dict[str, Any]:
+        """ POST /announce with a torrent file to publish (followed by the announce it redirects to) """
+        response = await self.request("POST", tracker_url + "/announce",
+                                      files={"file": (filename, torrent_data)}, data=data, params=params)
+        return _decode_peers(response.json())
+
+    async def scrape(self, tracker_url: str, info_hashes: List[str]) -> Dict[str, Dict[str, int]]:
+        """ GET /scrape, returns the counts of every torrent by info_hash """
+        response = await self.request("GET", tracker_url + "/scrape", params={"info_hash": info_hashes})
+        return response.json()["files"]
+
+    async def get_torrents(self, tracker_url: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        response = await self.request("GET", tracker_url + "/torrents", params=params)
+        return response.json()
+
+    async def get_torrent_file(self, tracker_url: str, info_hash: str) -> bytes:
+        response = await self.request("GET", tracker_url + f"/torrents/{info_hash}")
+        return response.content
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,401 @@
+"""Peer wire connections on `asyncio.BufferedProtocol`, an alternative to streams"""
+import asyncio
+import struct
+from collections import deque
+from typing import Awaitable, Callable, Deque, Iterable, Optional, Tuple, Union
+from torrent_peer.peer_message import Handshake, PeerMessage, Piece, decode_message
+from torrent_peer.message_reader import MessageReader, MAX_MESSAGE_LENGTH, KEEP_ALIVE
+from torrent_peer.config_loader import WIRE_ENGINE
+
+# Bytes of the receive buffer messages are parsed from (it grows for longer messages)
+RECEIVE_BUFFER = 2**16
+# Decoded messages waiting for the reader before reading from the socket pauses
+MAX_PENDING_MESSAGES = 64
+# Writes up to this size are held until the end of the event loop iteration and sent together
+COALESCE_LIMIT = 512
+
+_LENGTH = struct.Struct('>I')
+_PIECE_PREFIX = struct.Struct('>IbII')
+
+# `block_buffer(index, begin, length)`: where to receive the block of a Piece, or None
+BlockBuffer = Callable[[int, int, int], Optional[memoryview]]
+
+class PeerWireProtocol(asyncio.BufferedProtocol):
+    """
+    One peer wire connection. It reads like `MessageReader` (`handshake`, `next`) and
+    writes through `writer`, which behaves like a `StreamWriter`.
+
+    Received bytes go straight from the socket into a reused buffer (`get_buffer`) and
+    are parsed into messages as they arrive, without a coroutine resume per read. When
+    `block_buffer` is set, the block of a Piece is received directly into the memory it
+    returns (e.g. its place in the piece being downloaded), and the Piece carries a view
+    of it; `drop_block` abandons such a block halfway.
+
+    Reading pauses while `MAX_PENDING_MESSAGES` messages wait for the reader; writing
+    pauses through `drain` while the transport's write buffer is full.
+    """
+    def __init__(self,
+                 client_connected_cb: Callable[["PeerWireProtocol", "WireWriter"], Awaitable[None]] = None,
+                 max_length: int = MAX_MESSAGE_LENGTH) -> None:
+        self.max_length = max_length
+        self.block_buffer: Optional[BlockBuffer] = None
+        self.writer: WireWriter = None
+        self._client_connected_cb = client_connected_cb
+        self._task: asyncio.Task = None
+        self._loop = asyncio.get_running_loop()
+        self._transport: asyncio.Transport = None
+        self._buffer = bytearray(RECEIVE_BUFFER)
+        self._start = 0         # Unparsed bytes are self._buffer[self._start:self._end]
+        self._end = 0
+        self._handshake: Optional[bytes] = None
+        self._block: Optional[memoryview] = None    # Destination of the block being received
+        self._block_filled = 0
+        self._block_key: Tuple[int, int] = None
+        self._block_dropped = False     # The rest of the block is read into scratch memory
+        self._messages: Deque[PeerMessage] = deque()
+        self._exception: Optional[BaseException] = None
+        self._eof = False
+        self._reading_paused = False
+        self._waiter: Optional[asyncio.Future] = None
+        self._writing_paused = False
+        self._drain_waiters: Deque[asyncio.Future] = deque()
+        self._closed = self._loop.create_future()
+
+    # Protocol callbacks
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self._transport = transport
+        self.writer = WireWriter(transport, self)
+        if self._client_connected_cb is not None:
+            self._task = self._loop.create_task(self._client_connected_cb(self, self.writer))
+            self._task.add_done_callback(self._client_done)
+
+    def _client_done(self, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is None:
+            return
+        self._loop.call_exception_handler({
+            "message": "Unhandled exception in client_connected_cb",
+            "exception": task.exception(),
+            "transport": self._transport,
+        })
+        self._transport.close()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._eof = True
+        if exc is not None and self._exception is None:
+            self._exception = exc
+        self._wakeup()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if not self._closed.done():
+            self._closed.set_result(None)
+        self.writer._pending.clear()
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup()
+        return False    # Close the transport
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._block is not None:
+            return self._block[self._block_filled:]
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > RECEIVE_BUFFER:
+                self._buffer = bytearray(RECEIVE_BUFFER)    # Grown for a long message
+        needed = self._needed()
+        if len(self._buffer) - self._start < needed or len(self._buffer) - self._end < RECEIVE_BUFFER // 4:
+            # Move the unparsed bytes to the front, into a larger buffer if the message needs it
+            buffer = self._buffer if len(self._buffer) >= needed else bytearray(needed)
+            buffer[:self._end - self._start] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._start, self._end = 0, self._end - self._start
+        return memoryview(self._buffer)[self._end:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        if self._block is not None:
+            self._block_filled += nbytes
+            if self._block_filled == len(self._block):
+                self._finish_block()
+            return
+        self._end += nbytes
+        try:
+            self._parse()
+        except (ValueError, struct.error) as e:
+            self._fail(e if isinstance(e, ValueError) else ValueError(f"Malformed message: {e}"))
+
+    # Parsing
+
+    def _needed(self) -> int:
+        """ Bytes the next message takes in the receive buffer, as far as is known yet """
+        if self._handshake is None or self._end - self._start < _LENGTH.size:
+            return RECEIVE_BUFFER
+        length = _LENGTH.unpack_from(self._buffer, self._start)[0]
+        return max(RECEIVE_BUFFER, _LENGTH.size + min(length, self.max_length))
+
+    def _parse(self) -> None:
+        buffer = self._buffer
+        while True:
+            available = self._end - self._start
+            if self._handshake is None:
+                if available < Handshake.length:
+                    return
+                self._handshake = bytes(buffer[self._start:self._start + Handshake.length])
+                self._start += Handshake.length
+                self._wakeup()
+                continue
+            if available < _LENGTH.size:
+                return
+            length = _LENGTH.unpack_from(buffer, self._start)[0]
+            if length == 0:
+                self._start += _LENGTH.size
+                self._deliver(KEEP_ALIVE)
+                continue
+            if length > self.max_length:
+                raise ValueError(f"Message of {length} bytes exceeds the limit of {self.max_length}")
+            if self.block_buffer is not None and available >= _PIECE_PREFIX.size \
+                    and buffer[self._start + _LENGTH.size] == PeerMessage.Piece and length > Piece.length:
+                _, _, index, begin = _PIECE_PREFIX.unpack_from(buffer, self._start)
+                destination = self.block_buffer(index, begin, length - Piece.length)
+                if destination is not None:
+                    if not self._receive_block(destination, index, begin, available):
+                        return  # The rest of the block is received in place
+                    continue
+            if available < _LENGTH.size + length:
+                return
+            end = self._start + _LENGTH.size + length
+            if buffer[self._start + _LENGTH.size] == PeerMessage.Piece:
+                # The Piece keeps a view of its block: not of this buffer, which is reused
+                message = decode_message(memoryview(bytes(buffer[self._start + _LENGTH.size:end])))
+            else:
+                with memoryview(buffer) as view:
+                    message = decode_message(view[self._start + _LENGTH.size:end])
+            self._start = end
+            if message is not None:
+                self._deliver(message)
+
+    def _receive_block(self, destination: memoryview, index: int, begin: int, available: int) -> bool:
+        """
+        Copy what was received of the block of the Piece at the start of the buffer to
+        `destination`, where the rest of it is then received. Returns True if the block
+        was complete already.
+        """
+        block_start = self._start + _PIECE_PREFIX.size
+        received = min(available - _PIECE_PREFIX.size, len(destination))
+        destination[:received] = self._buffer[block_start:block_start + received]
+        self._start = block_start + received
+        self._block, self._block_filled, self._block_key = destination, received, (index, begin)
+        if received < len(destination):
+            return False
+        self._finish_block()
+        return True
+
+    def _finish_block(self) -> None:
+        (index, begin), block = self._block_key, self._block
+        self._block, self._block_filled, self._block_key = None, 0, None
+        if self._block_dropped:
+            self._block_dropped = False
+            return
+        self._deliver(Piece(index, begin, block))
+
+    def drop_block(self) -> None:
+        """
+        Stop receiving a block in place: the rest of it is read and thrown away, and its
+        Piece is not delivered. Call it before the memory from `block_buffer` is given back
+        (e.g. when the block's request is released), so nothing writes to it afterwards.
+        """
+        if self._block is not None and not self._block_dropped:
+            self._block = memoryview(bytearray(len(self._block) - self._block_filled))
+            self._block_filled = 0
+            self._block_dropped = True
+
+    def _deliver(self, message: PeerMessage) -> None:
+        self._messages.append(message)
+        if len(self._messages) >= MAX_PENDING_MESSAGES and not self._reading_paused:
+            self._reading_paused = True
+            self._transport.pause_reading()
+        self._wakeup()
+
+    def _fail(self, exc: BaseException) -> None:
+        self._exception = exc
+        self._block, self._block_dropped = None, False
+        self._transport.pause_reading()
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait(self, timeout: float, body_timeout: float) -> None:
+        """
+        Wait for something to read. `timeout` applies until a message starts arriving,
+        and `body_timeout` (from then on) to the rest of it.
+        """
+        deadline = self._loop.time() + timeout
+        started = False
+        while True:
+            self._waiter = self._loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout=max(0, deadline - self._loop.time()))
+                return
+            except asyncio.TimeoutError:
+                if started or not (self._end > self._start or self._block is not None):
+                    raise
+                started = True
+                deadline = self._loop.time() + body_timeout
+            finally:
+                self._waiter = None
+
+    def _raise_closed(self) -> None:
+        if self._exception is not None:
+            raise self._exception
+        raise asyncio.IncompleteReadError(b"", None)
+
+    # Reading, as MessageReader
+
+    async def handshake(self, timeout: float) -> Handshake:
+        while self._handshake is None:
+            if self._eof or self._exception is not None:
+                self._raise_closed()
+            await self._wait(timeout, timeout)
+        if not Handshake.is_valid(self._handshake):
+            raise ValueError("Invalid handshake")
+        return Handshake.decode(self._handshake)
+
+    async def next(self, timeout: float, body_timeout: float = 10) -> Optional[PeerMessage]:
+        """
+        The next message: `KEEP_ALIVE` for a keep-alive, None for a message ID that is not
+        supported. Raises `asyncio.IncompleteReadError` once the connection is closed and
+        every message was read, and `asyncio.TimeoutError` when nothing arrives in time.
+        """
+        while not self._messages:
+            if self._eof or self._exception is not None:
+                self._raise_closed()
+            await self._wait(timeout, body_timeout)
+        message = self._messages.popleft()
+        if self._reading_paused and len(self._messages) <= MAX_PENDING_MESSAGES // 2 \
+                and self._exception is None and not self._transport.is_closing():
+            self._reading_paused = False
+            self._transport.resume_reading()
+        return message
+
+    async def _drain_helper(self) -> None:
+        if self._transport.is_closing():
+            # Let connection_lost run, then fail like StreamWriter.drain
+            await asyncio.sleep(0)
+            if self._closed.done():
+                raise ConnectionResetError("Connection lost")
+            return
+        if not self._writing_paused:
+            return
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+class WireWriter:
+    """
+    The sending side of a `PeerWireProtocol`, with the methods of `StreamWriter` used on
+    peer connections.
+
+    Small messages (up to `COALESCE_LIMIT` bytes, e.g. Have, Request or Cancel) are
+    collected until the end of the event loop iteration and handed to the transport in a
+    single write, or together with the next large write. `drain` only waits while the
+    transport's buffer is over its high-water mark.
+    """
+    def __init__(self, transport: asyncio.Transport, protocol: PeerWireProtocol) -> None:
+        self.transport = transport
+        self._protocol = protocol
+        self._pending = bytearray()
+        self._flush_scheduled = False
+
+    def write(self, data: bytes) -> None:
+        if len(data) <= COALESCE_LIMIT:
+            self._pending += data
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                asyncio.get_running_loop().call_soon(self.flush)
+            return
+        self.writelines((data,))
+
+    def writelines(self, buffers: Iterable[bytes]) -> None:
+        """ Write `buffers`, after the small messages collected so far, in one transport write """
+        parts = [bytes(self._pending)] if self._pending else []
+        self._pending.clear()
+        parts.extend(buffers)
+        self.transport.writelines(parts)
+
+    def flush(self) -> None:
+        """ Hand the collected small messages to the transport """
+        self._flush_scheduled = False
+        if self._pending and not self.transport.is_closing():
+            self.transport.write(bytes(self._pending))
+        self._pending.clear()
+
+    async def drain(self) -> None:
+        self.flush()
+        await self._protocol._drain_helper()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self) -> None:
+        self.flush()
+        self.transport.close()
+
+    async def wait_closed(self) -> None:
+        await self._protocol._closed
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+# The two ends of a connection with either engine
+Messages = Union[MessageReader, PeerWireProtocol]
+Writer = Union[asyncio.StreamWriter, WireWriter]
+
+async def open_connection(host: str, port: int) -> Tuple[PeerWireProtocol, WireWriter]:
+    """ Connect to a peer, like `asyncio.open_connection` """
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_connection(PeerWireProtocol, host, port)
+    return protocol, protocol.writer
+
+async def start_server(client_connected_cb: Callable[[PeerWireProtocol, WireWriter], Awaitable[None]],
+                       host: str,
+                       port: int) -> asyncio.AbstractServer:
+    """ Serve peer connections, like `asyncio.start_server` """
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: PeerWireProtocol(client_connected_cb), host, port)
+
+async def open_peer_connection(host: str,
+                               port: int,
+                               engine: str = WIRE_ENGINE) -> Tuple[Messages, Writer]:
+    """ Connect to a peer with the configured engine ("streams" or "protocol") """
+    if engine == "protocol":
+        return await open_connection(host, port)
+    if engine == "streams":
+        reader, writer = await asyncio.open_connection(host, port)
+        return MessageReader(reader), writer
+    raise ValueError(f"Unknown wire engine: {engine}")
+
+async def start_peer_server(client_connected_cb: Callable[[Messages, Writer], Awaitable[None]],
+                            host: str,
+                            port: int,
+                            engine: str = WIRE_ENGINE) -> asyncio.AbstractServer:
+    """ Serve peer connections with the configured engine; the callback gets `(messages, writer)` """
+    if engine == "protocol":
+        return await start_server(client_connected_cb, host, port)
+    if engine == "streams":
+        return await asyncio.start_server(
+            lambda reader, writer: client_connected_cb(MessageReader(reader), writer), host, port)
+    raise ValueError(f"Unknown wire engine: {engine}")
@@ -0,0 +1,139 @@
+"""SQLite-backed catalog of the torrents uploaded to the tracker"""
+import json
+import base64
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Columns that may be returned to clients (the path of the stored file stays private)
+PUBLIC_FIELDS = ("name", "description")
+
+class Catalog:
+    """
+    The torrents of the tracker in an SQLite database (WAL mode).
+
+    Listing is ordered by `(name, info_hash)` and paginated with a cursor holding the last
+    key returned, so every page is an index range scan however deep it is. Names can be
+    searched by prefix (also an index range) or by substring.
+
+    The methods block on SQLite, so the tracker calls them off its event loop. They may
+    run on several threads at once and take turns on the shared connection.
+    """
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS torrents (
+                    info_hash TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    description TEXT NOT NULL DEFAULT '',
+                    file_path TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS torrents_name ON torrents (name, info_hash)")
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+    def get(self, info_hash: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT info_hash, name, description, file_path FROM torrents WHERE info_hash = ?",
+                (info_hash,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def add(self, info_hash: str, name: str, description: str, file_path: str) -> None:
+        """ Insert a torrent, or replace the entry of one with the same info_hash """
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO torrents (info_hash, name, description, file_path, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (info_hash, name, description, file_path, time.time()))
+
+    def list(self,
+             limit: int = 100,
+             cursor: str = None,
+             prefix: str = None,
+             search: str = None,
+             fields: Sequence[str] = PUBLIC_FIELDS) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of torrents.
+
+        Args:
+            limit: Maximum number of torrents returned.
+            cursor: `next_cursor` of the previous page (None for the first page).
+            prefix: Only names starting with this.
+            search: Only names containing this (case-insensitive).
+            fields: Columns of `PUBLIC_FIELDS` to return besides info_hash.
+
+        Returns:
+            The torrents, and the cursor of the next page (None after the last page).
+        """
+        unknown = set(fields) - set(PUBLIC_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        conditions, params = [], []
+        if cursor:
+            conditions.append("(name, info_hash) > (?, ?)")
+            params.extend(self.decode_cursor(cursor))
+        if prefix:
+            # A range on the name index rather than LIKE, which SQLite cannot always use
+            conditions.append("name >= ? AND name < ?")
+            params.extend((prefix, prefix + "\U0010ffff"))
+        if search:
+            escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            conditions.append("name LIKE ? ESCAPE '\\'")
+            params.append(f"%{escaped}%")
+        columns = ", ".join(["info_hash", "name", *(field for field in fields if field != "name")])
+        query = f"SELECT {columns} FROM torrents"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY name, info_hash LIMIT ?"
+        params.append(limit + 1)
+        with self._lock:
+            rows = self.connection.execute(query, params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self.encode_cursor(rows[-1]["name"], rows[-1]["info_hash"])
+        torrents = [{"info_hash": row["info_hash"], **{field: row[field] for field in fields}}
+                    for row in rows]
+        return torrents, next_cursor
+
+    @staticmethod
+    def encode_cursor(name: str, info_hash: str) -> str:
+        return base64.urlsafe_b64encode(json.dumps([name, info_hash]).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, str]:
+        try:
+            name, info_hash = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            return str(name), str(info_hash)
+        except Exception:
+            raise ValueError("Invalid cursor")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self.connection.execute("SELECT 1 FROM torrents LIMIT 1").fetchone() is None
+
+    def import_json(self, json_path: str) -> int:
+        """ Import the entries of the former JSON catalog (`{info_hash: {...}}`). Returns their number. """
+        with open(json_path, "r") as file:
+            data = json.load(file)
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO torrents (info_hash, name, description, file_path, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(info_hash, entry.get("name", ""), entry.get("description", ""), entry["file_path"],
+                  time.time())
+                 for info_hash, entry in data.items() if "file_path" in entry])
+        return len(data)
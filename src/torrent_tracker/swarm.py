@@ -0,0 +1,196 @@
+"""In-memory registry of the peers of every torrent"""
+import os
+import json
+import time
+import random
+import socket
+import struct
+from collections import OrderedDict
+from typing import Collection, Dict, List, Tuple
+
+Address = Tuple[str, int]
+# When a peer last announced, and whether it has the whole torrent
+PeerState = Tuple[float, bool]
+
+_PORT = struct.Struct(">H")
+
+def compact_peers(addresses: List[Address]) -> Tuple[bytes, bytes]:
+    """
+    BEP 23 compact form of peers: 6 bytes per IPv4 peer (address, then port, big-endian)
+    and 18 bytes per IPv6 peer, returned separately. Peers whose address is not an IP
+    (e.g. a host name) cannot be represented and are left out.
+    """
+    ipv4, ipv6 = [], []
+    for ip, port in addresses:
+        try:
+            ipv4.append(socket.inet_pton(socket.AF_INET, ip) + _PORT.pack(port))
+            continue
+        except OSError:
+            pass
+        try:
+            ipv6.append(socket.inet_pton(socket.AF_INET6, ip) + _PORT.pack(port))
+        except OSError:
+            pass
+    return b"".join(ipv4), b"".join(ipv6)
+
+class SwarmRegistry:
+    """
+    The peers of every swarm, keyed by info_hash, with the time each one last announced
+    and whether it is a seed.
+
+    Every swarm is an `OrderedDict` of `(ip, port) -> (last_seen, seed)` kept in announce
+    order: a peer that announces again moves to the end, so the peers that have gone quiet
+    for more than `peer_ttl` seconds are always at the front and expiring them costs nothing
+    for the live ones. An announce only touches its own swarm, so it takes the same time
+    however many swarms the tracker holds.
+
+    The number of seeds of every swarm, and of `completed` events of every torrent, are
+    counted as peers come, change and go, so `stats` never scans a swarm.
+
+    The registry lives in memory. `snapshot` and `restore` save it to and load it from a
+    JSON file, e.g. to survive a restart; writing the snapshot is up to the caller.
+    """
+    def __init__(self, peer_ttl: float) -> None:
+        self.peer_ttl = peer_ttl
+        self.swarms: Dict[str, "OrderedDict[Address, PeerState]"] = {}
+        self.seeders: Dict[str, int] = {}
+        # Downloads finished, by info_hash (kept when the swarm empties)
+        self.completed: Dict[str, int] = {}
+
+    def announce(self,
+                 info_hash: str,
+                 address: Address,
+                 event: str = None,
+                 now: float = None,
+                 left: int = None) -> None:
+        """
+        Record an announce: `stopped` removes the peer, anything else (re)adds it. The peer
+        is a seed if it has nothing `left` to download; if it does not say, it keeps its
+        earlier status (a new peer counts as a leecher).
+        """
+        now = time.time() if now is None else now
+        if event == "stopped":
+            swarm = self.swarms.get(info_hash)
+            if swarm is not None:
+                state = swarm.pop(address, None)
+                if state is not None and state[1]:
+                    self.seeders[info_hash] -= 1
+                if not swarm:
+                    self._drop_swarm(info_hash)
+            return
+        if event == "completed":
+            self.completed[info_hash] = self.completed.get(info_hash, 0) + 1
+        swarm = self.swarms.get(info_hash)
+        if swarm is None:
+            swarm = self.swarms[info_hash] = OrderedDict()
+            self.seeders[info_hash] = 0
+        state = swarm.get(address)
+        was_seed = state is not None and state[1]
+        seed = was_seed if left is None else left == 0
+        if seed != was_seed:
+            self.seeders[info_hash] += 1 if seed else -1
+        swarm[address] = (now, seed)
+        swarm.move_to_end(address)
+
+    def stats(self, info_hash: str, now: float = None) -> Dict[str, int]:
+        """ Scrape counts of a torrent: seeds (`complete`), leechers (`incomplete`) and `downloaded` """
+        swarm = self.swarms.get(info_hash)
+        if swarm is not None:
+            self._expire_swarm(info_hash, swarm, time.time() if now is None else now)
+            swarm = self.swarms.get(info_hash)
+        seeders = self.seeders.get(info_hash, 0)
+        return {
+            "complete": seeders,
+            "incomplete": len(swarm) - seeders if swarm is not None else 0,
+            "downloaded": self.completed.get(info_hash, 0),
+        }
+
+    def _drop_swarm(self, info_hash: str) -> None:
+        del self.swarms[info_hash]
+        del self.seeders[info_hash]
+
+    def peers(self,
+              info_hash: str,
+              now: float = None,
+              numwant: int = None,
+              exclude: Collection[Address] = ()) -> List[Address]:
+        """
+        The live peers of a swarm (stale ones are dropped on the way), but those in
+        `exclude`: all of them, or a random sample of `numwant`.
+        """
+        swarm = self.swarms.get(info_hash)
+        if swarm is None:
+            return []
+        self._expire_swarm(info_hash, swarm, time.time() if now is None else now)
+        if info_hash not in self.swarms:
+            return []
+        peers = [address for address in swarm if address not in exclude]
+        if numwant is not None and len(peers) > numwant:
+            return random.sample(peers, numwant)
+        return peers
+
+    def _expire_swarm(self, info_hash: str, swarm: "OrderedDict[Address, PeerState]", now: float) -> int:
+        deadline = now - self.peer_ttl
+        expired = 0
+        while swarm:
+            address, (last_seen, seed) = next(iter(swarm.items()))
+            if last_seen > deadline:
+                break
+            del swarm[address]
+            if seed:
+                self.seeders[info_hash] -= 1
+            expired += 1
+        if not swarm:
+            self._drop_swarm(info_hash)
+        return expired
+
+    def expire(self, now: float = None) -> int:
+        """ Drop the stale peers (and empty swarms) of every swarm. Returns the number dropped. """
+        now = time.time() if now is None else now
+        return sum(self._expire_swarm(info_hash, swarm, now)
+                   for info_hash, swarm in list(self.swarms.items()))
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        JSON-ready copy of the registry: `{"peers": {info_hash: [[ip, port, last_seen, seed],
+        ...]}, "completed": {info_hash: count}}`
+        """
+        return {
+            "peers": {
+                info_hash: [[ip, port, last_seen, seed] for (ip, port), (last_seen, seed) in swarm.items()]
+                for info_hash, swarm in self.swarms.items()
+            },
+            "completed": dict(self.completed),
+        }
+
+    @staticmethod
+    def write_snapshot(snapshot: Dict[str, Dict], path: str) -> None:
+        """ Write a snapshot atomically (blocking, meant to run in a thread) """
+        with open(path + ".tmp", "w") as file:
+            json.dump(snapshot, file)
+        os.replace(path + ".tmp", path)
+
+    def restore(self, path: str) -> None:
+        """ Load a snapshot written by `write_snapshot`, if there is one """
+        try:
+            with open(path, "r") as file:
+                snapshot = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        if not isinstance(snapshot, dict):
+            return
+        if "peers" in snapshot:
+            swarms = snapshot["peers"] if isinstance(snapshot["peers"], dict) else {}
+            completed = snapshot.get("completed")
+            if isinstance(completed, dict):
+                self.completed.update({info_hash: int(count) for info_hash, count in completed.items()})
+        else:
+            swarms = snapshot    # Written before seeds were told apart: `{info_hash: [[ip, port, last_seen]]}`
+        for info_hash, peers in swarms.items():
+            if not isinstance(peers, list):
+                continue
+            for peer in sorted((peer for peer in peers if isinstance(peer, list) and len(peer) in (3, 4)),
+                               key=lambda peer: peer[2]):
+                left = 0 if len(peer) == 4 and peer[3] else None
+                self.announce(info_hash, (peer[0], int(peer[1])), now=float(peer[2]), left=left)
+        self.expire()
@@ -1,12 +1,20 @@
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional, Tuple
+from contextlib import asynccontextmanager
+from urllib.parse import urlencode
 from fastapi import FastAPI, Request, File, UploadFile, Form, Query, HTTPException, status
 from fastapi.responses import RedirectResponse, FileResponse
+from pydantic import BaseModel
 import configparser
 import uuid
 import os
-import json
+import base64
+import ipaddress
+import asyncio
+import logging
 import click
 import uvicorn
+from torrent_tracker.swarm import SwarmRegistry, compact_peers
+from torrent_tracker.catalog import Catalog, PUBLIC_FIELDS
 # Read configuration
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_PATH = os.path.join(CURRENT_DIR, "../config.ini")
@@ -14,17 +22,62 @@ config = configparser.ConfigParser()
 config.read(CONFIG_PATH)
 TORRENT_DIR = os.path.join(CURRENT_DIR, config["tracker"]["TORRENT_DIR"])
 PEER_FILE = os.path.join(CURRENT_DIR, config["tracker"]["PEER_FILE"])
+# Former JSON catalog, imported into CATALOG_DB once
 TORRENT_FILE = os.path.join(CURRENT_DIR, config["tracker"]["TORRENT_FILE"])
+CATALOG_DB = os.path.join(CURRENT_DIR, config["tracker"]["CATALOG_DB"])
+# Seconds peers are asked to wait between announces
+ANNOUNCE_INTERVAL = int(config["tracker"]["ANNOUNCE_INTERVAL"])
+# Seconds peers must wait at least between announces
+MIN_ANNOUNCE_INTERVAL = int(config["tracker"]["MIN_ANNOUNCE_INTERVAL"])
+# Seconds between snapshots of the peers to PEER_FILE (0: never)
+PEER_SNAPSHOT_INTERVAL = int(config["tracker"]["PEER_SNAPSHOT_INTERVAL"])
+# Peers returned by an announce that does not ask for a number (numwant), and the most returned
+DEFAULT_NUMWANT = int(config["tracker"]["DEFAULT_NUMWANT"])
+MAX_NUMWANT = int(config["tracker"]["MAX_NUMWANT"])
+# A peer that misses two announces in a row is dropped
+PEER_TTL = 2 * ANNOUNCE_INTERVAL
+# Largest page of GET /torrents, and most torrents of one GET /scrape or POST /announce/batch
+MAX_PAGE_SIZE = 1000
 os.makedirs(TORRENT_DIR, exist_ok=True)
 
-if (not os.path.exists(TORRENT_FILE)):
-    with open(TORRENT_FILE, "w") as file:
-        json.dump({}, file)
+logger = logging.getLogger(__name__)
 
-with open(PEER_FILE, "w") as file:
-    json.dump({}, file)
+catalog = Catalog(CATALOG_DB)
+if catalog.is_empty() and os.path.exists(TORRENT_FILE):
+    logger.info(f"Imported {catalog.import_json(TORRENT_FILE)} torrents from {TORRENT_FILE}")
 
-app = FastAPI()
+swarms = SwarmRegistry(PEER_TTL)
+
+async def expire_peers():
+    """ Drop the peers that stopped announcing, also from swarms nobody asks about """
+    while True:
+        await asyncio.sleep(min(ANNOUNCE_INTERVAL, 60))
+        swarms.expire()
+
+async def snapshot_peers():
+    """ Save the swarms to PEER_FILE every PEER_SNAPSHOT_INTERVAL seconds, off the event loop """
+    while True:
+        await asyncio.sleep(PEER_SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(SwarmRegistry.write_snapshot, swarms.snapshot(), PEER_FILE)
+        except Exception as e:
+            logger.error(f"Error saving peers to {PEER_FILE}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PEER_SNAPSHOT_INTERVAL > 0:
+        swarms.restore(PEER_FILE)
+    tasks = [asyncio.create_task(expire_peers())]
+    if PEER_SNAPSHOT_INTERVAL > 0:
+        tasks.append(asyncio.create_task(snapshot_peers()))
+    yield
+    for task in tasks:
+        task.cancel()
+    if PEER_SNAPSHOT_INTERVAL > 0:
+        SwarmRegistry.write_snapshot(swarms.snapshot(), PEER_FILE)
+    catalog.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Exception response
 class NotFoundError(HTTPException):
@@ -36,17 +89,63 @@ class BadRequestError(HTTPException):
         super().__init__(status_code=status.HTTP_400_BAD_REQUEST, detail=detail)
 
 # Function to get peers
-def get_peers(peer_dict, info_hash: str) -> List[Dict[str, str]]:
+def get_peers(info_hash: str, numwant: int = None, exclude=()) -> List[Dict[str, str]]:
     """
-    Retrieve the list of peers for a given info_hash.
+    Retrieve the list of live peers for a given info_hash (a random sample of `numwant`
+    if there are more).
     """
     return [
         {
-            "ip": peer["ip"], 
-            "port": peer["port"]
-        } for peer in peer_dict.get(info_hash, [])
+            "ip": ip, 
+            "port": port
+        } for ip, port in swarms.peers(info_hash, numwant=numwant, exclude=exclude)
     ]
 
+def peer_address(public_ip: str, ip: Optional[str], port: int) -> Tuple[str, int]:
+    """
+    Where other peers can reach an announcing peer: the address the request came from,
+    unless the peer reports a public IP. A reported private or loopback address (e.g.
+    the LAN address of a peer behind NAT) is not reachable from other networks.
+    """
+    try:
+        if ip and ipaddress.ip_address(ip).is_global:
+            return ip, port
+    except ValueError:
+        pass    # A host name
+    return public_ip, port
+
+def announce_torrent(public_ip: str,
+                     info_hash: str,
+                     port: int,
+                     ip: Optional[str],
+                     event: Optional[str],
+                     left: Optional[int],
+                     compact: int,
+                     numwant: Optional[int]) -> Dict[str, Any]:
+    """
+    Record the announce of one torrent, returns its swarm counts and `peers`. The peer is
+    registered once, under `peer_address`.
+    """
+    address = peer_address(public_ip, ip, port)
+    # Any announce but "stopped" (re)adds the peer and refreshes its last-seen time
+    swarms.announce(info_hash, address, event, left=left)
+
+    response = swarms.stats(info_hash)
+    if event == "stopped":
+        response["peers"] = "" if compact else []
+        return response
+    # Respond with a sample of the other peers of this torrent
+    numwant = DEFAULT_NUMWANT if numwant is None else min(numwant, MAX_NUMWANT)
+    exclude = {address}
+    if compact:
+        ipv4, ipv6 = compact_peers(swarms.peers(info_hash, numwant=numwant, exclude=exclude))
+        response["peers"] = base64.b64encode(ipv4).decode("ascii")
+        if ipv6:
+            response["peers6"] = base64.b64encode(ipv6).decode("ascii")
+    else:
+        response["peers"] = get_peers(info_hash, numwant, exclude)
+    return response
+
 @app.get("/")
 def get_status():
     return {"status": "Tracker is running."}
@@ -57,38 +156,58 @@ async def announce(
     info_hash: (str) = Query(...), 
     port: int = Query(...), 
     ip: str = Query(None),
-    event: str = Query(None)
+    event: str = Query(None),
+    left: int = Query(None, ge=0),
+    compact: int = Query(0),
+    numwant: int = Query(None, ge=0)
 ):
-    public_ip = request.client.host # Get client IP
-    with open(PEER_FILE, "r") as f:
-        peer_dict = json.load(f) 
+    """
+    Register the peer and return other peers of the torrent: at most `numwant`, picked at
+    random. With `compact=1`, `peers` (IPv4) and `peers6` (IPv6) are base64 strings of
+    6 and 18 bytes per peer (BEP 23) instead of lists of `{"ip", "port"}`. A peer with
+    nothing `left` to download counts as a seed.
+    """
+    response = {"interval": ANNOUNCE_INTERVAL, "min interval": MIN_ANNOUNCE_INTERVAL}  # In seconds
+    response.update(announce_torrent(request.client.host, info_hash, port, ip, event, left, compact, numwant))
+    return response
 
-    peer_dict.setdefault(info_hash, []) 
+class BatchEntry(BaseModel):
+    info_hash: str
+    event: Optional[str] = None
+    left: Optional[int] = None
 
+class BatchAnnounce(BaseModel):
+    port: int
+    ip: Optional[str] = None
+    compact: int = 0
+    numwant: Optional[int] = None
+    torrents: List[BatchEntry]
 
-    def update_peer_info(peer):
-        """
-        Function for update peer_dict
+@app.post("/announce/batch")
+async def announce_batch(request: Request, batch: BatchAnnounce):
+    """
+    Announce many torrents of one peer in a single request. Every entry is handled like
+    `GET /announce` with the shared `port`, `ip`, `compact` and `numwant`:
+    `{"interval", "min interval", "torrents": {<info_hash>: {"peers", "complete", ...}}}`.
+    """
+    if len(batch.torrents) > MAX_PAGE_SIZE:
+        raise BadRequestError(f"At most {MAX_PAGE_SIZE} torrents per batch.")
+    if (batch.numwant is not None and batch.numwant < 0) or \
+            any(entry.left is not None and entry.left < 0 for entry in batch.torrents):
+        raise BadRequestError("numwant and left cannot be negative.")
+    return {
+        "interval": ANNOUNCE_INTERVAL,
+        "min interval": MIN_ANNOUNCE_INTERVAL,
+        "torrents": {
+            entry.info_hash: announce_torrent(request.client.host, entry.info_hash, batch.port, batch.ip,
+                                              entry.event, entry.left, batch.compact, batch.numwant)
+            for entry in batch.torrents
+        }
+    }
 
-        Args:
-        - peer: peer information
-            Example: { "ip": <ip>, "port": <port> }
-        """
-        if event=="started" and peer not in peer_dict[info_hash]:
-            peer_dict[info_hash].append(peer)
-        elif event == 'stopped':
-            peer_dict[info_hash] = [p for p in peer_dict[info_hash] if p != peer]
-    
-    update_peer_info({"ip": public_ip, "port": port})
-    if ip:
-        update_peer_info({"ip": ip, "port": port})
-
-    # Respond with a list of peers for this torrent
-    peers = get_peers(peer_dict, info_hash)
-    with open(PEER_FILE, 'w') as f:
-        json.dump(peer_dict, f, indent=4)
-    response = {"interval": 1800, "peers": peers}  # 'interval' is in seconds
-    return response
+def _write_file(path: str, content: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(content)
 
 @app.post("/announce")
 async def insert_torrent(
@@ -98,57 +217,82 @@ async def insert_torrent(
     info_hash: str = Query(...),
     port: int = Query(...),
     ip: str = Query(None),
+    left: int = Query(None, ge=0),
+    compact: int = Query(0),
+    numwant: int = Query(None, ge=0)
 ):
     # Check if the file has a .torrent extension
     if not file.filename.endswith(".torrent"):
         raise BadRequestError("Accept file with .torrent file extension only.")
 
-    with open(TORRENT_FILE, "r") as f:
-        data = json.load(f) 
-
-    if info_hash not in data or not os.path.exists(data[info_hash]["file_path"]):
+    # The catalog and the file are handled on a worker thread, not to block the announces
+    entry = await asyncio.to_thread(catalog.get, info_hash)
+    if entry is None or not os.path.exists(entry["file_path"]):
         file_path = os.path.join(TORRENT_DIR, f"{uuid.uuid4()}.torrent")
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
+        content = await file.read()
+        await asyncio.to_thread(_write_file, file_path, content)
 
         name = name + ".torrent" if name else file.filename
+        await asyncio.to_thread(catalog.add, info_hash, name, description, file_path)
 
-        data[info_hash] = {
-            "file_path": file_path,
-            "name": name,
-            "description": description,
-        }
-
-        with open(TORRENT_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
-
+    params = {"info_hash": info_hash, "port": port, "ip": ip, "event": "started", "left": left,
+              "compact": compact, "numwant": numwant}
     return RedirectResponse(
-        url=f"/announce?info_hash={info_hash}&port={port}&{'ip=' + ip + '&' if ip else ''}event=started", 
+        url="/announce?" + urlencode({key: value for key, value in params.items() if value is not None}), 
         status_code=302
     )
 
+@app.get("/scrape")
+async def scrape(info_hash: List[str] = Query(...)):
+    """
+    Swarm counts of many torrents at once (repeat `info_hash`): `{"files": {<info_hash>:
+    {"complete": <seeds>, "incomplete": <leechers>, "downloaded": <completed downloads>}}}`.
+    """
+    if len(info_hash) > MAX_PAGE_SIZE:
+        raise BadRequestError(f"At most {MAX_PAGE_SIZE} info_hash per scrape.")
+    return {"files": {value: swarms.stats(value) for value in info_hash}}
+
+# The catalog endpoints are plain functions: FastAPI runs them in its threadpool, so the
+# SQLite queries do not block the event loop that answers the announces
 @app.get("/torrents")
-async def get_all_torrents():
-    with open(TORRENT_FILE, "r") as f:
-        data = json.load(f)
-    for key in data:
-        if "file_path" in data[key]:
-            del data[key]["file_path"]
-    return data
+def get_all_torrents(
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = Query(None),
+    prefix: str = Query(None),
+    search: str = Query(None),
+    fields: str = Query(",".join(PUBLIC_FIELDS))
+):
+    """
+    One page of the catalog, ordered by name: `{"torrents": {<info_hash>: {<field>: ...}},
+    "next_cursor": <cursor of the next page, or null>}`.
+    """
+    try:
+        torrents, next_cursor = catalog.list(
+            limit=limit, 
+            cursor=cursor, 
+            prefix=prefix, 
+            search=search,
+            fields=[field.strip() for field in fields.split(",") if field.strip()]
+        )
+    except ValueError as e:
+        raise BadRequestError(str(e))
+    return {
+        "torrents": {torrent.pop("info_hash"): torrent for torrent in torrents},
+        "next_cursor": next_cursor
+    }
 
 @app.get("/torrents/{info_hash}")
-async def get_torrent_by_info_hash(info_hash: str):
-    with open(TORRENT_FILE, "r") as f:
-        data = json.load(f)
+def get_torrent_by_info_hash(info_hash: str):
+    entry = catalog.get(info_hash)
 
-    if info_hash not in data or not os.path.exists(data[info_hash]["file_path"]):
+    if entry is None or not os.path.exists(entry["file_path"]):
         raise BadRequestError(
             detail=f"Bad Request: {info_hash} not found"
         )
 
     return FileResponse(
-        path = data[info_hash]["file_path"],
-        filename = data[info_hash]["name"],
+        path = entry["file_path"],
+        filename = entry["name"],
         media_type= "application/octet-stream"
     )
 @click.command()